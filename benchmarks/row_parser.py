@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for decoding ``produkt_*`` files.
+
+Compares the compiled row decoders with the vectorized NumPy parser
+on a synthetic file of hourly air temperature data. Synopsis::
+
+    python benchmarks/row_parser.py [count]
+"""
+import sys
+import time
+import random
+
+from dwdweather.parser import get_row_decoder, parse_columns
+
+
+def synthetic_textfile(count):
+    """
+    Generate content like it is found within ``produkt_tu_stunde_*`` files.
+    """
+    rnd = random.Random(42)
+    lines = ["STATIONS_ID;MESS_DATUM;QN_9;TT_TU;RF_TU;eor"]
+    for index in range(count):
+        lines.append(
+            "{:>11};{};{:>5};{:>6.1f};{:>6.1f};eor".format(
+                44,
+                "%04d%02d%02d%02d" % (1950 + index // 8760, 1 + index // 720 % 12, 1 + index // 24 % 28, index % 24),
+                3,
+                rnd.uniform(-20, 35),
+                -999 if index % 50 == 0 else rnd.uniform(20, 100),
+            )
+        )
+    return "\r\n".join(lines) + "\r\n"
+
+
+def run(count):
+    text = synthetic_textfile(count)
+    print("Hourly air temperature, {:,} rows".format(count))
+
+    started = time.time()
+    decoder = get_row_decoder("hourly", "air_temperature")
+    rows = [decoder(line) for line in text.splitlines()[1:]]
+    slow = time.time() - started
+    print("{:<12} {:>10.3f} s {:>14,.0f} rows/s".format("decoder", slow, count / slow))
+
+    started = time.time()
+    columns = parse_columns(text, "hourly", "air_temperature")
+    fast = time.time() - started
+    print("{:<12} {:>10.3f} s {:>14,.0f} rows/s".format("numpy", fast, count / fast))
+    print("{:<12} {:>10.1f} x".format("speedup", slow / fast))
+
+    # Converting columns back into rows of Python objects, like
+    # needed for writing them to the database, takes extra time.
+    started = time.time()
+    records = list(columns.iter_rows())
+    fast += time.time() - started
+    print("{:<12} {:>10.3f} s {:>14,.0f} rows/s".format("numpy+rows", fast, count / fast))
+    print("{:<12} {:>10.1f} x".format("speedup", slow / fast))
+
+    assert rows == records
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for decoding raw ``MESS_DATUM`` values.
+
+Compares the precompiled per-resolution decoder with the dateutil-based
+path on synthetic timestamps. Synopsis::
+
+    python benchmarks/timestamp_decoder.py [count]
+"""
+import sys
+import time
+import random
+
+from dwdweather.knowledge import DwdCdcKnowledge
+from dwdweather.parser import get_timestamp_decoder, parse_timestamp
+
+
+def synthetic_timestamps(count, timestamp_format):
+    """
+    Generate raw timestamps like they are found within ``produkt_*`` files.
+    """
+    rnd = random.Random(42)
+    items = []
+    for _ in range(count):
+        value = "%04d%02d%02d%02d%02d" % (
+            rnd.randint(1893, 2020),
+            rnd.randint(1, 12),
+            rnd.randint(1, 28),
+            rnd.randint(0, 23),
+            rnd.randint(0, 5) * 10,
+        )
+        items.append(value[: len(time.strftime(timestamp_format, time.gmtime(0)))])
+    return items
+
+
+def measure(label, function, items):
+    started = time.time()
+    for item in items:
+        function(item)
+    duration = time.time() - started
+    print(
+        "{:<12} {:>10.3f} s {:>14,.0f} timestamps/s".format(
+            label, duration, len(items) / duration
+        )
+    )
+    return duration
+
+
+def run(count):
+    for resolution, knowledge in DwdCdcKnowledge.climate.get_resolutions().items():
+        timestamp_format = knowledge.__timestamp_format__
+        items = synthetic_timestamps(count, timestamp_format)
+        decoder = get_timestamp_decoder(timestamp_format)
+
+        # Sanity check.
+        for item in items[:1000]:
+            assert decoder(item) == parse_timestamp(item, timestamp_format)
+
+        print('Resolution "{}", {:,} timestamps'.format(resolution, count))
+        slow = measure("dateutil", lambda item: parse_timestamp(item, timestamp_format), items)
+        fast = measure("decoder", decoder, items)
+        print("{:<12} {:>10.1f} x".format("speedup", slow / fast))
+        print()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
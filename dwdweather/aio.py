@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+# (c) 2014 Marian Steinbach, MIT licensed
+# (c) 2018-2019 Andreas Motl, MIT licensed
+import os
+import asyncio
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from dwdweather.client import DwdCdcResult, index_archives, read_archive
+from dwdweather.util import DwdCdcResource, chunked, parse_html_file_list
+
+"""
+Asynchronous interface for serving many lookups from one event loop.
+
+HTTP requests are made using aiohttp, sharing the response cache and the
+listing index with the synchronous client. Blocking work is offloaded:
+the cache index is accessed from the default executor, while all access
+to the cache database goes through a single database thread, which owns
+its own ``DwdWeather`` instance. Concurrent lookups needing the same
+data share one import.
+"""
+
+log = logging.getLogger(__name__)
+
+
+def import_aiohttp():
+    """
+    Import aiohttp, which is an optional dependency.
+    """
+    try:
+        import aiohttp
+    except ImportError:  # pragma: no cover
+        raise ImportError(
+            'The asynchronous interface needs aiohttp, please install it using "pip install dwdweather2[async]"'
+        )
+    return aiohttp
+
+
+class AsyncDwdCdcClient:
+    """
+    Non-blocking counterpart of ``DwdCdcClient``, using its
+    configuration, response cache and listing index.
+
+    The client is bound to the event loop it is first used
+    from, ``close()`` must be awaited when done.
+    """
+
+    def __init__(self, cdc):
+
+        # Synchronous client, providing configuration and caches.
+        self.cdc = cdc
+
+        # HTTP client, created within the event loop.
+        self.session = None
+
+        # Running tasks by key, for sharing them between callers.
+        self.tasks = {}
+
+        # Bounds the number of concurrent requests, created within the event loop.
+        self.semaphore = None
+
+    def get_session(self):
+        if self.session is None:
+            aiohttp = import_aiohttp()
+            self.session = aiohttp.ClientSession(
+                headers={"User-Agent": self.cdc.http.headers["User-Agent"]},
+                connector=aiohttp.TCPConnector(limit=self.cdc.max_connections),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.cdc.cache.timeout, sock_read=self.cdc.cache.timeout
+                ),
+            )
+        return self.session
+
+    def get_semaphore(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.cdc.max_connections)
+        return self.semaphore
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def run(self, function, *args):
+        """
+        Run blocking function in the default executor.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(function, *args))
+
+    async def shared(self, key, factory):
+        """
+        Await task identified by ``key``, which is created by calling
+        ``factory()`` unless another caller is awaiting it already.
+        """
+        task = self.tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.tasks[key] = task
+            task.add_done_callback(lambda task: self.tasks.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def fetch(self, uri, resource_class, size=None, chunk_size=65536, modified=None):
+        """
+        Make sure the resource is in the response cache, like
+        ``HttpCache.fetch``. Returns its record.
+        """
+        cache = self.cdc.cache
+
+        # Downloads of the same resource are serialized with the synchronous
+        # client. Poll the lock, in order not to block the event loop.
+        uri_lock = cache.get_uri_lock(uri)
+        while not uri_lock.acquire(blocking=False):
+            await asyncio.sleep(0.01)
+        try:
+            entry = await self.run(cache.lookup, uri)
+
+            # Serve fresh responses without asking the server.
+            ttl = self.cdc.get_ttl(resource_class, uri)
+            if cache.is_fresh(entry, ttl) and cache.is_current(entry, size, modified):
+                cache.count("fresh")
+                cache.count("bytes_saved", entry["size"])
+                return await self.run(cache.serve, entry)
+
+            record = await self.transfer_resuming(uri, entry, chunk_size)
+
+            # Server confirmed a cache entry not matching the listing, request it unconditionally.
+            if entry is not None and not cache.has_size(record, size):
+                log.warning("Revalidated {} does not match its listing, downloading again".format(uri))
+                record = await self.transfer_resuming(uri, None, chunk_size)
+
+            await self.run(cache.check_size, uri, record, size)
+            return await self.run(cache.serve, record)
+        finally:
+            uri_lock.release()
+
+    async def transfer_resuming(self, uri, entry, chunk_size=65536):
+        """
+        Transfer resource, resuming interrupted downloads,
+        like ``HttpCache.transfer_resuming``.
+        """
+        aiohttp = import_aiohttp()
+        attempt = 0
+        while True:
+            try:
+                async with self.get_semaphore():
+                    return await self.transfer(uri, entry, chunk_size)
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as ex:
+                attempt += 1
+                if attempt > self.cdc.cache.retries:
+                    raise
+                log.warning("Download of {} interrupted, resuming: {}".format(uri, ex))
+
+    async def transfer(self, uri, entry, chunk_size=65536):
+        """
+        Request resource and stream its body into the partial file,
+        like ``HttpCache.transfer``.
+        """
+        cache = self.cdc.cache
+        headers, partial_path, offset = await self.run(cache.prepare_transfer, uri, entry)
+
+        async with self.get_session().get(uri, headers=headers) as response:
+
+            # Resource has not changed, refresh cache entry.
+            if entry and response.status == 304:
+                await self.run(cache.revalidated, uri, entry, response.headers)
+                return cache.result(entry)
+
+            # Partial file does not match the resource anymore.
+            if response.status == 416:
+                os.remove(partial_path)
+                return await self.transfer(uri, entry, chunk_size)
+
+            response.raise_for_status()
+
+            content_hash, received, mode = await self.run(
+                cache.open_partial, uri, partial_path, offset, response.status, response.headers
+            )
+            with open(partial_path, mode) as body:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    body.write(chunk)
+                    content_hash.update(chunk)
+                    received += len(chunk)
+                    cache.count("bytes_downloaded", len(chunk))
+
+        return await self.run(
+            cache.complete_transfer, uri, response.headers, partial_path, received, content_hash
+        )
+
+    async def open(self, uri, resource_class, size=None, modified=None):
+        """
+        Make sure the resource is in the response cache and open
+        its blob for reading. Returns ``(record, fileobj)`` tuple.
+        """
+        for attempt in range(3):
+            record = await self.fetch(uri, resource_class, size=size, modified=modified)
+            try:
+                path = self.cdc.cache.get_blob_path(record["content_hash"])
+                return record, open(path, "rb")
+            except FileNotFoundError:
+                # Blob has been evicted in the meantime.
+                log.warning("Blob for {} has been evicted, fetching again".format(uri))
+        raise IOError("Could not acquire {}".format(uri))
+
+    async def read(self, uri, resource_class):
+        """
+        Download resource through the response cache and return its content.
+        """
+        record, fileobj = await self.open(uri, resource_class)
+        with fileobj:
+            return await self.run(fileobj.read)
+
+    async def get_resource_index(self, uri, extension):
+        log.info(u"Requesting %s", uri)
+        try:
+            html = await self.read(uri, "listing")
+        except import_aiohttp().ClientResponseError as ex:
+            if ex.status == 404:
+                return []
+            raise
+        items = await self.run(parse_html_file_list, uri, html, extension)
+        return [DwdCdcResource(*item) for item in items]
+
+    async def get_listing(self, category, timerange):
+        """
+        Return listing of a folder from the listing index, see
+        ``DwdCdcClient.get_listing``. Expired listings are refreshed once,
+        even when requested by multiple callers at the same time.
+        """
+        listings = self.cdc.listings
+        key = self.cdc.get_listing_key(category, timerange)
+        ttl = self.cdc.ttl_policy.get("listing", timerange, self.cdc.resolution)
+        listing = await self.run(listings.lookup, key, ttl)
+        if listing is not None:
+            return listing
+
+        async def refresh():
+            index_uri = self.cdc.get_index_uri(category, timerange)
+            resources = await self.get_resource_index(index_uri, "zip")
+            return await self.run(listings.update, key, list(index_archives(resources)))
+
+        return await self.shared(("listing",) + key, refresh)
+
+    async def get_measurement_resources(self, station_id, category, timeranges):
+        """
+        Find measurement archives for given station, category and timeranges.
+        Returns list of ``DwdCdcResource`` items.
+        """
+        resources = []
+        index_uris = []
+        for timerange in timeranges:
+            index_uri = self.cdc.get_index_uri(category, timerange)
+            if index_uri in index_uris:
+                continue
+            index_uris.append(index_uri)
+            try:
+                listing = await self.get_listing(category, timerange)
+            except Exception:
+                log.exception("Could not acquire resource from {}".format(index_uri))
+                continue
+            resources += listing.get(station_id, [])
+        if not resources:
+            log.warning(
+                'Station "{}" has no data for category "{}"'.format(station_id, category["name"])
+            )
+        return resources
+
+    async def get_stations(self, categories):
+        """
+        Load station lists of all categories concurrently.
+        Returns list of ``DwdCdcResult`` items.
+        """
+
+        async def get_category_stations(category):
+            index_uri = self.cdc.get_stations_index_uri(category)
+            try:
+                resources = await self.get_resource_index(index_uri, "txt")
+            except Exception:
+                log.warning(
+                    'Resolution "{}" has no category "{}" or request failed'.format(
+                        self.cdc.resolution, category["name"]
+                    )
+                )
+                return []
+            uris = [
+                resource.uri for resource in resources if "Beschreibung_Stationen" in resource.uri
+            ]
+            payloads = await asyncio.gather(*[self.read(uri, "stations") for uri in uris])
+            return [
+                DwdCdcResult(self.cdc.resolution, category, uri=uri, payload=payload)
+                for uri, payload in zip(uris, payloads)
+            ]
+
+        results = []
+        for category_results in await asyncio.gather(
+            *[get_category_stations(category) for category in categories]
+        ):
+            results += category_results
+        return results
+
+
+class DwdAsync:
+    """
+    Asynchronous variants of ``query``, ``stations`` and ``nearest_station``.
+    """
+
+    def __init__(self, dwd):
+
+        # Client object, providing configuration.
+        self.dwd = dwd
+
+        # Non-blocking HTTP client.
+        self.client = AsyncDwdCdcClient(dwd.cdc)
+
+        # Database thread and its own client object.
+        self.executor = ThreadPoolExecutor(max_workers=1, initializer=self.setup_worker)
+        self.worker = None
+
+    def setup_worker(self):
+        from dwdweather.core import DwdWeather
+
+        dwd = self.dwd
+        self.worker = DwdWeather(
+            resolution=dwd.resolution,
+            category_names=[category["name"] for category in dwd.categories],
+            cache_path=dwd.cache_path,
+            parser=dwd.parser,
+            batch_size=dwd.batch_size,
+            storage_profile=dwd.storage_profile,
+        )
+
+    async def db(self, function, *args):
+        """
+        Call method of the database thread's client object,
+        or given function, in the database thread.
+        """
+        loop = asyncio.get_running_loop()
+
+        def call():
+            if isinstance(function, str):
+                return getattr(self.worker, function)(*args)
+            return function(*args)
+
+        return await loop.run_in_executor(self.executor, call)
+
+    async def close(self):
+        await self.client.close()
+        if self.worker is not None:
+            await self.db(self.worker.db.close)
+        self.executor.shutdown()
+
+    async def query(self, station_id, timestamp, fields=None, quality=True):
+        """
+        Get values from cache, importing them on a cache miss.
+        """
+        category_names, fieldnames = self.dwd.get_projection(fields, quality)
+        value = int(timestamp.strftime(self.dwd.get_timestamp_format()))
+        result = await self.db("get_measurement", station_id, value, fields, quality)
+        if result is None:
+            # Skip categories the station has no data for.
+            categories = await self.db("get_covered_categories", station_id, timestamp)
+            if categories is None:
+                categories = category_names
+            categories = [
+                category_name for category_name in categories if category_name in category_names
+            ]
+            if not categories:
+                return None
+            timeranges = self.dwd.get_timeranges(timestamp)
+            day = int(timestamp.strftime("%Y%m%d"))
+            await self.client.shared(
+                ("import", station_id, day) + tuple(timeranges) + tuple(sorted(categories)),
+                partial(self.import_measures, station_id, timeranges, categories, (day, day)),
+            )
+            result = await self.db("get_measurement", station_id, value, fields, quality)
+        return result
+
+    async def import_measures(self, station_id, timeranges, categories=None, days=None):
+        """
+        Download and import measurements of all categories, or the given
+        category names, concurrently, skipping historical archives not
+        covering the ``(first_day, last_day)`` tuple ``days``.
+        Returns the number of imported rows.
+        """
+        log.info(
+            "Downloading measurements for station %d and timeranges %s" % (station_id, timeranges)
+        )
+        manifest = await self.db("get_manifest")
+        rowcounts = await asyncio.gather(
+            *[
+                self.import_category(station_id, category, timeranges, manifest, days)
+                for category in self.dwd.categories
+                if category["name"] in self.dwd.fields
+                and (categories is None or category["name"] in categories)
+            ]
+        )
+        return sum(rowcounts)
+
+    async def import_category(self, station_id, category, timeranges, manifest, days=None):
+        rowcount = 0
+        for resource in await self.client.get_measurement_resources(
+            station_id, category, timeranges
+        ):
+            if days is not None and not self.dwd.is_archive_covering(resource, *days):
+                log.info('Skipping archive "{}" not covering {}-{}'.format(resource.uri, *days))
+                continue
+
+            entry = manifest.get(resource.uri)
+            if self.dwd.is_archive_unchanged(entry, resource):
+                log.info('Skipping unchanged archive "{}"'.format(resource.uri))
+                continue
+
+            log.info("Fetching resource {}".format(resource.uri))
+            record, archive = await self.client.open(
+                resource.uri, "archive", size=resource.size, modified=resource.modified
+            )
+            with archive:
+                record = dict(record)
+                record.update(uri=resource.uri, category=category["name"], modified=resource.modified)
+
+                # Archive has been imported already, only listing information changed.
+                if entry and entry["content_hash"] == record["content_hash"]:
+                    log.info('Skipping unchanged archive "{}"'.format(resource.uri))
+                    record["rowcount"] = entry["rowcount"]
+                    await self.db(self.update_manifest, record, "complete")
+                    continue
+
+                rowcount += await self.db(self.import_archive, category, record, archive)
+        return rowcount
+
+    def update_manifest(self, record, status):
+        self.worker.update_manifest(record, status=status)
+        self.worker.db.commit()
+
+    def import_archive(self, category, record, fileobj):
+        """
+        Decode and import measurement archive. Runs in the database thread.
+        """
+        worker = self.worker
+        category_name = category["name"]
+        self.update_manifest(record, "started")
+        record["rowcount"] = 0
+        for result in read_archive(worker.resolution, category, record["uri"], fileobj):
+            log.info('Importing "{}" data from "{}"'.format(category_name, result.uri))
+            for batch in chunked(worker.decode_measures(result), worker.batch_size):
+                worker.upsert_measurements(category_name, batch)
+                record["rowcount"] += len(batch)
+        self.update_manifest(record, "complete")
+        return record["rowcount"]
+
+    async def stations(self):
+        """
+        Return list of dicts with all stations, importing them on a cache miss.
+        """
+        stations = await self.db("load_stations")
+        if not stations:
+            await self.client.shared(("stations",), self.import_stations)
+            stations = await self.db("load_stations")
+        return stations
+
+    async def import_stations(self):
+        results = await self.client.get_stations(self.dwd.categories)
+        await self.db("store_stations", results)
+
+    async def nearest_station(self, lon, lat, surrounding=False, timestamp=None):
+        """
+        Select station closest to given location, see ``DwdWeather.nearest_station``.
+        """
+        stations = await self.stations()
+        if timestamp is not None:
+            stations = await self.db("filter_covering_stations", stations, timestamp)
+        return self.dwd.find_nearest_station(stations, lon, lat, surrounding)
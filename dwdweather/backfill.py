@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# (c) 2014 Marian Steinbach, MIT licensed
+# (c) 2018-2019 Andreas Motl, MIT licensed
+import os
+import time
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from queue import Full
+from concurrent.futures import ThreadPoolExecutor
+
+from dwdweather.client import read_archive
+from dwdweather.parser import decode_result
+from dwdweather.util import chunked
+
+"""
+Pipeline for backfilling measurements of many stations at once.
+
+It has three stages:
+
+- Threads in the main process find and download archives into a spool directory.
+- A pool of worker processes decodes the ``produkt_*`` files into row batches.
+- A single writer process upserts the batches into the ``measures_<resolution>_<category>`` tables.
+"""
+
+log = logging.getLogger(__name__)
+
+# Queue of row batches from worker processes to the writer process.
+batch_queue = None
+
+# Event signalling worker processes to stop, when the writer is gone.
+stopping = None
+
+
+def init_worker(queue, event):
+    global batch_queue, stopping
+    batch_queue = queue
+    stopping = event
+
+
+def decode_archive(resolution, category, uri, path, parser, batch_size):
+    """
+    Decode all data files of a downloaded archive and hand the
+    row batches over to the writer process. Runs in a worker process.
+    Returns the number of decoded rows.
+    """
+    rowcount = 0
+    try:
+        if stopping.is_set():
+            return rowcount
+        with open(path, "rb") as fileobj:
+            for result in read_archive(resolution, category, uri, fileobj):
+                rows = decode_result(result, resolution, parser)
+                for batch in chunked(rows, batch_size):
+                    if not put(batch_queue, (category["name"], batch), stopping):
+                        # Do not wait for flushing buffered batches on exit,
+                        # nobody may be reading them any more.
+                        batch_queue.cancel_join_thread()
+                        return rowcount
+                    rowcount += len(batch)
+    finally:
+        os.remove(path)
+    return rowcount
+
+
+def put(queue, item, event):
+    """
+    Put item into the bounded queue, giving up when the event is set.
+    Returns whether the item has been put.
+    """
+    while not event.is_set():
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def write_batches(queue, resolution, cache_path, storage_profile=None, committed=None):
+    """
+    Write row batches to the database until receiving the stop signal.
+    Runs in the writer process. Counts the committed rows in the shared
+    ``committed`` value.
+    """
+    from dwdweather.core import DwdWeather
+
+    dwd = DwdWeather(
+        resolution=resolution, cache_path=cache_path, storage_profile=storage_profile
+    )
+    failed = False
+    with dwd.checkpointing():
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            category_name, batch = item
+            try:
+                dwd.upsert_measurements(category_name, batch)
+                dwd.db.commit()
+                if committed is not None:
+                    with committed.get_lock():
+                        committed.value += len(batch)
+            except Exception:
+                # Keep draining the queue, in order not to block the workers.
+                log.exception('Writing "{}" data failed'.format(category_name))
+                failed = True
+    dwd.db.close()
+    if failed:
+        raise SystemExit(1)
+
+
+class DwdBackfill:
+    """
+    Backfill measurements for many stations, categories and timeranges.
+    """
+
+    def __init__(self, dwd, processes=None):
+
+        # Client object, providing configuration and access to the CDC server.
+        self.dwd = dwd
+
+        # Number of worker processes for decoding data files.
+        self.processes = processes or os.cpu_count() or 1
+
+    def run(self, station_ids, timeranges):
+        """
+        Download, decode and import measurements.
+        Returns the number of imported rows.
+        """
+        dwd = self.dwd
+        tasks = [
+            (station_id, category)
+            for station_id in station_ids
+            for category in dwd.categories
+            if category["name"] in dwd.fields
+        ]
+        log.info(
+            "Backfilling {} stations with {} processes and timeranges {}".format(
+                len(station_ids), self.processes, timeranges
+            )
+        )
+
+        queue = multiprocessing.Queue(maxsize=self.processes * 4)
+        event = multiprocessing.Event()
+        committed = multiprocessing.Value("q", 0)
+        writer = multiprocessing.Process(
+            target=write_batches,
+            args=(queue, dwd.resolution, dwd.cache_path, dwd.storage_profile, committed),
+        )
+        writer.start()
+
+        spool = tempfile.mkdtemp(prefix="dwdweather-backfill-")
+        pool = multiprocessing.Pool(
+            self.processes, initializer=init_worker, initargs=(queue, event)
+        )
+
+        def acquire(task):
+            station_id, category = task
+            jobs = []
+            for uri in dwd.cdc.get_measurement_uris(station_id, category, timeranges):
+                if event.is_set():
+                    break
+                log.info("Fetching resource {}".format(uri))
+                path = os.path.join(spool, os.path.basename(uri))
+                with open(path, "wb") as fileobj:
+                    dwd.cdc.download(uri, fileobj)
+                jobs.append(
+                    pool.apply_async(
+                        decode_archive,
+                        (dwd.resolution, category, uri, path, dwd.parser, dwd.batch_size),
+                    )
+                )
+            return jobs
+
+        def wait(job):
+            # Workers would block forever when the writer is gone.
+            while True:
+                if not writer.is_alive():
+                    raise RuntimeError("Writing measurements to the database failed")
+                try:
+                    return job.get(timeout=1)
+                except multiprocessing.TimeoutError:
+                    pass
+
+        started = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=dwd.workers) as executor:
+                try:
+                    for jobs in executor.map(acquire, tasks):
+                        for job in jobs:
+                            wait(job)
+                except BaseException:
+                    event.set()
+                    raise
+        finally:
+            # Let workers finish instead of terminating them, which could
+            # happen in the middle of a put, leaving the queue locked.
+            event.set()
+            pool.close()
+            pool.join()
+            while writer.is_alive():
+                try:
+                    queue.put(None, timeout=1)
+                    break
+                except Full:
+                    pass
+            writer.join()
+            shutil.rmtree(spool, ignore_errors=True)
+
+        if writer.exitcode != 0:
+            raise RuntimeError("Writing measurements to the database failed")
+
+        rowcount = committed.value
+
+        # Report about import performance.
+        duration = time.time() - started
+        log.info(
+            "Backfilled {} rows in {:.2f} seconds ({:.0f} rows/s)".format(
+                rowcount, duration, rowcount / duration if duration else rowcount
+            )
+        )
+
+        return rowcount
@@ -0,0 +1,790 @@
+# -*- coding: utf-8 -*-
+# (c) 2014 Marian Steinbach, MIT licensed
+# (c) 2018-2019 Andreas Motl, MIT licensed
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from functools import partial
+from collections import Counter
+from zipfile import ZIP_LZMA, ZipFile, ZipInfo, is_zipfile
+
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+from dwdweather.util import DwdCdcResource
+
+"""
+Response cache for resources of the CDC server.
+
+Response bodies are kept in a content-addressed blob store. Blobs are
+files named by the SHA-256 hash of their content and sharded into
+directories, their metadata and the validators of each response are
+stored in an SQLite index. When the blobs exceed the size budget, the
+least recently used ones are evicted.
+
+Downloads are streamed into partial files. When a transfer is interrupted,
+it is resumed using ``Range`` requests, guarded by ``If-Range``, so the
+bytes received so far are not requested again.
+
+Within the expiration time, responses are served from the cache right
+away. Afterwards, they are revalidated using conditional requests with
+``If-None-Match`` and ``If-Modified-Since`` headers, so the body will
+only be transferred again if it has changed on the server.
+
+Directory listings are additionally kept in a persistent index, which
+maps station ids to archives for each folder.
+
+Expiration times are determined by a policy, based on the class
+of a resource, its timerange and resolution.
+"""
+
+log = logging.getLogger(__name__)
+
+
+class TtlPolicy:
+    """
+    Expiration times of cached resources in seconds, by resource class
+    ("listing", "archive" or "stations"), timerange ("now", "recent" or
+    "historical") and resolution.
+
+    Rules are given as dictionary, keys are ``<class>[:<timerange>[:<resolution>]]``,
+    where each part may be ``*``. Values are seconds, or "never" for
+    resources which never expire. Given rules take precedence over the
+    defaults. Among them, the most specific matching rule wins, the
+    resource class being most significant.
+    """
+
+    # Archives of historical data are only updated once a year, recent
+    # data once a day. Stations are described in the "recent" folders.
+    defaults = {
+        "*": 300,
+        "*:now": 120,
+        "listing:recent": 3600,
+        "listing:historical": 86400,
+        "archive:recent": 3600,
+        "archive:historical": "never",
+        "stations": 86400,
+    }
+
+    # Known values of the parts of rule keys, besides "*".
+    resource_classes = ["listing", "archive", "stations"]
+    timeranges = ["now", "recent", "historical"]
+
+    def __init__(self, rules=None):
+        self.rulesets = [
+            {
+                self.parse_key(key): self.parse_value(value)
+                for key, value in ruleset.items()
+            }
+            for ruleset in [rules or {}, self.defaults]
+        ]
+
+    @classmethod
+    def parse_key(cls, key):
+        parts = key.split(":")
+        if len(parts) > 3:
+            raise ValueError('Invalid TTL rule "{}"'.format(key))
+        parts += ["*"] * (3 - len(parts))
+        for part, choices in [(parts[0], cls.resource_classes), (parts[1], cls.timeranges)]:
+            if part != "*" and part not in choices:
+                raise ValueError(
+                    'Invalid TTL rule "{}", "{}" is not one of {}'.format(
+                        key, part, ", ".join(choices)
+                    )
+                )
+        return tuple(parts)
+
+    @staticmethod
+    def parse_value(value):
+        if str(value).lower() in ["never", "inf"]:
+            return float("inf")
+        try:
+            seconds = float(value)
+        except ValueError:
+            raise ValueError('Invalid TTL "{}", use seconds or "never"'.format(value))
+        if seconds < 0 or seconds != seconds:
+            raise ValueError('Invalid TTL "{}", use seconds or "never"'.format(value))
+        return seconds
+
+    def get(self, resource_class, timerange=None, resolution=None):
+        """
+        Return expiration time for resources of given class, timerange and resolution.
+        """
+        for rules in self.rulesets:
+            best = None
+            for (rule_class, rule_timerange, rule_resolution), ttl in rules.items():
+                score = 0
+                for weight, part, value in [
+                    (4, rule_class, resource_class),
+                    (2, rule_timerange, timerange),
+                    (1, rule_resolution, resolution),
+                ]:
+                    if part == value:
+                        score += weight
+                    elif part != "*":
+                        break
+                else:
+                    if best is None or score > best[0]:
+                        best = (score, ttl)
+            if best is not None:
+                return best[1]
+
+
+class HttpCache:
+    """
+    Cache for HTTP responses, revalidating expired entries
+    using conditional requests.
+
+    ``max_size`` is the size budget of the blob store in bytes, ``None``
+    means unlimited. With ``recompress``, ZIP archives are stored with
+    LZMA compression when this makes them smaller. Their members stay
+    the same, but the archives are not byte-identical to the original.
+
+    Interrupted downloads are resumed up to ``retries`` times.
+
+    ``stats`` counts "fresh", "revalidated" and "downloaded" responses,
+    "resumed" downloads,
+    the number of transferred bytes as "bytes_downloaded", the number
+    of bytes served from the cache as "bytes_saved" and the number of
+    evicted blobs as "evicted".
+    """
+
+    def __init__(
+        self,
+        path,
+        session,
+        ttl=300,
+        timeout=30,
+        max_size=None,
+        recompress=False,
+        retries=3,
+    ):
+
+        # Directory holding the index database and blobs.
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+        # HTTP session for requesting resources.
+        self.session = session
+
+        # Expiration time of cached responses in seconds.
+        self.ttl = ttl
+
+        # Timeout for HTTP requests in seconds.
+        self.timeout = timeout
+
+        # Number of attempts for resuming interrupted downloads.
+        self.retries = retries
+
+        # Size budget of the blob store in bytes.
+        self.max_size = max_size
+
+        # Whether to recompress ZIP archives using LZMA.
+        self.recompress = recompress
+
+        # Metrics about cache efficiency.
+        self.stats = Counter()
+
+        # The index is accessed from multiple threads, each
+        # resource is only downloaded by one of them at a time.
+        self.lock = threading.Lock()
+        self.uri_locks = {}
+        self.db = sqlite3.connect(
+            os.path.join(self.path, "index.sqlite"), check_same_thread=False, timeout=30
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses
+            (
+                uri text PRIMARY KEY,
+                etag text,
+                last_modified text,
+                size int,
+                content_hash text,
+                stored_at real
+            )"""
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs
+            (
+                content_hash text PRIMARY KEY,
+                size int,
+                stored_size int,
+                recompressed int,
+                accessed_at real
+            )"""
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS blobs_accessed_idx ON blobs (accessed_at)"
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS partials
+            (
+                uri text PRIMARY KEY,
+                etag text,
+                last_modified text
+            )"""
+        )
+        self.db.commit()
+
+    def get_blob_path(self, content_hash):
+        """
+        Compute path of the blob with given content hash.
+        """
+        return os.path.join(self.path, content_hash[:2], content_hash[2:4], content_hash)
+
+    def lookup(self, uri):
+        """
+        Return index entry for given URI, or ``None`` when not cached.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT etag, last_modified, responses.size, responses.content_hash, stored_at "
+                "FROM responses JOIN blobs USING (content_hash) WHERE uri=?",
+                (uri,),
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, size, content_hash, stored_at = row
+        if not os.path.exists(self.get_blob_path(content_hash)):
+            return None
+        return {
+            "etag": etag,
+            "last_modified": last_modified,
+            "size": size,
+            "content_hash": content_hash,
+            "stored_at": stored_at,
+        }
+
+    def store(self, uri, entry):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (uri, etag, last_modified, size, content_hash, stored_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    uri,
+                    entry["etag"],
+                    entry["last_modified"],
+                    entry["size"],
+                    entry["content_hash"],
+                    entry["stored_at"],
+                ),
+            )
+            self.db.commit()
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def get_partial_path(self, uri):
+        """
+        Compute path of the file receiving the response body of given URI.
+        """
+        key = hashlib.sha256(uri.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "partial", key + ".part")
+
+    def get_uri_lock(self, uri):
+        """
+        Return lock serializing downloads of given URI.
+        """
+        with self.lock:
+            return self.uri_locks.setdefault(uri, threading.Lock())
+
+    def fetch(self, uri, fileobj=None, size=None, ttl=None, chunk_size=65536, modified=None):
+        """
+        Make sure the response body of given URI is in the cache and
+        write it into given binary file object, if any. Responses must
+        have the expected ``size``, if given. ``ttl`` overrides the
+        expiration time of the cache. Cache entries not matching ``size``,
+        or stored before the Unix timestamp ``modified``, e.g. from the
+        directory listing, are revalidated regardless of their age.
+
+        Returns dictionary with "size", "etag", "last_modified"
+        and the SHA-256 "content_hash" of the response body.
+        """
+        with self.get_uri_lock(uri):
+            entry = self.lookup(uri)
+
+            # Serve fresh responses without asking the server.
+            if self.is_fresh(entry, ttl) and self.is_current(entry, size, modified):
+                self.count("fresh")
+                self.count("bytes_saved", entry["size"])
+                return self.serve(entry, fileobj)
+
+            record = self.transfer_resuming(uri, entry, chunk_size)
+
+            # Server confirmed a cache entry not matching the listing, request it unconditionally.
+            if entry is not None and not self.has_size(record, size):
+                log.warning("Revalidated {} does not match its listing, downloading again".format(uri))
+                record = self.transfer_resuming(uri, None, chunk_size)
+
+            self.check_size(uri, record, size)
+            return self.serve(record, fileobj)
+
+    def transfer_resuming(self, uri, entry, chunk_size=65536):
+        """
+        Transfer resource, resuming interrupted downloads up to
+        ``retries`` times.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.transfer(uri, entry, chunk_size)
+            except (ChunkedEncodingError, ConnectionError, Timeout) as ex:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                log.warning("Download of {} interrupted, resuming: {}".format(uri, ex))
+
+    def transfer(self, uri, entry, chunk_size=65536):
+        """
+        Request resource and stream its body into the partial file.
+        When the partial file holds the beginning of the current
+        representation, only the remaining part is requested.
+        """
+        headers, partial_path, offset = self.prepare_transfer(uri, entry)
+
+        with self.session.get(uri, headers=headers, stream=True, timeout=self.timeout) as response:
+
+            # Resource has not changed, refresh cache entry.
+            if entry and response.status_code == 304:
+                self.revalidated(uri, entry, response.headers)
+                return self.result(entry)
+
+            # Partial file does not match the resource anymore.
+            if response.status_code == 416:
+                os.remove(partial_path)
+                return self.transfer(uri, entry, chunk_size)
+
+            response.raise_for_status()
+
+            content_hash, received, mode = self.open_partial(
+                uri, partial_path, offset, response.status_code, response.headers
+            )
+            with open(partial_path, mode) as body:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    body.write(chunk)
+                    content_hash.update(chunk)
+                    received += len(chunk)
+                    self.count("bytes_downloaded", len(chunk))
+
+        return self.complete_transfer(uri, response.headers, partial_path, received, content_hash)
+
+    def prepare_transfer(self, uri, entry):
+        """
+        Compute request headers for downloading given URI: conditional
+        headers for revalidating the cache entry, and a range request
+        for the remaining part of the partial file, if any.
+        Returns ``(headers, partial_path, offset)``.
+        """
+        headers = self.get_conditional_headers(entry)
+
+        partial_path = self.get_partial_path(uri)
+        os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        with self.lock:
+            validator = self.db.execute(
+                "SELECT etag, last_modified FROM partials WHERE uri=?", (uri,)
+            ).fetchone()
+        if validator:
+            etag, last_modified = validator
+            validator = etag if etag and not etag.startswith("W/") else last_modified
+        if offset and validator:
+            headers["Range"] = "bytes={}-".format(offset)
+            headers["If-Range"] = validator
+        return headers, partial_path, offset
+
+    def open_partial(self, uri, partial_path, offset, status, headers, chunk_size=65536):
+        """
+        Continue partial file when the response holds the remaining part,
+        or start from scratch. Records the validator of the response for
+        resuming it later. Returns ``(content_hash, received, mode)``,
+        with the hash object and size of the body received so far, and
+        the mode for opening the partial file.
+        """
+        content_hash = hashlib.sha256()
+        content_range = headers.get("Content-Range", "")
+        if status == 206 and content_range.startswith("bytes {}-".format(offset)):
+            self.count("resumed")
+            log.info("Resuming download of {} at {} bytes".format(uri, offset))
+            with open(partial_path, "rb") as body:
+                for chunk in iter(partial(body.read, chunk_size), b""):
+                    content_hash.update(chunk)
+            mode = "ab"
+        else:
+            if status != 200:
+                raise IOError("Unexpected response with status {} for {}".format(status, uri))
+            offset = 0
+            mode = "wb"
+
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO partials (uri, etag, last_modified) VALUES (?, ?, ?)",
+                (uri, headers.get("ETag"), headers.get("Last-Modified")),
+            )
+            self.db.commit()
+        return content_hash, offset, mode
+
+    def complete_transfer(self, uri, headers, partial_path, received, content_hash):
+        """
+        Add completely received partial file to the cache.
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM partials WHERE uri=?", (uri,))
+            self.db.commit()
+
+        return self.add_response(uri, headers, partial_path, received, content_hash.hexdigest())
+
+    def is_fresh(self, entry, ttl=None):
+        """
+        Whether a cache entry can be used without asking the server.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        return entry is not None and time.time() - entry["stored_at"] < ttl
+
+    def is_current(self, entry, size=None, modified=None):
+        """
+        Whether a cache entry matches the ``size`` and the Unix timestamp
+        ``modified`` of the resource, e.g. from the directory listing.
+        """
+        return (
+            entry is not None
+            and self.has_size(entry, size)
+            and (modified is None or modified <= entry["stored_at"])
+        )
+
+    def has_size(self, entry, size=None):
+        return size is None or entry["size"] == size
+
+    def check_size(self, uri, entry, size=None):
+        """
+        Compare size of a response body with the expected one.
+        Mismatching responses are removed from the cache.
+        """
+        if not self.has_size(entry, size):
+            self.forget(uri)
+            raise IOError(
+                "Received {} bytes from {}, but expected {} bytes".format(entry["size"], uri, size)
+            )
+
+    def forget(self, uri):
+        """
+        Remove cache entry of given URI. Its blob is kept until evicted.
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM responses WHERE uri=?", (uri,))
+            self.db.commit()
+
+    def get_conditional_headers(self, entry):
+        """
+        Compute headers for revalidating a cache entry.
+        """
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def revalidated(self, uri, entry, headers):
+        """
+        Refresh cache entry after the server responded with "304 Not Modified".
+        """
+        entry["etag"] = headers.get("ETag", entry["etag"])
+        entry["last_modified"] = headers.get("Last-Modified", entry["last_modified"])
+        entry["stored_at"] = time.time()
+        self.store(uri, entry)
+        self.count("revalidated")
+        self.count("bytes_saved", entry["size"])
+        log.info("Revalidated {}, saved {} bytes".format(uri, entry["size"]))
+
+    def add_response(self, uri, headers, path, size, content_hash):
+        """
+        Add downloaded response body from given file to the cache.
+        """
+        entry = {
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "size": size,
+            "content_hash": content_hash,
+            "stored_at": time.time(),
+        }
+        self.add_blob(content_hash, path, size)
+        self.store(uri, entry)
+        self.count("downloaded")
+        return self.result(entry)
+
+    def open(self, uri, size=None, ttl=None, modified=None):
+        """
+        Make sure the response body of given URI is in the cache and open
+        its blob for reading. Returns ``(record, fileobj)`` tuple, where
+        ``record`` is the return value of ``fetch``.
+        """
+        for attempt in range(3):
+            record = self.fetch(uri, size=size, ttl=ttl, modified=modified)
+            try:
+                return record, open(self.get_blob_path(record["content_hash"]), "rb")
+            except FileNotFoundError:
+                # Blob has been evicted in the meantime.
+                log.warning("Blob for {} has been evicted, fetching again".format(uri))
+        raise IOError("Could not acquire {}".format(uri))
+
+    def serve(self, entry, fileobj=None):
+        """
+        Copy cached response body into file object, if any.
+        """
+        if fileobj is not None:
+            with open(self.get_blob_path(entry["content_hash"]), "rb") as body:
+                shutil.copyfileobj(body, fileobj)
+        self.touch(entry["content_hash"])
+        return self.result(entry)
+
+    def touch(self, content_hash):
+        """
+        Record access to a blob, for evicting least recently used blobs first.
+        """
+        with self.lock:
+            self.db.execute(
+                "UPDATE blobs SET accessed_at=? WHERE content_hash=?",
+                (time.time(), content_hash),
+            )
+            self.db.commit()
+
+    def result(self, entry):
+        return {
+            "size": entry["size"],
+            "etag": entry["etag"],
+            "last_modified": entry["last_modified"],
+            "content_hash": entry["content_hash"],
+        }
+
+    def add_blob(self, content_hash, path, size):
+        """
+        Move downloaded file into the blob store and evict
+        least recently used blobs when exceeding the size budget.
+        """
+        blob_path = self.get_blob_path(content_hash)
+        if os.path.exists(blob_path):
+            os.remove(path)
+            self.touch(content_hash)
+            return
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        recompressed = False
+        if self.recompress and is_zipfile(path):
+            recompressed = recompress_zip(path)
+        stored_size = os.path.getsize(path)
+        os.replace(path, blob_path)
+
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO blobs (content_hash, size, stored_size, recompressed, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (content_hash, size, stored_size, int(recompressed), time.time()),
+            )
+            self.db.commit()
+        self.evict(keep=content_hash)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used blobs and their responses,
+        until the blob store fits into the size budget.
+        """
+        if self.max_size is None:
+            return
+        with self.lock:
+            total = self.db.execute("SELECT SUM(stored_size) FROM blobs").fetchone()[0] or 0
+            if total <= self.max_size:
+                return
+            evicted = []
+            for content_hash, stored_size in self.db.execute(
+                "SELECT content_hash, stored_size FROM blobs WHERE content_hash != ? ORDER BY accessed_at",
+                (keep,),
+            ).fetchall():
+                if total <= self.max_size:
+                    break
+                evicted.append((content_hash,))
+                total -= stored_size
+            self.db.executemany("DELETE FROM blobs WHERE content_hash=?", evicted)
+            self.db.executemany("DELETE FROM responses WHERE content_hash=?", evicted)
+            self.db.commit()
+            self.stats["evicted"] += len(evicted)
+        for (content_hash,) in evicted:
+            try:
+                os.remove(self.get_blob_path(content_hash))
+            except FileNotFoundError:
+                pass
+        log.info("Evicted {} blobs from the cache".format(len(evicted)))
+
+    def close(self):
+        self.db.close()
+
+
+def recompress_zip(path):
+    """
+    Rewrite members of a ZIP archive using LZMA compression. The archive
+    is only replaced when it gets smaller. Returns whether it was replaced.
+    """
+    target = path + ".lzma"
+    try:
+        with ZipFile(path) as source, ZipFile(target, "w") as recompressed:
+            for info in source.infolist():
+                member = ZipInfo(info.filename, date_time=info.date_time)
+                member.compress_type = ZIP_LZMA
+                member.external_attr = info.external_attr
+                with source.open(info) as reader, recompressed.open(member, "w", force_zip64=True) as writer:
+                    shutil.copyfileobj(reader, writer)
+        if os.path.getsize(target) < os.path.getsize(path):
+            os.replace(target, path)
+            return True
+    finally:
+        if os.path.exists(target):
+            os.remove(target)
+    return False
+
+
+class ListingIndex:
+    """
+    Persistent index of directory listings, mapping station ids to
+    the archives within a folder of the CDC server.
+
+    Listings are stored per ``(resolution, category, timerange)`` folder
+    and refreshed after ``ttl`` seconds, unless given for each lookup.
+    Lookups are served from memory.
+    """
+
+    def __init__(self, path, ttl=3600):
+
+        # Expiration time of listings in seconds.
+        self.ttl = ttl
+
+        # Listings by folder key, mapping station ids to lists of resources.
+        self.folders = {}
+
+        # Serialize refreshing each folder, without blocking the others.
+        self.lock = threading.Lock()
+        self.folder_locks = {}
+
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(
+            os.path.join(path, "listings.sqlite"), check_same_thread=False, timeout=30
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS folders
+            (
+                resolution text,
+                category text,
+                timerange text,
+                refreshed_at real,
+                PRIMARY KEY (resolution, category, timerange)
+            )"""
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS archives
+            (
+                resolution text,
+                category text,
+                timerange text,
+                station_id int,
+                uri text,
+                modified int,
+                size int,
+                date_from int,
+                date_to int
+            )"""
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS archives_folder_idx ON archives (resolution, category, timerange)"
+        )
+        self.db.commit()
+
+    def get(self, key, refresh, ttl=None):
+        """
+        Return listing of the folder identified by ``key``, which is a
+        ``(resolution, category, timerange)`` tuple, as dictionary mapping
+        station ids to lists of resources.
+
+        Expired listings are replaced by calling ``refresh()``, which
+        returns an iterable of ``(station_id, resource)`` tuples.
+        """
+        with self.lock:
+            folder_lock = self.folder_locks.setdefault(key, threading.Lock())
+
+        with folder_lock:
+            listing = self.lookup(key, ttl)
+            if listing is None:
+                listing = self.update(key, refresh())
+            return listing
+
+    def lookup(self, key, ttl=None):
+        """
+        Return listing of a folder, or ``None`` when it has expired.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        listing, refreshed_at = self.folders.get(key) or self.load(key)
+        if time.time() - refreshed_at >= ttl:
+            return None
+        self.folders[key] = (listing, refreshed_at)
+        return listing
+
+    def update(self, key, items):
+        """
+        Replace listing of a folder by given ``(station_id, resource)`` tuples.
+        """
+        listing = {}
+        for station_id, resource in items:
+            listing.setdefault(station_id, []).append(resource)
+        refreshed_at = time.time()
+        self.save(key, listing, refreshed_at)
+        self.folders[key] = (listing, refreshed_at)
+        return listing
+
+    def load(self, key):
+        """
+        Load listing of a folder from the database.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT refreshed_at FROM folders WHERE resolution=? AND category=? AND timerange=?",
+                key,
+            ).fetchone()
+            if row is None:
+                return {}, 0
+            listing = {}
+            for station_id, uri, modified, size, date_from, date_to in self.db.execute(
+                "SELECT station_id, uri, modified, size, date_from, date_to FROM archives WHERE resolution=? AND category=? AND timerange=? ORDER BY rowid",
+                key,
+            ):
+                listing.setdefault(station_id, []).append(
+                    DwdCdcResource(uri, modified, size, date_from, date_to)
+                )
+        return listing, row[0]
+
+    def save(self, key, listing, refreshed_at):
+        """
+        Replace listing of a folder in the database.
+        """
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM archives WHERE resolution=? AND category=? AND timerange=?", key
+            )
+            self.db.executemany(
+                "INSERT INTO archives (resolution, category, timerange, station_id, uri, modified, size, date_from, date_to) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    key + (station_id,) + tuple(resource)
+                    for station_id, resources in listing.items()
+                    for resource in resources
+                ],
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO folders (resolution, category, timerange, refreshed_at) VALUES (?, ?, ?, ?)",
+                key + (refreshed_at,),
+            )
+            self.db.commit()
@@ -3,16 +3,22 @@
 # (c) 2018-2019 Andreas Motl, MIT licensed
 import io
 import os
+import re
 import logging
+import threading
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from zipfile import ZipFile
 
-from requests import HTTPError
-from requests_cache import CachedSession
+from requests import HTTPError, Session
+from requests.adapters import HTTPAdapter
 
 from dwdweather import __appname__ as APP_NAME
 from dwdweather import __version__ as APP_VERSION
-from dwdweather.util import fetch_html_file_list
+from dwdweather.cache import HttpCache, ListingIndex, TtlPolicy
+from dwdweather.util import DwdCdcResource, parse_html_file_list
 
 log = logging.getLogger(__name__)
 
@@ -25,19 +31,43 @@ class DwdCdcClient:
     # Observations in Germany.
     germany_climate_uri = baseuri + "/observations_germany/climate/{resolution}"
 
-    def __init__(self, resolution, cache_path):
+    def __init__(
+        self,
+        resolution,
+        cache_path,
+        max_connections=4,
+        pool_size=None,
+        cache_size=None,
+        recompress=False,
+        ttl=None,
+    ):
 
         # Data set selector by resolution (daily, hourly, 10_minutes).
         self.resolution = resolution
 
-        # HTTP client.
+        # HTTP client, response cache and index of directory listings.
         self.http = None
+        self.cache = None
+        self.listings = None
 
-        # Path where response cache sqlite database is stores.
+        # Limit number of concurrent requests to the CDC server.
+        self.max_connections = max_connections
+        self.throttle = threading.BoundedSemaphore(max_connections)
+
+        # Number of keep-alive connections to the CDC server.
+        self.pool_size = pool_size or max_connections
+
+        # Path where response cache is stored.
         self.cache_path = cache_path
 
-        # Expiration time of response cache.
-        self.cache_ttl = 300
+        # Expiration times of cached resources, see ``TtlPolicy``.
+        # Expired responses will be revalidated with the server.
+        self.ttl_policy = TtlPolicy(ttl)
+
+        # Size budget of the response cache in bytes, ``None`` means
+        # unlimited, and whether to recompress archives using LZMA.
+        self.cache_size = cache_size
+        self.recompress = recompress
 
         # CDC server URI.
         self.uri = self.germany_climate_uri.format(resolution=self.resolution)
@@ -55,21 +85,60 @@ class DwdCdcClient:
         # Configure User-Agent string.
         user_agent = APP_NAME + "/" + APP_VERSION
 
-        # Use hostname of url as cache prefix.
+        # Use hostname of url as name of the cache directory.
         cache_name = urlparse(self.uri).netloc
 
-        # Configure cached requests session.
-        self.http = CachedSession(
-            backend="sqlite",
-            cache_name=os.path.join(self.cache_path, cache_name),
-            expire_after=self.cache_ttl,
-            user_agent=user_agent,
+        # Configure requests session and response cache. All requests go
+        # through a single pool of keep-alive connections.
+        self.http = Session()
+        self.http.headers["User-Agent"] = user_agent
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        cache_directory = os.path.join(self.cache_path, "http", cache_name)
+        self.cache = HttpCache(
+            cache_directory,
+            self.http,
+            ttl=self.ttl_policy.get("*"),
+            max_size=self.cache_size,
+            recompress=self.recompress,
+        )
+        self.listings = ListingIndex(cache_directory, ttl=self.ttl_policy.get("listing"))
+
+    def get_ttl(self, resource_class, uri):
+        """
+        Compute expiration time of a resource by its class and the
+        timerange, as found within its URI.
+        """
+        timerange = None
+        for part in uri[len(self.uri):].split("/"):
+            if part in ["now", "recent", "historical"]:
+                timerange = part
+        return self.ttl_policy.get(resource_class, timerange, self.resolution)
+
+    def log_cache_stats(self):
+        """
+        Report about efficiency of the response cache.
+        """
+        stats = self.cache.stats
+        log.info(
+            "HTTP cache: {} fresh, {} revalidated, {} downloaded responses, "
+            "{} bytes downloaded, {} bytes saved".format(
+                stats["fresh"],
+                stats["revalidated"],
+                stats["downloaded"],
+                stats["bytes_downloaded"],
+                stats["bytes_saved"],
+            )
         )
 
     def get_resource_index(self, uri, extension):
         log.info(u'Requesting %s', uri)
         try:
-            resource_list = fetch_html_file_list(uri, extension)
+            html = self.fetch(uri, "listing")
+            resource_list = [
+                DwdCdcResource(*item) for item in parse_html_file_list(uri, html, extension)
+            ]
         except HTTPError as ex:
             if ex.response.status_code == 404:
                 #log.warning('Resource {} not found'.format(uri))
@@ -78,20 +147,60 @@ class DwdCdcClient:
                 raise
         return resource_list
 
+    def download(self, uri, fileobj, size=None, resource_class="archive", modified=None):
+        """
+        Download resource through the response cache into given
+        binary file object, which will be rewound afterwards.
+        Interrupted downloads are resumed, the downloaded resource
+        must have the expected ``size``, if given. The expiration time
+        is determined by ``resource_class``, see ``TtlPolicy``, cached
+        resources not matching ``size`` or stored before ``modified``
+        are revalidated anyway.
+
+        Returns dictionary with "size", "etag", "last_modified"
+        and the SHA-256 "content_hash" of the resource.
+        """
+        with self.throttle:
+            record = self.cache.fetch(
+                uri, fileobj, size=size, ttl=self.get_ttl(resource_class, uri), modified=modified
+            )
+        fileobj.seek(0)
+        return record
+
+    @contextmanager
+    def open_download(self, uri, size=None, resource_class="archive", modified=None):
+        """
+        Download resource through the response cache and open the cached
+        file for reading, without copying it. Yields ``(record, fileobj)``
+        tuple, where ``record`` is the return value of ``download``.
+        """
+        with self.throttle:
+            record, fileobj = self.cache.open(
+                uri, size=size, ttl=self.get_ttl(resource_class, uri), modified=modified
+            )
+        with fileobj:
+            yield record, fileobj
+
+    def fetch(self, uri, resource_class):
+        """
+        Download resource through the response cache and return its content.
+        """
+        buffer = io.BytesIO()
+        self.download(uri, buffer, resource_class=resource_class)
+        return buffer.getvalue()
+
     def get_stations(self, categories):
         """
         Load station meta data from DWD server.
+
+        The station lists of all categories are fetched concurrently,
+        using up to ``max_connections`` threads.
         """
         log.info("Loading station data from CDC")
-        for category in categories:
-            category_name = category["name"]
-            category_folder = category.get("folder", category_name)
 
-            if category_name == "solar" and self.resolution in ["daily", "hourly"]:
-                # workaround - solar has no subdirs
-                index_uri = u"%s/%s" % (self.uri, category_folder)
-            else:
-                index_uri = u"%s/%s/recent" % (self.uri, category_folder)
+        def acquire(category):
+            category_name = category["name"]
+            index_uri = self.get_stations_index_uri(category)
 
             try:
                 resource_list = self.get_resource_index(index_uri, "txt")
@@ -101,91 +210,222 @@ class DwdCdcClient:
                         self.resolution, category_name
                     )
                 )
-                continue
+                return []
 
             # Get directory contents.
-            for resource_uri in resource_list:
+            results = []
+            for resource in resource_list:
+                resource_uri = resource.uri
                 if "Beschreibung_Stationen" not in resource_uri:
                     continue
                 log.info("Fetching resource {}".format(resource_uri))
-                response = self.http.get(resource_uri)
-                yield DwdCdcResult(self.resolution, category, response=response)
+                payload = self.fetch(resource_uri, "stations")
+                results.append(
+                    DwdCdcResult(self.resolution, category, uri=resource_uri, payload=payload)
+                )
+            return results
 
-    def get_measurements(self, station_id, category, timeranges):
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            for results in executor.map(acquire, categories):
+                for result in results:
+                    yield result
 
+    def get_stations_index_uri(self, category):
+        """
+        Compute URI of the folder holding the station list for given category.
+        """
         category_name = category["name"]
         category_folder = category.get("folder", category_name)
+        if category_name == "solar" and self.resolution in ["daily", "hourly"]:
+            # workaround - solar has no subdirs
+            return u"%s/%s" % (self.uri, category_folder)
+        else:
+            return u"%s/%s/recent" % (self.uri, category_folder)
+
+    def get_index_uri(self, category, timerange):
+        """
+        Compute URI of the folder holding the measurement archives
+        for given category and timerange.
+        """
+        category_name = category["name"]
+        category_folder = category.get("folder", category_name)
+        if category_name == "solar" and self.resolution in ["daily", "hourly"]:
+            # workaround - solar has no subdirs
+            return "%s/%s" % (self.uri, category_name)
+        else:
+            return "%s/%s/%s" % (self.uri, category_folder, timerange)
+
+    def get_listing(self, category, timerange):
+        """
+        Return listing of the folder holding the measurement archives for
+        given category and timerange, as dictionary mapping station ids
+        to lists of ``DwdCdcResource`` items. Listings are served from
+        the persistent listing index.
+        """
+        index_uri = self.get_index_uri(category, timerange)
+
+        def refresh():
+            return index_archives(self.get_resource_index(index_uri, "zip"))
+
+        ttl = self.ttl_policy.get("listing", timerange, self.resolution)
+        return self.listings.get(self.get_listing_key(category, timerange), refresh, ttl=ttl)
+
+    def get_listing_key(self, category, timerange):
+        return self.resolution, category["name"], timerange
+
+    def get_archive_index(self, category, timerange):
+        """
+        List all measurement archives for given category and timerange.
+        Returns list of ``(station_id, resource)`` tuples, with
+        ``DwdCdcResource`` items.
+        """
+        return [
+            (station_id, resource)
+            for station_id, resources in self.get_listing(category, timerange).items()
+            for resource in resources
+        ]
+
+    def get_measurement_uris(self, station_id, category, timeranges):
+        """
+        Find URIs of measurement archives for given station, category and timeranges.
+        """
+        for resource in self.get_measurement_resources(station_id, category, timeranges):
+            yield resource.uri
+
+    def get_measurement_resources(self, station_id, category, timeranges):
+        """
+        Find measurement archives for given station, category and timeranges.
+        Yields ``DwdCdcResource`` items.
+        """
+
+        category_name = category["name"]
+
+        index_uris = []
+        for timerange in timeranges:
+            index_uri = self.get_index_uri(category, timerange)
+            if index_uri in index_uris:
+                continue
+            index_uris.append(index_uri)
 
-        def download_zip(uri):
-            log.info("Fetching resource {}".format(uri))
-            response = self.http.get(uri)
-            with ZipFile(io.BytesIO(response.content)) as myzip:
-                for f in myzip.infolist():
-                    # This is the data file
-                    # print('zip content:', f.filename)
-                    if f.filename.startswith("produkt_"):
-                        log.info("Reading from Zip: %s" % (f.filename))
-                        payload = myzip.read(f.filename)
-                        real_uri = "{}/{}".format(uri, f.filename)
-                        thing = DwdCdcResult(
-                            self.resolution, category, uri=real_uri, payload=payload
-                        )
-                        yield thing
-
-        def find_resource_file(index_uri, pattern):
             try:
-                resource_list = self.get_resource_index(index_uri, "zip")
+                listing = self.get_listing(category, timerange)
             except:
                 log.exception('Could not acquire resource from {}'.format(index_uri))
-                return
-
-            # Get directory contents.
-            for resource_uri in resource_list:
-                if pattern in resource_uri:
-                    return resource_uri
+                continue
 
-        def download_resource(uri):
-            if resource_uri_effective is None:
+            resources = listing.get(station_id)
+            if not resources:
                 log.warning(
                     'Station "{}" has no data for category "{}"'.format(
                         station_id, category_name
                     )
                 )
-            else:
-                for thing in download_zip(uri):
+                continue
+            for resource in resources:
+                yield resource
+
+    def read_archive(self, category, uri, fileobj):
+        """
+        Yield results for all data files within a measurement archive.
+        """
+        return read_archive(self.resolution, category, uri, fileobj)
+
+    def get_measurements(self, station_id, category, timeranges):
+
+        def download_zip(resource):
+            log.info("Fetching resource {}".format(resource.uri))
+            with self.open_download(
+                resource.uri, size=resource.size, modified=resource.modified
+            ) as (record, fileobj):
+                for thing in self.read_archive(category, resource.uri, fileobj):
                     yield thing
 
-        if category_name == "solar" and self.resolution in ["daily", "hourly"]:
-            index_uri = "%s/%s" % (self.uri, category_name)
-            resource_uri_effective = find_resource_file(
-                index_uri, "_%05d_" % station_id
-            )
-            for item in download_resource(resource_uri_effective):
+        for resource in self.get_measurement_resources(station_id, category, timeranges):
+            for item in download_zip(resource):
                 yield item
 
-        else:
-            for timerange in timeranges:
-                timerange_suffix = "akt"
-                if timerange == "historical":
-                    timerange_suffix = "hist"
-
-                index_uri = "%s/%s/%s" % (self.uri, category_folder, timerange)
-                resource_uri_effective = find_resource_file(
-                    index_uri, "_%05d_" % station_id
+
+def index_archives(resources):
+    """
+    Yield ``(station_id, resource)`` tuples for measurement archives
+    within a directory listing. The time span covered by historical
+    archives is added to their resources.
+    """
+    for resource in resources:
+        filename = os.path.basename(resource.uri)
+        match = re.search(r"_(\d{5})_", filename)
+        if not match:
+            continue
+        dates = re.search(r"_(\d{8})_(\d{8})_hist", filename)
+        if dates:
+            resource = resource._replace(
+                date_from=int(dates.group(1)), date_to=int(dates.group(2))
+            )
+        yield int(match.group(1)), resource
+
+
+def read_archive(resolution, category, uri, fileobj):
+    """
+    Yield results for all data files within a measurement archive.
+    The results are valid until the next item is requested.
+    """
+    with ZipFile(fileobj) as myzip:
+        for f in myzip.infolist():
+            # This is the data file
+            # print('zip content:', f.filename)
+            if f.filename.startswith("produkt_"):
+                log.info("Reading from Zip: %s" % (f.filename))
+                real_uri = "{}/{}".format(uri, f.filename)
+                thing = DwdCdcResult(
+                    resolution, category, uri=real_uri, opener=partial(myzip.open, f)
                 )
-                for item in download_resource(resource_uri_effective):
-                    yield item
+                yield thing
 
 
 class DwdCdcResult:
-    def __init__(self, resolution, category, uri=None, payload=None, response=None):
+    """
+    Container for the payload of a resource acquired from the CDC server.
+
+    When an ``opener`` function is given, the payload is read from the
+    binary file object it returns, e.g. a member of a ZIP archive.
+    Results from ``get_measurements`` are only valid until the next
+    item is requested from the generator.
+    """
+
+    def __init__(
+        self, resolution, category, uri=None, payload=None, response=None, opener=None
+    ):
         self.resolution = resolution
         self.category = category
 
         self.uri = uri
-        self.payload = payload
+        self.opener = opener
+        self._payload = payload
 
         self.response = response
         if self.response:
             self.uri = self.response.url
-            self.payload = self.response.content
+            self._payload = self.response.content
+
+    @property
+    def payload(self):
+        if self._payload is None and self.opener is not None:
+            with self.open() as fileobj:
+                self._payload = fileobj.read()
+        return self._payload
+
+    def open(self):
+        """
+        Return binary file object for reading the payload.
+        """
+        if self._payload is None and self.opener is not None:
+            return self.opener()
+        return io.BytesIO(self._payload)
+
+    def iter_lines(self, encoding="latin-1"):
+        """
+        Decode payload incrementally and yield it line by line.
+        """
+        with io.TextIOWrapper(self.open(), encoding=encoding) as textfile:
+            for line in textfile:
+                yield line
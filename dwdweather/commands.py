@@ -7,13 +7,30 @@ import logging
 import argparse
 
 from dateutil.parser import parse as parsedate
+from dwdweather.cache import TtlPolicy
 from dwdweather.core import DwdWeather
 from dwdweather.knowledge import DwdCdcKnowledge
+from dwdweather.storage import STORAGE_PROFILES
 from dwdweather.util import float_range, setup_logging
 
 log = logging.getLogger(__name__)
 
 
+def parse_ttl_rule(value):
+    """
+    Parse "RULE=SECONDS" command line argument into a tuple,
+    validating rule and seconds like ``TtlPolicy``.
+    """
+    rule, separator, ttl = value.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError('Invalid TTL rule "{}"'.format(value))
+    try:
+        TtlPolicy.parse_key(rule)
+        return rule, TtlPolicy.parse_value(ttl)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+
 def run():
     def get_station(args):
         dwd = DwdWeather(
@@ -21,8 +38,13 @@ def run():
             category_names=args.categories,
             cache_path=args.cache_path,
             reset_cache=args.reset_cache,
+            cache_size=args.cache_size,
+            recompress=args.recompress,
+            ttl=args.ttl,
+            storage_profile=args.storage_profile,
         )
-        output = json.dumps(dwd.nearest_station(lon=args.lon, lat=args.lat), indent=4)
+        station = dwd.nearest_station(lon=args.lon, lat=args.lat, timestamp=args.timestamp)
+        output = json.dumps(station, indent=4)
         print(output)
 
     def get_stations(args):
@@ -31,6 +53,10 @@ def run():
             category_names=args.categories,
             cache_path=args.cache_path,
             reset_cache=args.reset_cache,
+            cache_size=args.cache_size,
+            recompress=args.recompress,
+            ttl=args.ttl,
+            storage_profile=args.storage_profile,
         )
         output = ""
         if args.type == "geojson":
@@ -54,6 +80,13 @@ def run():
             category_names=args.categories,
             cache_path=args.cache_path,
             reset_cache=args.reset_cache,
+            cache_size=args.cache_size,
+            recompress=args.recompress,
+            ttl=args.ttl,
+            storage_profile=args.storage_profile,
+            workers=args.workers,
+            max_connections=args.max_connections,
+            pool_size=args.pool_size,
         )
 
         # Sanitize some input values
@@ -67,9 +100,77 @@ def run():
                 **locals()
             )
         )
-        results = dwd.query(station_id, timestamp)
+        quality = not args.no_quality
+        try:
+            if args.end is None:
+                results = dwd.query(station_id, timestamp, fields=args.fields, quality=quality)
+            else:
+                results = list(
+                    dwd.query_range(
+                        station_id,
+                        timestamp,
+                        parsedate(args.end),
+                        fields=args.fields,
+                        quality=quality,
+                    )
+                )
+        except ValueError as ex:
+            argparser.error(str(ex))
         print(json.dumps(results, indent=4, sort_keys=True))
 
+    def run_backfill(args):
+
+        # Workhorse
+        dwd = DwdWeather(
+            resolution=args.resolution,
+            category_names=args.categories,
+            cache_path=args.cache_path,
+            reset_cache=args.reset_cache,
+            cache_size=args.cache_size,
+            recompress=args.recompress,
+            ttl=args.ttl,
+            storage_profile=args.storage_profile or "bulk-load",
+            workers=args.workers,
+            max_connections=args.max_connections,
+            pool_size=args.pool_size,
+        )
+
+        log.info(
+            'Backfilling data for stations "{}" and categories "{}"'.format(
+                args.station_ids, args.categories
+            )
+        )
+        rowcount = dwd.backfill(
+            args.station_ids, timeranges=args.timeranges, processes=args.processes
+        )
+        print(json.dumps({"rowcount": rowcount}, indent=4))
+
+    def run_mirror(args):
+
+        # Workhorse
+        dwd = DwdWeather(
+            resolution=args.resolution,
+            category_names=args.categories,
+            cache_path=args.cache_path,
+            reset_cache=args.reset_cache,
+            cache_size=args.cache_size,
+            recompress=args.recompress,
+            ttl=args.ttl,
+            storage_profile=args.storage_profile or "bulk-load",
+            workers=args.workers,
+            max_connections=args.max_connections,
+            pool_size=args.pool_size,
+        )
+
+        log.info('Mirroring data for categories "{}"'.format(args.categories))
+        rowcount = dwd.mirror(
+            timeranges=args.timeranges,
+            station_ids=args.station_ids,
+            bbox=args.bbox,
+            resume=not args.restart,
+        )
+        print(json.dumps({"rowcount": rowcount}, indent=4))
+
     argparser = argparse.ArgumentParser(
         prog="dwdweather", description="Get weather information for Germany."
     )
@@ -90,6 +191,11 @@ def run():
         type=float_range(-90, 90),
         help="Geographic latitude (y) component as float, e.g. 53.9",
     )
+    parser_station.add_argument(
+        "--timestamp",
+        type=parsedate,
+        help="Only consider stations having data at this time, e.g. 2019-06-01T15:00",
+    )
 
     # 2. "stations" options
     parser_stations = subparsers.add_parser("stations", help="List or export stations")
@@ -112,7 +218,7 @@ def run():
 
     # 3. "weather" options
     parser_weather = subparsers.add_parser(
-        "weather", help="Get weather data for a station and hour"
+        "weather", help="Get weather data for a station and hour or time range"
     )
     parser_weather.set_defaults(func=get_weather)
     parser_weather.add_argument(
@@ -123,10 +229,104 @@ def run():
         type=str,
         help="Timestamp in the format of YYYY-MM-DDTHH or YYYY-MM-DDTHH:MM",
     )
+    parser_weather.add_argument(
+        "end",
+        type=str,
+        nargs="?",
+        help="End of time range, when querying all data from timestamp until this one",
+    )
+    parser_weather.add_argument(
+        "--fields",
+        type=str,
+        nargs="+",
+        help="List of fields to output, e.g. air_temperature_200 relative_humidity_200. "
+        "By default, all fields of the selected categories will be output.",
+    )
+    parser_weather.add_argument(
+        "--no-quality",
+        action="store_true",
+        help="Omit *_quality_level fields",
+    )
+
+    # 4. "backfill" options
+    parser_backfill = subparsers.add_parser(
+        "backfill", help="Import weather data for many stations at once"
+    )
+    parser_backfill.set_defaults(func=run_backfill)
+    parser_backfill.add_argument(
+        "station_ids", type=int, nargs="+", help="Numeric IDs of the stations, e.g. 44 2667"
+    )
+    parser_backfill.add_argument(
+        "--processes",
+        type=int,
+        help="Number of worker processes for decoding data files. "
+        "By default, the number of CPUs is used.",
+    )
+
+    # 5. "mirror" options
+    parser_mirror = subparsers.add_parser(
+        "mirror", help="Import weather data for all stations"
+    )
+    parser_mirror.set_defaults(func=run_mirror)
+    parser_mirror.add_argument(
+        "--stations",
+        dest="station_ids",
+        type=int,
+        nargs="*",
+        help="Restrict mirror to these numeric station IDs",
+    )
+    parser_mirror.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("LON_MIN", "LAT_MIN", "LON_MAX", "LAT_MAX"),
+        help="Restrict mirror to stations within this bounding box",
+    )
+    parser_mirror.add_argument(
+        "--restart",
+        action="store_true",
+        help="Discard state of an interrupted run instead of resuming it",
+    )
+
+    for parser in [parser_backfill, parser_mirror]:
+        parser.add_argument(
+            "--timeranges",
+            type=str,
+            nargs="*",
+            choices=["now", "recent", "historical"],
+            default=["recent", "historical"],
+            help='List of timeranges to import. Defaults to "recent" and "historical".',
+        )
+
+    for parser in [parser_weather, parser_backfill, parser_mirror]:
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of threads for downloading and decoding measurements. Defaults to 4.",
+        )
+        parser.add_argument(
+            "--max-connections",
+            type=int,
+            default=4,
+            help="Maximum number of concurrent requests to the DWD server. Defaults to 4.",
+        )
+        parser.add_argument(
+            "--pool-size",
+            type=int,
+            help="Number of keep-alive connections to the DWD server. "
+            "Defaults to the value of --max-connections.",
+        )
 
     # Add global options to all subparsers.
 
-    for parser in [parser_station, parser_stations, parser_weather]:
+    for parser in [
+        parser_station,
+        parser_stations,
+        parser_weather,
+        parser_backfill,
+        parser_mirror,
+    ]:
 
         # "--resolution" option for choosing the corresponding dataset, defaults to "hourly"
         resolutions_available = DwdCdcKnowledge.climate.get_resolutions().keys()
@@ -156,6 +356,35 @@ def run():
             "--reset-cache", action="store_true", help="Drop the cache database"
         )
 
+        # Size budget and compression of the HTTP response cache.
+        parser.add_argument(
+            "--cache-size",
+            type=lambda value: int(float(value) * 1024 * 1024),
+            metavar="MEGABYTES",
+            help="Size budget of the HTTP response cache in megabytes, "
+            "least recently used archives will be evicted. Defaults to unlimited.",
+        )
+        parser.add_argument(
+            "--recompress",
+            action="store_true",
+            help="Recompress cached archives using LZMA in order to save disk space",
+        )
+        parser.add_argument(
+            "--storage-profile",
+            choices=sorted(STORAGE_PROFILES),
+            help='Storage profile of the cache database. Defaults to "serve", '
+            'the "backfill" and "mirror" subcommands use "bulk-load".',
+        )
+        parser.add_argument(
+            "--ttl",
+            type=parse_ttl_rule,
+            action="append",
+            metavar="RULE=SECONDS",
+            help="Expiration time of cached responses by resource class, timerange "
+            'and resolution, like "archive:now=60" or "archive:historical=never". '
+            "May be given multiple times.",
+        )
+
         # Debugging.
         parser.add_argument(
             "-d",
@@ -175,6 +404,8 @@ def run():
         )
 
     args = argparser.parse_args()
+    if args.ttl is not None:
+        args.ttl = dict(args.ttl)
     if args.debug > 0:
         setup_logging(logging.DEBUG)
     else:
@@ -2,23 +2,32 @@
 # (c) 2014 Marian Steinbach, MIT licensed
 # (c) 2018-2019 Andreas Motl, MIT licensed
 import os
-import re
 import sys
 import csv
 import json
 import math
 import logging
 import sqlite3
+import time
+import threading
 from io import StringIO
-import traceback
+from contextlib import nullcontext
+from queue import Empty, Full, Queue
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 from copy import deepcopy
-from datetime import datetime
-from dateutil.parser import parse as parsedate
+from datetime import datetime, timedelta
 
-from dwdweather.client import DwdCdcClient
+from dwdweather.aio import DwdAsync
+from dwdweather.backfill import DwdBackfill
+from dwdweather.client import DwdCdcClient, DwdCdcResult
 from dwdweather.knowledge import DwdCdcKnowledge
+from dwdweather.mirror import DwdMirror
+from dwdweather.parser import decode_result, decode_stations, import_numpy
+from dwdweather.rows import Rows, check_row_mode, import_pandas, to_datetime64
+from dwdweather.storage import Checkpointer, apply_storage_profile, get_storage_profile
+from dwdweather.util import chunked
 
 from dwdweather import __appname__ as APP_NAME
 
@@ -45,6 +54,10 @@ class DwdWeather:
     # Observations in Germany.
     germany_climate_uri = baseuri + "/observations_germany/climate/{resolution}"
 
+    # Stations reporting until this many days before the end
+    # of a station list are considered to be still active.
+    active_days = 7
+
     def __init__(self, resolution="hourly", category_names=None, **kwargs):
 
         # =================
@@ -68,6 +81,41 @@ class DwdWeather:
             cp = kwargs["cache_path"]
         self.cache_path = self.get_cache_path(cp)
 
+        # Parser for measurement files, either "python" or "numpy".
+        self.parser = kwargs.get("parser") or "python"
+        if self.parser == "numpy":
+            import_numpy()
+        elif self.parser != "python":
+            raise ValueError('Unknown parser "{}"'.format(self.parser))
+
+        # Shape of rows emitted by bulk readers, see ``dwdweather.rows``.
+        self.row_mode = check_row_mode(kwargs.get("row_mode") or "dict")
+
+        # Asynchronous interface, created on first use.
+        self.aio = None
+
+        # Number of rows written to the database at once.
+        self.batch_size = int(kwargs.get("batch_size") or 5000)
+
+        # Number of threads for downloading and decoding measurements,
+        # the number of concurrent requests to the CDC server and the
+        # number of keep-alive connections, which defaults to the former.
+        self.workers = int(kwargs.get("workers") or 4)
+        self.max_connections = int(kwargs.get("max_connections") or 4)
+        self.pool_size = int(kwargs.get("pool_size") or self.max_connections)
+
+        # Size budget of the HTTP response cache in bytes, unlimited
+        # by default, and whether to recompress archives using LZMA.
+        self.cache_size = kwargs.get("cache_size")
+        self.recompress = bool(kwargs.get("recompress"))
+
+        # Expiration rules of cached responses, see ``TtlPolicy``.
+        self.ttl = kwargs.get("ttl")
+
+        # Storage profile of the cache database, see ``dwdweather.storage``.
+        self.storage_profile = kwargs.get("storage_profile") or "serve"
+        get_storage_profile(self.storage_profile)
+
         # =================================
         # Acquire knowledgebase information
         # =================================
@@ -87,7 +135,15 @@ class DwdWeather:
         # =====================
         # Configure HTTP client
         # =====================
-        self.cdc = DwdCdcClient(self.resolution, self.cache_path)
+        self.cdc = DwdCdcClient(
+            self.resolution,
+            self.cache_path,
+            max_connections=self.max_connections,
+            pool_size=self.pool_size,
+            cache_size=self.cache_size,
+            recompress=self.recompress,
+            ttl=self.ttl,
+        )
 
         # ========================
         # Configure cache database
@@ -100,12 +156,25 @@ class DwdWeather:
         # Initialize
         self.init_cache()
 
+    def checkpointing(self):
+        """
+        Return context manager for running long imports. With the
+        "bulk-load" storage profile, it runs WAL checkpoints from
+        a background thread.
+        """
+        interval = get_storage_profile(self.storage_profile).get("checkpoint_interval")
+        if interval is None:
+            return nullcontext()
+        return Checkpointer(self.get_cache_database(), interval=interval)
+
     def resolve_categories(self, category_names):
         available_categories = deepcopy(DwdCdcKnowledge.climate.measurements)
         if category_names:
-            categories = filter(
-                lambda category: category["name"] in category_names,
-                available_categories,
+            categories = list(
+                filter(
+                    lambda category: category["name"] in category_names,
+                    available_categories,
+                )
             )
         else:
             categories = available_categories
@@ -150,6 +219,7 @@ class DwdWeather:
         log.info('Using cache database {}'.format(database_file))
 
         self.db = sqlite3.connect(database_file)
+        apply_storage_profile(self.db, self.storage_profile)
 
         # Enable debugging.
         #self.db.set_trace_callback(print)
@@ -158,21 +228,34 @@ class DwdWeather:
         self.db.row_factory = self.dict_factory
         c = self.db.cursor()
 
+        # Create one measurement table per category, clustered by
+        # station and timestamp.
+        for category_name in sorted(self.fields.keys()):
+            create_fields = []
+            for fieldname, fieldtype in self.fields[category_name]:
+                create_fields.append("%s %s" % (fieldname, fieldtype))
+            create = "CREATE TABLE IF NOT EXISTS {table} (station_id int, datetime int, {sql_fields}, PRIMARY KEY (station_id, datetime)) WITHOUT ROWID".format(
+                table=self.get_category_table(category_name), sql_fields=",\n".join(create_fields)
+            )
+            c.execute(create)
+
+        # Migrate wide measurement table of previous versions.
         tablename = self.get_measurement_table()
+        c.execute("SELECT type FROM sqlite_master WHERE name=?", (tablename,))
+        item = c.fetchone()
+        if item is not None and item["type"] == "table":
+            self.migrate_measurement_table()
 
-        # Create measurement tables and index.
-        create_fields = []
-        for category in sorted(self.fields.keys()):
-            for fieldname, fieldtype in self.fields[category]:
-                create_fields.append("%s %s" % (fieldname, fieldtype))
-        create = "CREATE TABLE IF NOT EXISTS {table} (station_id int, datetime int, {sql_fields})".format(
-            table=tablename, sql_fields=",\n".join(create_fields)
+        # Create view joining all categories into rows of the wide shape,
+        # unless it exists already.
+        create = "CREATE VIEW {table} AS {select}".format(
+            table=tablename, select=self.get_measurement_sql(sorted(self.fields.keys()))
         )
-        index = "CREATE UNIQUE INDEX IF NOT EXISTS {table}_uniqueidx ON {table} (station_id, datetime)".format(
-            table=tablename
-        )
-        c.execute(create)
-        c.execute(index)
+        c.execute("SELECT sql FROM sqlite_master WHERE type='view' AND name=?", (tablename,))
+        item = c.fetchone()
+        if item is None or item["sql"] != create:
+            c.execute("DROP VIEW IF EXISTS {}".format(tablename))
+            c.execute(create)
 
         # Create station tables and index.
         tablename = self.get_stations_table()
@@ -196,96 +279,235 @@ class DwdWeather:
         c.execute(create)
         c.execute(index)
 
+        # Create table recording the time spans covered by each station
+        # per category, from station lists ("all") and archive names.
+        # The index answers which stations cover a given day.
+        tablename = self.get_coverage_table()
+        create = """
+            CREATE TABLE IF NOT EXISTS {table}
+            (
+                category text,
+                station_id int,
+                timerange text,
+                date_start int,
+                date_end int,
+                PRIMARY KEY (category, station_id, timerange)
+            ) WITHOUT ROWID""".format(
+            table=tablename
+        )
+        index = "CREATE INDEX IF NOT EXISTS {table}_dateidx ON {table} (category, date_start, date_end, station_id)".format(
+            table=tablename
+        )
+        c.execute(create)
+        c.execute(index)
+
+        # Create manifest table for recording imported archives.
+        tablename = self.get_manifest_table()
+        create = """
+            CREATE TABLE IF NOT EXISTS {table}
+            (
+                uri text PRIMARY KEY,
+                category text,
+                size int,
+                modified int,
+                etag text,
+                last_modified text,
+                content_hash text,
+                rowcount int,
+                status text,
+                imported_at int
+            )""".format(
+            table=tablename
+        )
+        c.execute(create)
+
         self.db.commit()
 
     def import_stations(self):
         """
         Load station meta data from DWD server.
+
+        The station lists of all categories are fetched concurrently,
+        merged in memory and written using a single bulk upsert.
         """
-        for result in self.cdc.get_stations(self.categories):
-            self.import_station(result.payload)
+        return self.store_stations(self.cdc.get_stations(self.categories))
 
     def import_station(self, content):
         """
         Takes the content of one station metadata file
         and imports it into the database.
         """
-        content = content.decode("latin1")
-        content = content.strip()
-        content = content.replace("\r", "")
-        content = content.replace("\n\n", "\n")
+        return self.store_stations([DwdCdcResult(self.resolution, None, payload=content)])
 
-        table = self.get_stations_table()
+    def store_stations(self, results):
+        """
+        Decode station lists from ``DwdCdcResult`` items and upsert
+        them into the database, along with the time span covered by
+        each station per category. Returns the number of stored stations.
+
+        Station lists are mostly identical across categories, so each
+        distinct payload is decoded once. Later entries for the same
+        station and start date take precedence.
+        """
+        started = time.time()
+        decoded = {}
+        stations = {}
+        coverage = {}
+        for result in results:
+            payload = result.payload
+            rows = decoded.get(payload)
+            if rows is None:
+                rows = decoded[payload] = list(decode_stations(payload))
+            if result.category is None or not rows:
+                for row in rows:
+                    stations[row[0], row[1]] = row
+                continue
 
-        insert_sql = """INSERT OR IGNORE INTO {table}
+            # Stations reporting until the end of the list are still active,
+            # their coverage is open-ended.
+            active_since = self.add_days(max(row[2] for row in rows), -self.active_days)
+            category_name = result.category["name"]
+            for row in rows:
+                station_id, date_start, date_end = row[:3]
+                stations[station_id, date_start] = row
+                if date_end >= active_since:
+                    date_end = None
+                key = (category_name, station_id)
+                if key in coverage:
+                    first, last = coverage[key]
+                    date_start = min(first, date_start)
+                    date_end = None if None in (last, date_end) else max(last, date_end)
+                coverage[key] = (date_start, date_end)
+
+        upsert_sql = """INSERT INTO {table}
             (station_id, date_start, date_end, geo_lon, geo_lat, height, name, state)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""".format(
-            table=table
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (station_id, date_start) DO UPDATE SET
+            date_end=excluded.date_end, geo_lon=excluded.geo_lon, geo_lat=excluded.geo_lat,
+            height=excluded.height, name=excluded.name, state=excluded.state""".format(
+            table=self.get_stations_table()
         )
-        update_sql = """UPDATE {table}
-            SET date_end=?, geo_lon=?, geo_lat=?, height=?, name=?, state=?
-            WHERE station_id=? AND date_start=?""".format(
-            table=table
+        self.db.executemany(upsert_sql, stations.values())
+        self.update_coverage(
+            (category_name, station_id, "all", date_start, date_end)
+            for (category_name, station_id), (date_start, date_end) in coverage.items()
         )
-        cursor = self.db.cursor()
-        # print content
-        linecount = 0
-        for line in content.split("\n"):
-            linecount += 1
-            line = line.strip()
-            if line == "" or line == u"\x1a":
-                continue
-            # print linecount, line
-            if linecount > 2:
-                # frist 7 fields
-                parts = re.split(r"\s+", line, 6)
-                # seperate name from Bundesland
-                (name, bundesland) = parts[6].rsplit(" ", 1)
-                name = name.strip()
-                del parts[6]
-                parts.append(name)
-                parts.append(bundesland)
-                # print parts
-                for n in range(len(parts)):
-                    parts[n] = parts[n].strip()
-                station_id = int(parts[0])
-                station_height = int(parts[3])
-                station_lat = float(parts[4])
-                station_lon = float(parts[5])
-                station_start = int(parts[1])
-                station_end = int(parts[2])
-                station_name = parts[6]
-                station_state = parts[7]
-                # issue sql
-                cursor.execute(
-                    insert_sql,
-                    (
-                        station_id,
-                        station_start,
-                        station_end,
-                        station_lon,
-                        station_lat,
-                        station_height,
-                        station_name,
-                        station_state,
-                    ),
-                )
-                cursor.execute(
-                    update_sql,
-                    (
-                        station_end,
-                        station_lon,
-                        station_lat,
-                        station_height,
-                        station_name,
-                        station_state,
-                        station_id,
-                        station_start,
-                    ),
-                )
         self.db.commit()
 
-    def import_measures(self, station_id, current=False, latest=False, historic=False):
+        log.info(
+            "Imported {} stations from {} station lists in {:.2f} seconds".format(
+                len(stations), len(decoded), time.time() - started
+            )
+        )
+        return len(stations)
+
+    def update_coverage(self, rows):
+        """
+        Upsert coverage records, given as tuples of
+        (category, station_id, timerange, date_start, date_end).
+        """
+        upsert_sql = """INSERT INTO {table}
+            (category, station_id, timerange, date_start, date_end)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (category, station_id, timerange) DO UPDATE SET
+            date_start=excluded.date_start, date_end=excluded.date_end""".format(
+            table=self.get_coverage_table()
+        )
+        self.db.executemany(upsert_sql, rows)
+
+    def get_station_categories(self, station_id):
+        """
+        Return names of the categories the station has data for,
+        according to the station lists.
+        """
+        sql = "SELECT category FROM {table} WHERE station_id=? AND timerange='all' ORDER BY category".format(
+            table=self.get_coverage_table()
+        )
+        return [row["category"] for row in self.db.execute(sql, (station_id,))]
+
+    def get_listed_categories(self):
+        """
+        Return names of the selected categories whose station lists
+        have been imported.
+        """
+        sql = "SELECT 1 FROM {table} WHERE category=? AND timerange='all' LIMIT 1".format(
+            table=self.get_coverage_table()
+        )
+        return [
+            category["name"]
+            for category in self.categories
+            if self.db.execute(sql, (category["name"],)).fetchone() is not None
+        ]
+
+    def get_covered_categories(self, station_id, timestamp, end=None):
+        """
+        Return names of the selected categories which have data of the
+        station on the day of ``timestamp``, or on any day until ``end``,
+        according to the station lists. Categories whose station list has
+        not been imported are included, as their coverage is unknown.
+        Returns ``None`` when the station is not in any station list.
+
+        Time spans of historical archives are not considered, as they
+        say nothing about the "recent" and "now" timeranges.
+        """
+        sql = "SELECT category, date_start, date_end FROM {table} WHERE station_id=? AND timerange='all'".format(
+            table=self.get_coverage_table()
+        )
+        spans = {
+            row["category"]: (row["date_start"], row["date_end"])
+            for row in self.db.execute(sql, (station_id,))
+        }
+        if not spans:
+            return None
+        first_day = int(timestamp.strftime("%Y%m%d"))
+        last_day = int((end or timestamp).strftime("%Y%m%d"))
+        listed = self.get_listed_categories()
+        categories = []
+        for category in self.categories:
+            category_name = category["name"]
+            if category_name in spans:
+                date_start, date_end = spans[category_name]
+                if date_start > last_day or (date_end is not None and date_end < first_day):
+                    continue
+            elif category_name in listed:
+                continue
+            categories.append(category_name)
+        return categories
+
+    def get_covering_stations(self, timestamp):
+        """
+        Return ids of the stations which have data of any selected
+        category on the day of ``timestamp``, according to the station
+        lists. Returns ``None`` when the station list of any selected
+        category has not been imported, as coverage is unknown then.
+        """
+        category_names = [category["name"] for category in self.categories]
+        if len(self.get_listed_categories()) < len(category_names):
+            return None
+        sql = """SELECT DISTINCT station_id FROM {table}
+            WHERE category IN ({placeholders}) AND timerange='all'
+            AND date_start<=? AND (date_end IS NULL OR date_end>=?)""".format(
+            table=self.get_coverage_table(), placeholders=", ".join("?" * len(category_names))
+        )
+        day = int(timestamp.strftime("%Y%m%d"))
+        return {row["station_id"] for row in self.db.execute(sql, category_names + [day, day])}
+
+    def add_days(self, day, days):
+        """
+        Add number of days to an integer date like ``20200601``.
+        """
+        return int((datetime.strptime(str(day), "%Y%m%d") + timedelta(days=days)).strftime("%Y%m%d"))
+
+    def import_measures(
+        self,
+        station_id,
+        current=False,
+        latest=False,
+        historic=False,
+        categories=None,
+        timestamp=None,
+        end=None,
+    ):
         """
         Load data from DWD server.
         Parameter:
@@ -294,11 +516,17 @@ class DwdWeather:
 
         latest: Load most recent data (True, False)
         historic: Load older values
+        categories: Restrict import to these category names
+        timestamp: Skip historical archives not covering this day,
+                   or any day until ``end``
 
         We download ZIP files for several categories
         of measures. We then extract one file from
         each ZIP. This path is then handed to the
         CSV -> Sqlite import function.
+
+        Downloading and decoding happens concurrently
+        using a pool of ``workers`` threads.
         """
 
         # Compute timerange labels / subfolder names.
@@ -318,200 +546,559 @@ class DwdWeather:
             % json.dumps(station_info, indent=2, sort_keys=True)
         )
 
-        # Download and import data.
+        days = None
+        if timestamp is not None:
+            days = (int(timestamp.strftime("%Y%m%d")), int((end or timestamp).strftime("%Y%m%d")))
+
+        tasks = []
         for category in self.categories:
-            key = category["key"]
-            name = category["name"].replace("_", " ")
-            log.info('Downloading "{}" data ({})'.format(name, key))
-            for result in self.cdc.get_measurements(station_id, category, timeranges):
-                # Import data for all categories.
-                log.info(
-                    'Importing measurements for station "{}" and category "{}"'.format(
-                        station_id, category
-                    )
+            category_name = category["name"]
+            if category_name not in self.fields:
+                log.warning(
+                    'Importing "{}" data not implemented yet'.format(category_name.replace("_", " "))
                 )
-                # log.warning("No files to import for station %s" % station_id)
-                self.import_measures_textfile(result)
+                continue
+            if categories is not None and category_name not in categories:
+                continue
+            tasks.append((station_id, category))
 
-    def datetime_to_int(self, datetime):
-        return int(datetime.replace("T", "").replace(":", ""))
+        rowcount = self.import_tasks(tasks, timeranges, days)
+        self.cdc.log_cache_stats()
+        return rowcount
 
-    def get_measurement(self, station_id, date):
-        tablename = self.get_measurement_table()
-        sql = "SELECT * FROM {tablename} WHERE station_id = {station_id} AND datetime = {datetime}".format(
-            tablename=tablename, station_id=station_id, datetime=date
+    def import_tasks(self, tasks, timeranges, days=None):
+        """
+        Download and import measurements for ``(station_id, category)``
+        tasks within given timeranges, skipping historical archives not
+        covering the ``(first_day, last_day)`` tuple ``days``.
+        Returns the number of imported rows.
+
+        Downloading and decoding happens concurrently using a pool of
+        ``workers`` threads. Each folder listing is requested once.
+        """
+
+        # Archives which have been imported completely.
+        manifest = self.get_manifest()
+
+        # Download and decode data for all tasks concurrently.
+        # Batches of rows and manifest records are handed over through
+        # a bounded queue to this thread, which is the single writer
+        # to the database.
+        queue = Queue(maxsize=self.workers * 4)
+
+        # Signal workers to stop when the writer has been interrupted.
+        stopping = threading.Event()
+
+        def put(item):
+            while not stopping.is_set():
+                try:
+                    queue.put(item, timeout=1)
+                    return
+                except Full:
+                    pass
+
+        def acquire(task):
+            station_id, category = task
+            if stopping.is_set():
+                return
+            try:
+                key = category["key"]
+                category_name = category["name"]
+                name = category_name.replace("_", " ")
+                log.info('Downloading "{}" data ({}) for station {}'.format(name, key, station_id))
+                resources = list(
+                    self.cdc.get_measurement_resources(station_id, category, timeranges)
+                )
+
+                # Record time spans of historical archives.
+                spans = [
+                    (resource.date_from, resource.date_to)
+                    for resource in resources
+                    if resource.date_from is not None
+                ]
+                if spans:
+                    coverage = (
+                        category_name,
+                        station_id,
+                        "historical",
+                        min(span[0] for span in spans),
+                        max(span[1] for span in spans),
+                    )
+                    put(("coverage", category_name, [coverage]))
+
+                for resource in resources:
+                    if stopping.is_set():
+                        return
+                    if days is not None and not self.is_archive_covering(resource, *days):
+                        log.info(
+                            'Skipping archive "{}" not covering {}-{}'.format(resource.uri, *days)
+                        )
+                        continue
+
+                    entry = manifest.get(resource.uri)
+                    if self.is_archive_unchanged(entry, resource):
+                        log.info('Skipping unchanged archive "{}"'.format(resource.uri))
+                        continue
+
+                    log.info("Fetching resource {}".format(resource.uri))
+                    with self.cdc.open_download(
+                        resource.uri, size=resource.size, modified=resource.modified
+                    ) as (record, archive):
+                        record = dict(record)
+                        record.update(
+                            uri=resource.uri, category=category_name, modified=resource.modified
+                        )
+
+                        # Archive has been imported already, only listing information changed.
+                        if entry and entry["content_hash"] == record["content_hash"]:
+                            log.info('Skipping unchanged archive "{}"'.format(resource.uri))
+                            record["rowcount"] = entry["rowcount"]
+                            put(("complete", category_name, record))
+                            continue
+
+                        put(("started", category_name, record))
+                        record["rowcount"] = 0
+                        for result in self.cdc.read_archive(category, resource.uri, archive):
+                            log.info('Importing "{}" data from "{}"'.format(name, result.uri))
+                            for batch in chunked(self.decode_measures(result), self.batch_size):
+                                put(("rows", category_name, batch))
+                                if stopping.is_set():
+                                    return
+                                record["rowcount"] += len(batch)
+                        put(("complete", category_name, record))
+            finally:
+                put(None)
+
+        rowcount = 0
+        started = time.time()
+        with self.checkpointing(), ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(acquire, task) for task in tasks]
+            pending = len(futures)
+            try:
+                with tqdm(ncols=79, unit=" rows") as progress:
+                    while pending:
+                        item = queue.get()
+                        if item is None:
+                            pending -= 1
+                            continue
+                        kind, category_name, payload = item
+                        if kind == "rows":
+                            self.upsert_measurements(category_name, payload)
+                            rowcount += len(payload)
+                            progress.update(len(payload))
+                        elif kind == "coverage":
+                            self.update_coverage(payload)
+                        else:
+                            self.update_manifest(payload, status=kind)
+                        self.db.commit()
+            except BaseException:
+                # Stop workers and unblock those waiting on the queue,
+                # so the executor can shut down and the error surfaces.
+                stopping.set()
+                for future in futures:
+                    future.cancel()
+                while True:
+                    try:
+                        queue.get_nowait()
+                    except Empty:
+                        break
+                raise
+
+        # Propagate errors from workers.
+        for future in futures:
+            future.result()
+
+        # Report about import performance.
+        duration = time.time() - started
+        log.info(
+            "Imported {} rows for {} stations in {:.2f} seconds ({:.0f} rows/s)".format(
+                rowcount,
+                len(set(station_id for station_id, category in tasks)),
+                duration,
+                rowcount / duration if duration else rowcount,
+            )
         )
 
-        c = self.db.cursor()
-        c.execute(sql)
+        return rowcount
 
-        result = []
-        for row in c.execute(sql):
-            result.append(row)
+    def get_manifest(self):
+        """
+        Return manifest records of all completely imported archives, keyed by URI.
+        """
+        sql = "SELECT * FROM {table} WHERE status='complete'".format(
+            table=self.get_manifest_table()
+        )
+        manifest = {}
+        for row in self.db.execute(sql):
+            manifest[row["uri"]] = row
+        return manifest
 
-        if len(result) > 0:
-            return result[0]
-        else:
-            return None
+    def update_manifest(self, record, status):
+        """
+        Record import status of an archive.
+        """
+        sql = """INSERT OR REPLACE INTO {table}
+            (uri, category, size, modified, etag, last_modified, content_hash, rowcount, status, imported_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""".format(
+            table=self.get_manifest_table()
+        )
+        self.db.execute(
+            sql,
+            (
+                record["uri"],
+                record["category"],
+                record["size"],
+                record["modified"],
+                record["etag"],
+                record["last_modified"],
+                record["content_hash"],
+                record.get("rowcount"),
+                status,
+                int(time.time()),
+            ),
+        )
 
-    def insert_measurement(self, tablename, fields, value_placeholders, dataset):
-        sql = "INSERT INTO {tablename} ({fields}) VALUES ({value_placeholders})".format(
-            tablename=tablename,
-            fields=", ".join(fields),
-            value_placeholders=", ".join(value_placeholders),
+    def is_archive_unchanged(self, entry, resource):
+        """
+        Whether the listing information of an archive matches
+        its manifest record, so it does not need to be imported.
+        """
+        return (
+            entry is not None
+            and resource.modified is not None
+            and resource.size is not None
+            and entry["modified"] == resource.modified
+            and entry["size"] == resource.size
         )
 
-        c = self.db.cursor()
-        c.execute(sql, dataset)
-        # self.db.commit()
+    def is_archive_covering(self, resource, first_day, last_day=None):
+        """
+        Whether an archive may contain data of the given day, or any day
+        until ``last_day``, according to the time span from its name.
+        """
+        if resource.date_from is None or resource.date_to is None:
+            return True
+        return resource.date_from <= (last_day or first_day) and resource.date_to >= first_day
 
-    def update_measurement(self, tablename, sets, dataset):
-        sql = "UPDATE {tablename} SET {sets} WHERE station_id = ? AND datetime = ?".format(
-            tablename=tablename, sets=", ".join(sets)
+    def backfill(self, station_ids, timeranges=("recent", "historical"), processes=None):
+        """
+        Import measurements for many stations at once.
+
+        Archives are downloaded concurrently, decoded by a pool of
+        ``processes`` worker processes and written to the database
+        by a single writer process. Returns the number of imported rows.
+
+        Example:
+        --------
+
+        >>> from dwdweather import DwdWeather
+        >>> dwd = DwdWeather(resolution="hourly", category_names=["air_temperature"])
+        >>> dwd.backfill([44, 96, 5792], timeranges=["recent"], processes=4)
+
+        """
+        return DwdBackfill(self, processes=processes).run(station_ids, list(timeranges))
+
+    def mirror(self, timeranges=("recent", "historical"), station_ids=None, bbox=None, resume=True):
+        """
+        Import measurements of the selected categories for all stations.
+
+        Each folder on the CDC server is listed once, all archives are
+        bulk-loaded into staging tables and merged at the end. An
+        interrupted run will be resumed, unless ``resume=False``.
+        Returns the number of imported rows.
+
+        Parameters:
+        ----------
+
+            station_ids : list
+                restrict mirror to these stations
+
+            bbox : tuple
+                restrict mirror to stations within
+                ``(lon_min, lat_min, lon_max, lat_max)``
+
+        Example:
+        --------
+
+        >>> from dwdweather import DwdWeather
+        >>> dwd = DwdWeather(resolution="hourly", category_names=["air_temperature"])
+        >>> dwd.mirror(timeranges=["recent"], bbox=(5.8, 47.2, 15.1, 55.1))
+
+        """
+        return DwdMirror(self).run(
+            list(timeranges), station_ids=station_ids, bbox=bbox, resume=resume
         )
 
-        c = self.db.cursor()
-        c.execute(sql, dataset)
-        # self.db.commit()
+    def datetime_to_int(self, datetime):
+        return int(datetime.replace("T", "").replace(":", ""))
 
-    def import_measures_textfile(self, result):
+    def get_measurement(self, station_id, date, fields=None, quality=True):
         """
-        Import content of source text file into database.
+        Return record of the selected categories for given station and
+        integer timestamp, or ``None`` when there is no data.
+        See ``get_projection`` for ``fields`` and ``quality``.
         """
+        category_names, fieldnames = self.get_projection(fields, quality)
+        if not category_names:
+            return None
+        sql = self.get_measurement_sql(
+            category_names, where="station_id=:station_id AND datetime=:datetime", fields=fieldnames
+        )
+        c = self.db.cursor()
+        c.execute(sql, {"station_id": station_id, "datetime": date})
+        result = c.fetchone()
+        c.close()
+        return result
 
-        category_name = result.category["name"]
-        category_label = category_name.replace("_", " ")
-        if category_name not in self.fields:
-            log.warning(
-                'Importing "{}" data from "{}" not implemented yet'.format(
-                    category_label, result.uri
-                )
-            )
-            return
+    def get_projection(self, fields=None, quality=True):
+        """
+        Resolve selection of fields into the names of the categories to
+        read and an explicit list of field names, or ``None`` for all
+        fields. Returns ``(category_names, fieldnames)``.
 
-        log.info('Importing "{}" data from "{}"'.format(category_label, result.uri))
+        Field names are validated against the knowledge base and must
+        belong to the selected categories. Without ``quality``, the
+        ``*_quality_level`` fields are left out.
+        """
+        category_names = self.get_category_names()
+        if fields is None and quality:
+            return category_names, None
+
+        categories_by_field = {}
+        for category_name, fielddefs in self.fields.items():
+            for fieldname, fieldtype in fielddefs:
+                categories_by_field[fieldname] = category_name
+
+        if fields is None:
+            fieldnames = [
+                fieldname
+                for category_name in category_names
+                for fieldname, fieldtype in self.fields[category_name]
+            ]
+        else:
+            fieldnames = []
+            for fieldname in fields:
+                if fieldname in ["station_id", "datetime"] or fieldname in fieldnames:
+                    continue
+                category_name = categories_by_field.get(fieldname)
+                if category_name is None:
+                    raise ValueError(
+                        'Unknown field "{}" for resolution "{}"'.format(fieldname, self.resolution)
+                    )
+                if category_name not in category_names:
+                    raise ValueError(
+                        'Field "{}" belongs to category "{}", which is not selected'.format(
+                            fieldname, category_name
+                        )
+                    )
+                fieldnames.append(fieldname)
 
-        # Create SQL template.
-        tablename = self.get_measurement_table()
-        fieldnames = []
-        value_placeholders = []
-        sets = []
+        if not quality:
+            fieldnames = [
+                fieldname for fieldname in fieldnames if not fieldname.endswith("_quality_level")
+            ]
 
-        fields = list(self.fields[category_name])
-        for fieldname, fieldtype in fields:
-            sets.append(fieldname + "=?")
+        selected = set(categories_by_field[fieldname] for fieldname in fieldnames)
+        category_names = [
+            category_name for category_name in category_names if category_name in selected
+        ]
+        return category_names, fieldnames
 
-        fields.append(("station_id", "str"))
-        fields.append(("datetime", "datetime"))
+    def get_measurement_columns(self, category_names, fields=None):
+        """
+        Return ``(name, type)`` tuples of the columns read by
+        ``get_measurement_sql``, in the same order.
+        """
+        columns = [("station_id", "int"), ("datetime", "datetime")]
+        for category_name in category_names:
+            columns += [
+                (fieldname, fieldtype)
+                for fieldname, fieldtype in self.fields[category_name]
+                if fields is None or fieldname in fields
+            ]
+        return columns
+
+    def get_measurement_sql(self, category_names, where=None, fields=None):
+        """
+        Build ``SELECT`` statement joining the tables of given categories
+        into rows of the wide shape: "station_id", "datetime" and the
+        fields of all categories, or only the given ``fields``.
 
-        for fieldname, fieldtype in fields:
-            fieldnames.append(fieldname)
-            value_placeholders.append("?")
+        The ``where`` clause is applied to each table, so it can use
+        their primary keys, and may refer to named parameters.
+        """
+        where = " WHERE {}".format(where) if where else ""
+        keys = " UNION ".join(
+            "SELECT station_id, datetime FROM {table}{where}".format(
+                table=self.get_category_table(category_name), where=where
+            )
+            for category_name in category_names
+        )
+        columns = []
+        joins = []
+        for category_name in category_names:
+            table = self.get_category_table(category_name)
+            columns += [
+                "{}.{}".format(table, fieldname)
+                for fieldname, fieldtype in self.fields[category_name]
+                if fields is None or fieldname in fields
+            ]
+            joins.append(
+                "LEFT JOIN {table} ON ({table}.station_id=k.station_id AND {table}.datetime=k.datetime)".format(
+                    table=table
+                )
+            )
+        return "SELECT {columns} FROM ({keys}) AS k {joins}".format(
+            columns=", ".join(
+                ["k.station_id AS station_id", "k.datetime AS datetime"] + columns
+            ),
+            keys=keys,
+            joins=" ".join(joins),
+        )
 
-        # Create data rows.
-        count = 0
-        items = result.payload.decode("latin-1").split("\n")
-        for line in tqdm(items, ncols=79):
-            count += 1
-            line = line.strip()
-            if line == "" or line == "\x1a":
+    def migrate_measurement_table(self):
+        """
+        Move records from the wide ``measures_<resolution>`` table of
+        previous versions into the tables of each category.
+        """
+        tablename = self.get_measurement_table()
+        log.info("Migrating measurement table {}".format(tablename))
+        columns = [row["name"] for row in self.db.execute("PRAGMA table_info({})".format(tablename))]
+        for category_name in sorted(self.fields.keys()):
+            fieldnames = [
+                fieldname
+                for fieldname, fieldtype in self.fields[category_name]
+                if fieldname in columns
+            ]
+            if not fieldnames:
                 continue
-            line = line.replace(";eor", "")
-            #print('Line:', line)
+            self.db.execute(
+                "INSERT OR REPLACE INTO {table} ({fields}, station_id, datetime) SELECT {fields}, station_id, datetime FROM {source} WHERE NOT ({empty})".format(
+                    table=self.get_category_table(category_name),
+                    fields=", ".join(fieldnames),
+                    source=tablename,
+                    empty=" AND ".join("{} IS NULL".format(fieldname) for fieldname in fieldnames),
+                )
+            )
+        self.db.execute("DROP TABLE {}".format(tablename))
+        self.db.commit()
 
-            parts = line.split(";")
-            for n in range(len(parts)):
-                parts[n] = parts[n].strip()
+    def get_upsert_sql(self, category_name, select=None):
+        """
+        Build ``INSERT ... ON CONFLICT DO UPDATE`` statement for writing
+        the fields of given category, followed by "station_id" and "datetime",
+        into the table of the category.
 
-            if count > 1:
+        Values are taken from SQL parameters, or from the given
+        ``SELECT`` statement, which must provide columns in this order.
+        It must have a ``WHERE`` clause, to disambiguate the upsert clause.
+        """
+        tablename = self.get_category_table(category_name)
+        fieldnames = [fieldname for fieldname, fieldtype in self.fields[category_name]]
+        if select is None:
+            select = "VALUES ({value_placeholders}, ?, ?)".format(
+                value_placeholders=", ".join(["?"] * len(fieldnames))
+            )
+        sql = """INSERT INTO {tablename} ({fields}, station_id, datetime)
+            {select}
+            ON CONFLICT(station_id, datetime) DO UPDATE SET {sets}""".format(
+            tablename=tablename,
+            fields=", ".join(fieldnames),
+            select=select,
+            sets=", ".join(
+                ["{0}=excluded.{0}".format(fieldname) for fieldname in fieldnames]
+            ),
+        )
+        return sql
 
-                # The first two fields are station id and timestamp in raw format.
-                station_id_raw = parts.pop(0)
-                timestamp_raw = parts.pop(0)
+    def upsert_measurements(self, category_name, rows):
+        """
+        Write a batch of measurement rows for a single category.
 
-                # Parse station id.
-                station_id = int(station_id_raw)
+        Each row contains the values for all fields of the category,
+        followed by "station_id" and "datetime". Rows are written into
+        the table of the category with a single prepared
+        ``INSERT ... ON CONFLICT DO UPDATE`` statement.
+        """
+        c = self.db.cursor()
+        c.executemany(self.get_upsert_sql(category_name), rows)
+        c.close()
 
-                # Parse timestamp.
-                # FIXME: We should not store timestamps as integers but better use real datetimes.
-                try:
-                    timestamp_sanitized = timestamp_raw.replace("T", "").replace(":", "")
+    def decode_measures(self, result):
+        """
+        Decode content of source text file using the configured parser.
 
-                    # If timestamp lacks minutes (like 2018112922),
-                    # let's add them to make the datetime parser happy.
-                    if len(timestamp_sanitized) == 10:
-                        timestamp_sanitized += '00'
+        Yields values for all fields of the category, followed by
+        "station_id" and "datetime", which are used as conflict
+        target of the upsert statement.
+        """
+        return decode_result(result, self.resolution, self.parser)
 
-                    # Run sanitized timestamp through datatime parser
-                    # and reformat it into the appropriate format.
-                    timestamp_datetime = parsedate(timestamp_sanitized, ignoretz=True)
-                    timestamp = int(timestamp_datetime.strftime(self.get_timestamp_format()))
+    def import_measures_textfile(self, result, batch_size=None):
+        """
+        Import content of source text file into database.
 
-                except Exception as ex:
-                    log.error('Parsing timestamp "{}" failed: {}'.format(timestamp_sanitized, ex))
-                    continue
+        Rows are collected into batches of ``batch_size`` items,
+        each batch is written using ``upsert_measurements``.
+        Returns the number of imported rows.
+        """
+        batch_size = batch_size or self.batch_size
 
-                dataset = []
-
-                # For debugging purposes.
-                # if category_name == "soil_temp":
-                #    print(self.fields[category_name])
-                #    print(parts)
-
-                for index, cell in enumerate(parts):
-                    (fieldname, fieldtype) = self.fields[category_name][index]
-                    if cell == "-999":
-                        cell = None
-                    elif fieldtype == "real":
-                        cell = float(cell)
-                    elif fieldtype == "int":
-                        try:
-                            cell = int(float(cell))
-                        except ValueError:
-                            sys.stderr.write(
-                                "Error in converting field '%s', value '%s' to int.\n"
-                                % (fieldname, cell)
-                            )
-
-                            # FIXME: Try to be more graceful here.
-                            (t, val, trace) = sys.exc_info()
-                            traceback.print_tb(trace)
-                            sys.exit(2)
-
-                    elif fieldtype == "datetime":
-                        cell = self.datetime_to_int(cell)
-
-                    dataset.append(cell)
-
-                # "station_id" and "datetime" should go into the last
-                # two slots of the SQL template to be interpolated
-                # as constraints into the WHERE clause.
-                dataset.append(station_id)
-                dataset.append(timestamp)
-
-                #print('Parts:', parts)
-                #print('Dataset:', dataset)
-
-                if self.get_measurement(station_id, timestamp):
-                    self.update_measurement(tablename, sets, dataset)
-                else:
-                    self.insert_measurement(
-                        tablename, fieldnames, value_placeholders, dataset
-                    )
+        category_name = result.category["name"]
+        category_label = category_name.replace("_", " ")
+        if category_name not in self.fields:
+            log.warning(
+                'Importing "{}" data from "{}" not implemented yet'.format(
+                    category_label, result.uri
+                )
+            )
+            return 0
 
-                # Commit in batches.
-                if count % 500 == 0:
-                    self.db.commit()
+        log.info('Importing "{}" data from "{}"'.format(category_label, result.uri))
 
-        # Commit all data.
+        # Create data rows.
+        started = time.time()
+        rows = self.decode_measures(result)
+
+        rowcount = 0
+        batch = []
+        for dataset in tqdm(rows, ncols=79):
+            batch.append(dataset)
+
+            # Write and commit in batches.
+            if len(batch) >= batch_size:
+                self.upsert_measurements(category_name, batch)
+                self.db.commit()
+                rowcount += len(batch)
+                batch = []
+
+        # Write and commit all remaining data.
+        if batch:
+            self.upsert_measurements(category_name, batch)
+            rowcount += len(batch)
         self.db.commit()
 
+        # Report about import performance.
+        duration = time.time() - started
+        log.info(
+            'Imported {} rows of "{}" data in {:.2f} seconds ({:.0f} rows/s)'.format(
+                rowcount, category_label, duration, rowcount / duration if duration else rowcount
+            )
+        )
+
+        return rowcount
+
     def get_data_age(self):
         """
         Return age of latest dataset as ``datetime.timedelta``.
         """
-        sql = (
-            "SELECT MAX(datetime) AS maxdatetime FROM %s" % self.get_measurement_table()
+        sql = "SELECT MAX(datetime) AS maxdatetime FROM ({})".format(
+            " UNION ALL ".join(
+                "SELECT MAX(datetime) AS datetime FROM {}".format(
+                    self.get_category_table(category_name)
+                )
+                for category_name in sorted(self.fields.keys())
+            )
         )
         c = self.db.cursor()
         c.execute(sql)
@@ -523,44 +1110,324 @@ class DwdWeather:
     def get_stations_table(self):
         return "stations_%s" % self.resolution
 
+    def get_coverage_table(self):
+        return "coverage_%s" % self.resolution
+
     def get_measurement_table(self):
         return "measures_%s" % self.resolution
 
+    def get_category_table(self, category_name):
+        return "measures_%s_%s" % (self.resolution, category_name)
+
+    def get_category_names(self):
+        """
+        Return names of the selected categories having fields,
+        in the order of the wide measurement shape.
+        """
+        return sorted(
+            category["name"] for category in self.categories if category["name"] in self.fields
+        )
+
+    def get_manifest_table(self):
+        return "manifest_%s" % self.resolution
+
     def get_timestamp_format(self):
         knowledge = DwdCdcKnowledge.climate.get_resolution_by_name(self.resolution)
         return knowledge.__timestamp_format__
 
-    def query(self, station_id, timestamp, recursion=0):
+    def query(self, station_id, timestamp, recursion=0, fields=None, quality=True):
         """
         Get values from cache.
         station_id: Numeric station ID
         timestamp: datetime object
+        fields: Restrict record to these field names
+        quality: Whether to include ``*_quality_level`` fields
         """
         if recursion < 2:
-            sql = (
-                "SELECT * FROM %s WHERE station_id=? AND datetime LIKE ?"
-                % self.get_measurement_table()
-            )
-            c = self.db.cursor()
-            c.execute(
-                sql, (station_id, timestamp.strftime(self.get_timestamp_format()))
+            out = self.get_measurement(
+                station_id,
+                int(timestamp.strftime(self.get_timestamp_format())),
+                fields=fields,
+                quality=quality,
             )
-            out = c.fetchone()
             if out is None:
-                # cache miss
-                age = (datetime.utcnow() - timestamp).total_seconds() / 86400
-                if age < 1:
-                    self.import_measures(station_id, current=True, latest=False, historic=False)
-                elif age < 360:
-                    self.import_measures(station_id, latest=True, historic=False)
-                elif age >= 360 and age <= 370:
-                    self.import_measures(station_id, latest=True, historic=True)
-                else:
-                    self.import_measures(station_id, current=False, latest=False, historic=True)
-                return self.query(station_id, timestamp, recursion=(recursion + 1))
-            c.close()
+                # cache miss, skip categories the station has no data for.
+                category_names, fieldnames = self.get_projection(fields, quality)
+                categories = self.get_covered_categories(station_id, timestamp)
+                if categories is None:
+                    categories = category_names
+                categories = [
+                    category_name for category_name in categories if category_name in category_names
+                ]
+                if not categories:
+                    log.info(
+                        "Station {} has no data for {}, according to its coverage".format(
+                            station_id, timestamp
+                        )
+                    )
+                    return None
+                timeranges = self.get_timeranges(timestamp)
+                self.import_measures(
+                    station_id,
+                    current="now" in timeranges,
+                    latest="recent" in timeranges,
+                    historic="historical" in timeranges,
+                    categories=categories,
+                    timestamp=timestamp,
+                )
+                return self.query(
+                    station_id, timestamp, recursion=(recursion + 1), fields=fields, quality=quality
+                )
             return out
 
+    def query_range(self, station_id, start, end, fields=None, quality=True, row_mode=None):
+        """
+        Get values of all timestamps between ``start`` and ``end``,
+        both inclusive, importing missing archives covering this window
+        first. Returns ``Rows`` of records ordered by timestamp,
+        see ``read_measurements``.
+
+        station_id: Numeric station ID
+        start, end: datetime objects
+        fields: Restrict records to these field names
+        quality: Whether to include ``*_quality_level`` fields
+        row_mode: Row mode of records, see ``dwdweather.rows``
+        """
+        category_names, fieldnames = self.get_projection(fields, quality)
+
+        # Import archives which have not been imported yet.
+        categories = self.get_covered_categories(station_id, start, end)
+        if categories is None:
+            categories = category_names
+        categories = [
+            category_name for category_name in categories if category_name in category_names
+        ]
+        if categories:
+            timeranges = self.get_timeranges(start, end)
+            self.import_measures(
+                station_id,
+                current="now" in timeranges,
+                latest="recent" in timeranges,
+                historic="historical" in timeranges,
+                categories=categories,
+                timestamp=start,
+                end=end,
+            )
+
+        timestamp_format = self.get_timestamp_format()
+        return self.read_measurements(
+            [station_id],
+            category_names,
+            start=int(start.strftime(timestamp_format)),
+            end=int(end.strftime(timestamp_format)),
+            fields=fieldnames,
+            row_mode=row_mode,
+        )
+
+    def to_numpy(self, station_id, start, end, fields=None, quality=True):
+        """
+        Get values of all timestamps between ``start`` and ``end`` like
+        ``query_range``, as NumPy structured array. The rows are read from
+        the database in batches, NULL values are NaN. The integer
+        "datetime" key is converted to ``datetime64[m]``.
+        """
+        np = import_numpy()
+        array = self.query_range(station_id, start, end, fields, quality, row_mode="numpy").to_array()
+        dtype = [
+            (name, "datetime64[m]" if name == "datetime" else array.dtype[name])
+            for name in array.dtype.names
+        ]
+        result = np.empty(len(array), dtype=dtype)
+        for name in array.dtype.names:
+            result[name] = array[name]
+        result["datetime"] = to_datetime64(array["datetime"], self.get_timestamp_format())
+        return result
+
+    def to_frame(self, station_id, start, end, fields=None, quality=True):
+        """
+        Get values of all timestamps between ``start`` and ``end`` like
+        ``query_range``, as ``pandas.DataFrame`` with one column for
+        each field, indexed by timestamp. NULL values are NaN.
+        """
+        pandas = import_pandas()
+        array = self.query_range(station_id, start, end, fields, quality, row_mode="numpy").to_array()
+        index = pandas.DatetimeIndex(
+            to_datetime64(array["datetime"], self.get_timestamp_format()), name="datetime"
+        )
+        return pandas.DataFrame(
+            {name: array[name] for name in array.dtype.names[2:]}, index=index
+        )
+
+    def query_many(
+        self, station_ids, timestamps=None, start=None, end=None, fields=None, quality=True
+    ):
+        """
+        Get values of multiple stations, either for a list of
+        ``timestamps``, or for all timestamps between ``start`` and
+        ``end``. Returns ``Rows`` of records ordered by station and
+        timestamp, see ``read_measurements``.
+
+        Stations missing records are imported first, all at once:
+        archives are downloaded concurrently, sharing folder listings.
+        All records are then read using a single query.
+
+        station_ids: List of numeric station IDs
+        timestamps: List of datetime objects
+        start, end: datetime objects
+        fields: Restrict records to these field names
+        quality: Whether to include ``*_quality_level`` fields
+        """
+        if timestamps is None:
+            if start is None or end is None:
+                raise ValueError("Either timestamps or start and end must be given")
+            window = [start, end]
+        else:
+            window = sorted(timestamps)
+            if not window:
+                return self.read_measurements([], [])
+        station_ids = sorted(set(station_ids))
+
+        category_names, fieldnames = self.get_projection(fields, quality)
+
+        # Find stations missing records at given timestamps, or at the
+        # boundaries of the range.
+        timestamp_format = self.get_timestamp_format()
+        values = sorted(set(int(value.strftime(timestamp_format)) for value in window))
+        present = {}
+        for station_id, value in self.read_measurements(
+            station_ids, category_names, datetimes=values, fields=[], row_mode="tuple"
+        ):
+            present.setdefault(station_id, set()).add(value)
+        missing = [
+            station_id for station_id in station_ids if present.get(station_id) != set(values)
+        ]
+
+        # Import missing data of all stations at once.
+        tasks = []
+        for station_id in missing:
+            categories = self.get_covered_categories(station_id, window[0], window[-1])
+            for category in self.categories:
+                if category["name"] not in category_names:
+                    continue
+                if categories is None or category["name"] in categories:
+                    tasks.append((station_id, category))
+        if tasks:
+            log.info(
+                "Importing measurements for {} of {} stations".format(len(missing), len(station_ids))
+            )
+            timeranges = self.get_timeranges(window[0], window[-1])
+            days = (int(window[0].strftime("%Y%m%d")), int(window[-1].strftime("%Y%m%d")))
+            self.import_tasks(tasks, timeranges, days)
+            self.cdc.log_cache_stats()
+
+        if timestamps is None:
+            return self.read_measurements(
+                station_ids,
+                category_names,
+                start=int(start.strftime(timestamp_format)),
+                end=int(end.strftime(timestamp_format)),
+                fields=fieldnames,
+            )
+        return self.read_measurements(
+            station_ids, category_names, datetimes=values, fields=fieldnames
+        )
+
+    def read_measurements(
+        self,
+        station_ids,
+        category_names,
+        datetimes=None,
+        start=None,
+        end=None,
+        fields=None,
+        row_mode=None,
+    ):
+        """
+        Read records of given stations and categories, either for a
+        list of integer timestamps, or for all timestamps between
+        ``start`` and ``end``, using a single query. Uses range scans
+        on the primary key of each category table.
+
+        Returns an iterable ``Rows`` result, emitting rows in the given
+        ``row_mode``, defaulting to the row mode of this instance.
+        """
+        columns = self.get_measurement_columns(category_names, fields)
+        if not category_names or not station_ids:
+            return Rows(self.db, None, None, columns, mode=row_mode or self.row_mode)
+        params = {}
+        for index, station_id in enumerate(station_ids):
+            params["station_%d" % index] = station_id
+        where = "station_id IN ({})".format(", ".join(":" + name for name in params))
+        if datetimes is None:
+            where += " AND datetime BETWEEN :start AND :end"
+            params.update(start=start, end=end)
+        else:
+            names = []
+            for index, value in enumerate(datetimes):
+                names.append(":datetime_%d" % index)
+                params["datetime_%d" % index] = value
+            where += " AND datetime IN ({})".format(", ".join(names))
+        sql = self.get_measurement_sql(category_names, where=where, fields=fields)
+        sql += " ORDER BY k.station_id, k.datetime"
+        return Rows(
+            self.db, sql, params, columns, mode=row_mode or self.row_mode, batch_size=self.batch_size
+        )
+
+    def get_timeranges(self, timestamp, end=None):
+        """
+        Compute timerange labels / subfolder names holding
+        measurements for given timestamp, or any time until ``end``.
+        """
+        timeranges = set()
+        for value in [timestamp, end or timestamp]:
+            age = (datetime.utcnow() - value).total_seconds() / 86400
+            if age < 1:
+                timeranges.add("now")
+            elif age < 360:
+                timeranges.add("recent")
+            elif age >= 360 and age <= 370:
+                timeranges.update(["recent", "historical"])
+            else:
+                timeranges.add("historical")
+
+        # Window spans all timeranges.
+        if "now" in timeranges and "historical" in timeranges:
+            timeranges.add("recent")
+
+        return [timerange for timerange in ["now", "recent", "historical"] if timerange in timeranges]
+
+    def get_async(self):
+        if self.aio is None:
+            self.aio = DwdAsync(self)
+        return self.aio
+
+    async def aquery(self, station_id, timestamp, fields=None, quality=True):
+        """
+        Asynchronous variant of ``query``, which does not block the event loop.
+        Needs aiohttp, see ``dwdweather.aio``.
+        """
+        return await self.get_async().query(station_id, timestamp, fields=fields, quality=quality)
+
+    async def astations(self):
+        """
+        Asynchronous variant of ``stations``.
+        """
+        return await self.get_async().stations()
+
+    async def anearest_station(self, lon, lat, surrounding=False, timestamp=None):
+        """
+        Asynchronous variant of ``nearest_station``.
+        """
+        return await self.get_async().nearest_station(lon, lat, surrounding, timestamp)
+
+    async def aclose(self):
+        """
+        Release resources of the asynchronous interface.
+        """
+        if self.aio is not None:
+            await self.aio.close()
+            self.aio = None
+
     def haversine_distance(self, origin, destination):
         lon1, lat1 = origin
         lon2, lat2 = destination
@@ -579,6 +1446,17 @@ class DwdWeather:
         """
         Return list of dicts with all stations.
         """
+        out = self.load_stations()
+        if len(out) == 0:
+            # cache miss - have to import stations.
+            self.import_stations()
+            out = self.stations()
+        return out
+
+    def load_stations(self):
+        """
+        Return list of dicts with all stations from the cache database.
+        """
         out = []
         table = self.get_stations_table()
         sql = """
@@ -592,10 +1470,6 @@ class DwdWeather:
         for row in c.execute(sql):
             out.append(row)
         c.close()
-        if len(out) == 0:
-            # cache miss - have to import stations.
-            self.import_stations()
-            out = self.stations()
         return out
 
     def station_info(self, station_id):
@@ -605,7 +1479,7 @@ class DwdWeather:
         c.execute(sql, (station_id,))
         return c.fetchone()
 
-    def nearest_station(self, lon, lat, surrounding=False):
+    def nearest_station(self, lon, lat, surrounding=False, timestamp=None):
         """
         Select most current stations datasets.
 
@@ -621,6 +1495,10 @@ class DwdWeather:
                 distance, and returns a list with all stations inside this zone
                 (instead of just one station)
 
+            timestamp : datetime
+                only consider stations having data of any selected
+                category at this time, according to their coverage
+
         Example:
         --------
 
@@ -630,9 +1508,29 @@ class DwdWeather:
 
         """
 
+        stations = self.stations()
+        if timestamp is not None:
+            stations = self.filter_covering_stations(stations, timestamp)
+        return self.find_nearest_station(stations, lon, lat, surrounding)
+
+    def filter_covering_stations(self, stations, timestamp):
+        """
+        Select stations which have data of any selected category
+        on the day of ``timestamp``.
+        """
+        station_ids = self.get_covering_stations(timestamp)
+        if station_ids is None:
+            return stations
+        return [station for station in stations if station["station_id"] in station_ids]
+
+    def find_nearest_station(self, stations, lon, lat, surrounding=False):
+        """
+        Select station closest to given location from list of stations,
+        see ``nearest_station``.
+        """
         closest = None
         closest_distance = 99999999999
-        for station in self.stations():
+        for station in stations:
             d = self.haversine_distance(
                 (lon, lat), (station["geo_lon"], station["geo_lat"])
             )
@@ -644,7 +1542,7 @@ class DwdWeather:
             closest1 = []
             closest_distance = closest_distance+surrounding
             i = 0
-            for station in self.stations():
+            for station in stations:
                 d = self.haversine_distance(
                     (lon, lat), (station["geo_lon"], station["geo_lat"])
                 )
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# (c) 2014 Marian Steinbach, MIT licensed
+# (c) 2018-2019 Andreas Motl, MIT licensed
+import time
+import logging
+import threading
+from queue import Full, Queue
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+from dwdweather.util import chunked
+
+"""
+Mirror measurements of whole categories across all stations.
+
+Each folder on the CDC server is listed only once. Archives are bulk-loaded
+into staging tables without indexes, which get merged into the
+``measures_<resolution>_<category>`` tables at the end. The state of each archive is
+recorded, so an interrupted run will resume where it stopped.
+"""
+
+log = logging.getLogger(__name__)
+
+# Order of timeranges when merging records contained in multiple archives.
+# Like when importing, quality controlled historical data wins.
+TIMERANGES = ["now", "recent", "historical"]
+
+
+class DwdMirror:
+    """
+    Mirror measurements for all stations, optionally filtered by
+    station ids or a bounding box.
+    """
+
+    def __init__(self, dwd):
+
+        # Client object, providing configuration and access to the CDC server.
+        self.dwd = dwd
+
+    def get_state_table(self):
+        return "mirror_%s" % self.dwd.resolution
+
+    def get_staging_table(self, category_name):
+        return "mirror_%s_%s" % (self.dwd.resolution, category_name)
+
+    def get_categories(self):
+        return [
+            category for category in self.dwd.categories if category["name"] in self.dwd.fields
+        ]
+
+    def run(self, timeranges, station_ids=None, bbox=None, resume=True):
+        """
+        Download and import all archives of the selected categories and timeranges.
+        Returns the number of imported rows.
+        """
+        self.setup(resume)
+
+        stations = self.select_stations(station_ids, bbox)
+        archives = self.find_archives(timeranges, stations)
+        pending = self.register_archives(archives)
+        log.info(
+            "Mirroring {} archives, {} of them pending".format(len(archives), len(pending))
+        )
+
+        with self.dwd.checkpointing():
+            rowcount = self.load(pending)
+            self.merge()
+        return rowcount
+
+    def setup(self, resume):
+        """
+        Create state and staging tables. When resuming, rows of
+        unfinished archives will be discarded, otherwise all state
+        of an interrupted run will be discarded.
+        """
+        db = self.dwd.db
+        state_table = self.get_state_table()
+        if not resume:
+            db.execute("DROP TABLE IF EXISTS {}".format(state_table))
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS {table}
+            (
+                archive_id integer PRIMARY KEY,
+                uri text UNIQUE,
+                category text,
+                timerange text,
+                size int,
+                modified int,
+                etag text,
+                last_modified text,
+                content_hash text,
+                rowcount int,
+                finished int DEFAULT 0
+            )""".format(
+                table=state_table
+            )
+        )
+
+        for category in self.get_categories():
+            staging_table = self.get_staging_table(category["name"])
+            if not resume:
+                db.execute("DROP TABLE IF EXISTS {}".format(staging_table))
+            create_fields = [
+                "%s %s" % (fieldname, fieldtype)
+                for fieldname, fieldtype in self.dwd.fields[category["name"]]
+            ]
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS {table} ({sql_fields}, station_id int, datetime int, archive_id int)".format(
+                    table=staging_table, sql_fields=", ".join(create_fields)
+                )
+            )
+            db.execute(
+                "DELETE FROM {table} WHERE archive_id NOT IN (SELECT archive_id FROM {state_table} WHERE finished=1)".format(
+                    table=staging_table, state_table=state_table
+                )
+            )
+        db.commit()
+
+    def select_stations(self, station_ids=None, bbox=None):
+        """
+        Compute set of station ids to mirror, ``None`` means all stations.
+        ``bbox`` is a tuple of ``(lon_min, lat_min, lon_max, lat_max)``.
+        """
+        stations = None
+        if station_ids:
+            stations = set(station_ids)
+        if bbox:
+            lon_min, lat_min, lon_max, lat_max = bbox
+            selected = set(
+                station["station_id"]
+                for station in self.dwd.stations()
+                if lon_min <= station["geo_lon"] <= lon_max
+                and lat_min <= station["geo_lat"] <= lat_max
+            )
+            stations = selected if stations is None else stations & selected
+        return stations
+
+    def find_archives(self, timeranges, stations=None):
+        """
+        List each folder once and collect all archives of the selected stations.
+        Returns list of ``(category, timerange, resource)`` tuples.
+        """
+        cdc = self.dwd.cdc
+        archives = []
+        for category in self.get_categories():
+            index_uris = []
+            for timerange in timeranges:
+                index_uri = cdc.get_index_uri(category, timerange)
+                if index_uri in index_uris:
+                    continue
+                index_uris.append(index_uri)
+                for station_id, resource in cdc.get_archive_index(category, timerange):
+                    if stations is None or station_id in stations:
+                        archives.append((category, timerange, resource))
+        return archives
+
+    def register_archives(self, archives):
+        """
+        Record archives in state table.
+        Returns list of ``(archive_id, category, resource)`` tuples for all unfinished archives.
+        """
+        db = self.dwd.db
+        state_table = self.get_state_table()
+        db.executemany(
+            "INSERT OR IGNORE INTO {table} (uri, category, timerange, modified) VALUES (?, ?, ?, ?)".format(
+                table=state_table
+            ),
+            [
+                (resource.uri, category["name"], timerange, resource.modified)
+                for category, timerange, resource in archives
+            ],
+        )
+        db.commit()
+
+        unfinished = {}
+        for row in db.execute(
+            "SELECT archive_id, uri FROM {table} WHERE finished=0".format(table=state_table)
+        ):
+            unfinished[row["uri"]] = row["archive_id"]
+
+        return [
+            (unfinished[resource.uri], category, resource)
+            for category, timerange, resource in archives
+            if resource.uri in unfinished
+        ]
+
+    def load(self, archives):
+        """
+        Download and decode archives concurrently and bulk-load them into
+        the staging tables. Returns the number of loaded rows.
+        """
+        dwd = self.dwd
+        queue = Queue(maxsize=dwd.workers * 4)
+
+        # Signal workers to stop when the writer has been interrupted.
+        stopping = threading.Event()
+
+        def put(item):
+            while not stopping.is_set():
+                try:
+                    queue.put(item, timeout=1)
+                    return
+                except Full:
+                    pass
+
+        def acquire(archive):
+            archive_id, category, resource = archive
+            uri = resource.uri
+            loaded = None
+            if stopping.is_set():
+                return
+            try:
+                log.info("Fetching resource {}".format(uri))
+                with dwd.cdc.open_download(
+                    uri, size=resource.size, modified=resource.modified
+                ) as (record, archive):
+                    for result in dwd.cdc.read_archive(category, uri, archive):
+                        for batch in chunked(dwd.decode_measures(result), dwd.batch_size):
+                            put((archive_id, category["name"], batch))
+                loaded = record
+            except Exception:
+                log.exception('Mirroring "{}" failed'.format(uri))
+            finally:
+                put((archive_id, category["name"], loaded))
+
+        rowcounts = {}
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=dwd.workers) as executor:
+            for archive in archives:
+                executor.submit(acquire, archive)
+            try:
+                failures = self.write(queue, len(archives), rowcounts)
+            except BaseException:
+                stopping.set()
+                raise
+
+        rowcount = sum(rowcounts.values())
+        duration = time.time() - started
+        log.info(
+            "Loaded {} rows from {} archives in {:.2f} seconds ({:.0f} rows/s)".format(
+                rowcount,
+                len(archives) - failures,
+                duration,
+                rowcount / duration if duration else rowcount,
+            )
+        )
+        if failures:
+            raise RuntimeError(
+                "Mirroring failed for {} archives, run again to resume".format(failures)
+            )
+        return rowcount
+
+    def write(self, queue, pending, rowcounts):
+        """
+        Write row batches from workers into the staging tables and record
+        the state of each archive, until all archives have been processed.
+        Finished archives are recorded along with their cache record.
+        Returns the number of failed archives.
+        """
+        dwd = self.dwd
+        state_table = self.get_state_table()
+        failures = 0
+        with tqdm(total=pending, ncols=79, unit=" archives") as progress:
+            while pending:
+                archive_id, category_name, item = queue.get()
+
+                # Bulk-load rows into staging table.
+                if isinstance(item, list):
+                    fieldnames = [
+                        fieldname for fieldname, fieldtype in dwd.fields[category_name]
+                    ]
+                    dwd.db.executemany(
+                        "INSERT INTO {table} ({fields}, station_id, datetime, archive_id) VALUES ({value_placeholders}, ?, ?, {archive_id})".format(
+                            table=self.get_staging_table(category_name),
+                            fields=", ".join(fieldnames),
+                            value_placeholders=", ".join(["?"] * len(fieldnames)),
+                            archive_id=int(archive_id),
+                        ),
+                        item,
+                    )
+                    rowcounts[archive_id] = rowcounts.get(archive_id, 0) + len(item)
+                    continue
+
+                # Archive has been processed completely.
+                pending -= 1
+                progress.update()
+                if item is not None:
+                    dwd.db.execute(
+                        "UPDATE {table} SET finished=1, rowcount=?, size=?, etag=?, last_modified=?, content_hash=? WHERE archive_id=?".format(
+                            table=state_table
+                        ),
+                        (
+                            rowcounts.get(archive_id, 0),
+                            item["size"],
+                            item["etag"],
+                            item["last_modified"],
+                            item["content_hash"],
+                            archive_id,
+                        ),
+                    )
+                else:
+                    failures += 1
+                    dwd.db.execute(
+                        "DELETE FROM {table} WHERE archive_id=?".format(
+                            table=self.get_staging_table(category_name)
+                        ),
+                        (archive_id,),
+                    )
+                    rowcounts.pop(archive_id, None)
+                dwd.db.commit()
+
+        return failures
+
+    def merge(self):
+        """
+        Merge staging tables into the ``measures_<resolution>_<category>`` tables and
+        discard the state of this run. The merged archives are recorded in the
+        manifest, so they will not be imported again.
+
+        Rows are written in the order of the primary key, so it gets
+        appended to instead of being updated randomly. For records
+        contained in multiple archives, the one from the latest timerange
+        in ``TIMERANGES`` wins, regardless of the loading order.
+        """
+        dwd = self.dwd
+        state_table = self.get_state_table()
+        priority = "CASE timerange {} END".format(
+            " ".join("WHEN '{}' THEN {}".format(timerange, index) for index, timerange in enumerate(TIMERANGES))
+        )
+        for category in self.get_categories():
+            category_name = category["name"]
+            staging_table = self.get_staging_table(category_name)
+            fieldnames = [fieldname for fieldname, fieldtype in dwd.fields[category_name]]
+            log.info('Merging "{}" data'.format(category_name.replace("_", " ")))
+            select = "SELECT {fields}, station_id, datetime FROM {table} JOIN {state_table} USING (archive_id) WHERE true ORDER BY station_id, datetime, {priority}, {table}.rowid".format(
+                fields=", ".join(fieldnames), table=staging_table, state_table=state_table, priority=priority
+            )
+            dwd.db.execute(dwd.get_upsert_sql(category_name, select=select))
+            records = dwd.db.execute(
+                "SELECT * FROM {table} WHERE category=? AND finished=1".format(table=state_table),
+                (category_name,),
+            ).fetchall()
+            for record in records:
+                dwd.update_manifest(record, status="complete")
+            dwd.db.execute("DROP TABLE {}".format(staging_table))
+            dwd.db.commit()
+
+        dwd.db.execute("DROP TABLE {}".format(self.get_state_table()))
+        dwd.db.commit()
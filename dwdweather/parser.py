@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+import io
+import logging
+import calendar
+import functools
+from collections import OrderedDict
+
+from dateutil.parser import parse as parsedate
+
+from dwdweather.knowledge import DwdCdcKnowledge
+
+"""
+Decoders for the semicolon-separated ``produkt_*.txt`` files and the
+fixed-width station lists from the DWD Climate Data Center (CDC).
+"""
+
+log = logging.getLogger(__name__)
+
+# Number of digits of the integer timestamp keys, by timestamp format.
+TIMESTAMP_WIDTHS = {
+    "%Y%m%d": 8,
+    "%Y%m%d%H": 10,
+    "%Y%m%d%H%M": 12,
+}
+
+# Number of days of each month in common years.
+MONTH_DAYS = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+
+def parse_timestamp(timestamp_raw, timestamp_format):
+    """
+    Parse raw ``MESS_DATUM`` value using dateutil and reformat it
+    into the integer representation of the given timestamp format.
+
+    This is the slow but lenient path, which is used as a fallback
+    for all values the fast decoder will not accept.
+    """
+    timestamp_sanitized = timestamp_raw.replace("T", "").replace(":", "")
+
+    # If timestamp lacks minutes (like 2018112922),
+    # let's add them to make the datetime parser happy.
+    if len(timestamp_sanitized) == 10:
+        timestamp_sanitized += "00"
+
+    # Run sanitized timestamp through datatime parser
+    # and reformat it into the appropriate format.
+    timestamp_datetime = parsedate(timestamp_sanitized, ignoretz=True)
+    return int(timestamp_datetime.strftime(timestamp_format))
+
+
+@functools.lru_cache(maxsize=None)
+def get_timestamp_decoder(timestamp_format):
+    """
+    Return a function decoding raw ``MESS_DATUM`` values into integer
+    timestamps of the given format, like ``2020060108`` for ``%Y%m%d%H``.
+
+    The decoder uses integer math on all-digit values of 8, 10, 12 or 14
+    characters and hands everything else over to ``parse_timestamp``.
+    """
+    width = TIMESTAMP_WIDTHS.get(timestamp_format)
+    if width is None:
+        return functools.partial(parse_timestamp, timestamp_format=timestamp_format)
+
+    # Divisors for splitting off the date part, the divisor for splitting
+    # off the minutes and the factor for rescaling to the target width.
+    layouts = {}
+    for length in (8, 10, 12, 14):
+        time_digits = length - 8
+        if length >= width:
+            scale = (10 ** (length - width), 1)
+        else:
+            scale = (1, 10 ** (width - length))
+        layouts[length] = (10 ** time_digits, 10 ** max(time_digits - 2, 0)) + scale
+
+    def decode(timestamp_raw):
+        value = timestamp_raw
+        if not value.isdigit():
+            value = value.replace("T", "").replace(":", "")
+            if not value.isdigit():
+                return parse_timestamp(timestamp_raw, timestamp_format)
+
+        layout = layouts.get(len(value))
+        if layout is None:
+            return parse_timestamp(timestamp_raw, timestamp_format)
+        date_divisor, hour_divisor, divisor, factor = layout
+
+        number = int(value)
+        date, time = divmod(number, date_divisor)
+
+        # Validate date and time components, otherwise
+        # let the datetime parser decide about the value.
+        year, month_day = divmod(date, 10000)
+        month, day = divmod(month_day, 100)
+        if not 1 <= month <= 12 or not 1 <= day <= 28 and (
+            day < 1 or day > calendar.monthrange(year, month)[1]
+        ):
+            return parse_timestamp(timestamp_raw, timestamp_format)
+        if date_divisor > 1:
+            hour, minute_second = divmod(time, hour_divisor)
+            if hour > 23 or minute_second % 100 > 59 or minute_second // 100 > 59:
+                return parse_timestamp(timestamp_raw, timestamp_format)
+
+        return number // divisor * factor
+
+    return decode
+
+
+# Missing values are marked as -999.
+MISSING = -999
+
+
+def decode_real(cell):
+    value = float(cell)
+    if value == MISSING:
+        return None
+    return value
+
+
+def decode_int(cell):
+    value = int(float(cell))
+    if value == MISSING:
+        return None
+    return value
+
+
+def decode_datetime(cell):
+    value = int(cell.replace("T", "").replace(":", ""))
+    if value == MISSING:
+        return None
+    return value
+
+
+def decode_str(cell):
+    value = cell.strip()
+    if value == "-999":
+        return None
+    return value
+
+
+# Converter functions by field type, all other types are decoded as strings.
+CONVERTERS = {
+    "real": decode_real,
+    "int": decode_int,
+    "datetime": decode_datetime,
+}
+
+
+def compile_row_decoder(fields, timestamp_format):
+    """
+    Compile a function which decodes a single line of a ``produkt_*``
+    file into a tuple of SQL parameters.
+
+    The tuple contains the values of all ``fields`` in the order of the
+    knowledge base definition, followed by "station_id" and "datetime".
+    The generated code performs no lookups or type comparisons per cell.
+    """
+    namespace = {"decode_timestamp": get_timestamp_decoder(timestamp_format)}
+    cells = []
+    for index, (fieldname, fieldtype) in enumerate(fields):
+        converter = "decode_%d" % index
+        namespace[converter] = CONVERTERS.get(fieldtype, decode_str)
+        cells.append("{}(parts[{}])".format(converter, index + 2))
+    cells.append("int(parts[0])")
+    cells.append("decode_timestamp(parts[1].strip())")
+
+    source = "def decode(line):\n    parts = line.split(';')\n    return ({},)\n".format(
+        ", ".join(cells)
+    )
+    exec(source, namespace)
+    return namespace["decode"]
+
+
+@functools.lru_cache(maxsize=None)
+def get_row_decoder(resolution, category_name):
+    """
+    Return compiled row decoder for given resolution and category.
+    """
+    knowledge = DwdCdcKnowledge.climate.get_resolution_by_name(resolution)
+    fields = getattr(knowledge, category_name)
+    return compile_row_decoder(fields, knowledge.__timestamp_format__)
+
+
+def import_numpy():
+    """
+    Import NumPy, which is an optional dependency.
+    """
+    try:
+        import numpy
+    except ImportError:  # pragma: no cover
+        raise ImportError(
+            'NumPy is not installed, please install it using "pip install dwdweather2[numpy]"'
+        )
+    return numpy
+
+
+class MeasurementColumns:
+    """
+    Typed column arrays of a whole ``produkt_*`` file.
+
+    ``station_id`` and ``datetime`` are ``int64`` arrays, ``columns`` maps
+    each field name to an array. Numeric and datetime fields are ``float64``
+    arrays with missing values masked as NaN, all other fields are object
+    arrays with missing values masked as ``None``.
+    """
+
+    def __init__(self, fields, station_id, datetime, columns):
+        self.fields = fields
+        self.station_id = station_id
+        self.datetime = datetime
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.datetime)
+
+    def iter_rows(self):
+        """
+        Yield rows of SQL parameters like the compiled row decoders,
+        with masked values converted to ``None``.
+        """
+        np = import_numpy()
+        columns = []
+        for fieldname, fieldtype in self.fields:
+            column = self.columns[fieldname]
+            if column.dtype.kind == "f":
+                mask = np.isnan(column)
+                if fieldtype == "real":
+                    column = column.astype(object)
+                else:
+                    column = np.where(mask, 0, column).astype(np.int64).astype(object)
+                column[mask] = None
+            columns.append(column)
+        columns.append(self.station_id.astype(object))
+        columns.append(self.datetime.astype(object))
+        return zip(*columns)
+
+    def to_dataframe(self):
+        """
+        Return columns as ``pandas.DataFrame``.
+        """
+        import pandas
+
+        data = OrderedDict()
+        data["station_id"] = self.station_id
+        data["datetime"] = self.datetime
+        data.update(self.columns)
+        return pandas.DataFrame(data)
+
+
+def parse_columns(text, resolution, category_name):
+    """
+    Parse content of a ``produkt_*`` file into ``MeasurementColumns``
+    in one pass, using the vectorized text reader of NumPy.
+
+    Raises ``ValueError`` when the content does not have a regular
+    layout. In this case, callers should fall back to the row decoders,
+    which are able to handle irregular lines individually.
+    """
+    np = import_numpy()
+
+    knowledge = DwdCdcKnowledge.climate.get_resolution_by_name(resolution)
+    fields = getattr(knowledge, category_name)
+    width = TIMESTAMP_WIDTHS[knowledge.__timestamp_format__]
+
+    # Read station id, timestamp and all fields, but not the "eor" marker.
+    # Timestamps like "2020051908:00" are read as plain numbers.
+    dtype = [("station_id", np.int64), ("datetime", np.int64)]
+    for fieldname, fieldtype in fields:
+        if fieldtype in CONVERTERS:
+            dtype.append((fieldname, np.float64))
+        else:
+            dtype.append((fieldname, "U32"))
+    table = np.loadtxt(
+        io.StringIO(text.replace(":", "").replace("\x1a", "")),
+        dtype=dtype,
+        delimiter=";",
+        skiprows=1,
+        usecols=range(len(dtype)),
+        ndmin=1,
+    )
+
+    # Rescale timestamps to the width of the timestamp format of this
+    # resolution, e.g. "2018112922" in 10-minute data gets padded.
+    datetime = table["datetime"]
+    for length in range(8, 15):
+        selection = (datetime >= 10 ** (length - 1)) & (datetime < 10 ** length)
+        if length > width:
+            datetime[selection] //= 10 ** (length - width)
+        elif length < width:
+            datetime[selection] *= 10 ** (width - length)
+
+    # Validate timestamps, including the length of each month.
+    date, time = np.divmod(datetime, 10 ** (width - 8))
+    year = date // 10000
+    month = date // 100 % 100
+    day = date % 100
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = np.array(MONTH_DAYS)[np.clip(month, 1, 12) - 1] + (leap & (month == 2))
+    if not (
+        np.all((datetime >= 10 ** (width - 1)) & (datetime < 10 ** width))
+        and np.all((month >= 1) & (month <= 12) & (day >= 1) & (day <= month_days))
+        and np.all(time // 10 ** max(width - 10, 0) % 100 <= 23)
+        and np.all(time % 100 <= 59)
+    ):
+        raise ValueError("Invalid timestamps")
+
+    columns = OrderedDict()
+    for fieldname, fieldtype in fields:
+        column = table[fieldname]
+        if column.dtype.kind == "f":
+            column[column == MISSING] = np.nan
+        else:
+            column = np.char.strip(column).astype(object)
+            column[column == "-999"] = None
+        columns[fieldname] = column
+
+    return MeasurementColumns(fields, table["station_id"], datetime, columns)
+
+
+def decode_lines(lines, resolution, category_name):
+    """
+    Decode lines of a ``produkt_*`` file using the compiled row decoder.
+
+    The header line is skipped, lines which can not be decoded
+    will be reported and skipped.
+    """
+
+    # Select row decoder for this resolution and category.
+    decode_row = get_row_decoder(resolution, category_name)
+
+    count = 0
+    for line in lines:
+        count += 1
+
+        # Skip header line.
+        if count == 1:
+            continue
+
+        line = line.strip()
+        if line == "" or line == "\x1a":
+            continue
+
+        try:
+            yield decode_row(line)
+        except Exception as ex:
+            log.error('Decoding line {} "{}" failed: {}'.format(count, line, ex))
+
+
+def decode_result(result, resolution, parser="python"):
+    """
+    Decode payload of a ``DwdCdcResult`` into rows of SQL parameters.
+
+    With the "numpy" parser, the whole file is parsed into typed column
+    arrays at once. It falls back to decoding line by line when the file
+    has an irregular layout.
+    """
+    category_name = result.category["name"]
+    if parser == "numpy":
+        try:
+            columns = parse_columns(
+                result.payload.decode("latin-1"), resolution, category_name
+            )
+            return columns.iter_rows()
+        except ValueError as ex:
+            log.warning(
+                'Vectorized parsing of "{}" failed, falling back to line-by-line parsing: {}'.format(
+                    result.uri, ex
+                )
+            )
+    return decode_lines(result.iter_lines(), resolution, category_name)
+
+
+def decode_stations(payload):
+    """
+    Decode the content of a ``*_Beschreibung_Stationen.txt`` file into
+    tuples of (station_id, date_start, date_end, geo_lon, geo_lat,
+    height, name, state).
+
+    The numeric columns are separated by whitespace, while the station
+    name may contain spaces. The number of columns following the name,
+    like "Bundesland" and "Abgabe", is determined once from the header.
+    """
+    lines = payload.decode("latin-1").splitlines()
+    if not lines:
+        return
+    trailing = max(len(lines[0].split()) - 7, 1)
+
+    # Skip header and separator lines.
+    for number, line in enumerate(lines[2:], 3):
+        line = line.strip()
+        if line == "" or line == "\x1a":
+            continue
+        try:
+            parts = line.split(None, 6)
+            name, state = parts[6].rsplit(None, trailing)[:2]
+            yield (
+                int(parts[0]),
+                int(parts[1]),
+                int(parts[2]),
+                float(parts[5]),
+                float(parts[4]),
+                int(parts[3]),
+                name,
+                state,
+            )
+        except (ValueError, IndexError) as ex:
+            log.error('Decoding station line {} "{}" failed: {}'.format(number, line, ex))
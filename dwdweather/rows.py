@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# (c) 2014 Marian Steinbach, MIT licensed
+# (c) 2018-2019 Andreas Motl, MIT licensed
+import logging
+from functools import lru_cache
+
+from dwdweather.parser import CONVERTERS, import_numpy
+
+"""
+Row modes for reading measurements in bulk.
+
+Instead of building a dict for each row, bulk readers can emit:
+
+- "tuple": Plain tuples, the column names are shared by all rows
+  through the ``names`` attribute of the result.
+- "record": Instances of a ``Record`` class with ``__slots__`` for
+  the columns, accessed as attributes.
+- "numpy": NumPy structured arrays, one for each batch of rows
+  fetched from the database.
+
+Integer timestamps can be converted to ``datetime64`` arrays using
+``to_datetime64``, based on the timestamp format of the resolution.
+"""
+
+log = logging.getLogger(__name__)
+
+ROW_MODES = ["dict", "tuple", "record", "numpy"]
+
+
+# Number of digits and ``timedelta64`` unit of the directives
+# used by timestamp formats, in the order of significance.
+TIMESTAMP_DIRECTIVES = [("%Y", 4, "Y"), ("%m", 2, "M"), ("%d", 2, "D"), ("%H", 2, "h"), ("%M", 2, "m")]
+
+
+def import_pandas():
+    """
+    Import pandas, which is an optional dependency.
+    """
+    try:
+        import pandas
+    except ImportError:  # pragma: no cover
+        raise ImportError(
+            'pandas is not installed, please install it using "pip install dwdweather2[pandas]"'
+        )
+    return pandas
+
+
+def to_datetime64(values, timestamp_format):
+    """
+    Convert array of integer timestamps like ``2020060108`` into a
+    ``datetime64[m]`` array, using integer arithmetic on the digits
+    selected by the ``strftime``-style ``timestamp_format``.
+    """
+    np = import_numpy()
+    directives = [item for item in TIMESTAMP_DIRECTIVES if item[0] in timestamp_format]
+    if timestamp_format != "".join(directive for directive, width, unit in directives):
+        raise ValueError('Unsupported timestamp format "{}"'.format(timestamp_format))
+
+    values = np.asarray(values, dtype=np.int64)
+    components = []
+    for directive, width, unit in reversed(directives):
+        components.insert(0, values % 10 ** width)
+        values = values // 10 ** width
+
+    result = (components[0] - 1970).astype("datetime64[Y]").astype("datetime64[m]")
+    for (directive, width, unit), component in zip(directives[1:], components[1:]):
+        if unit in ["M", "D"]:
+            component = component - 1
+        if unit == "M":
+            result = result.astype("datetime64[M]") + component.astype("timedelta64[M]")
+        else:
+            result = result + component.astype("timedelta64[{}]".format(unit))
+    return result.astype("datetime64[m]")
+
+
+def check_row_mode(mode):
+    if mode not in ROW_MODES:
+        raise ValueError(
+            'Unknown row mode "{}", choose one of {}'.format(mode, ", ".join(ROW_MODES))
+        )
+    if mode == "numpy":
+        import_numpy()
+    return mode
+
+
+class Record:
+    """
+    Base class of records having one slot for each column.
+    """
+
+    __slots__ = ()
+
+    def __iter__(self):
+        for name in self.__slots__:
+            yield getattr(self, name)
+
+    def __eq__(self, other):
+        if not isinstance(other, Record):
+            return NotImplemented
+        return self.__slots__ == other.__slots__ and tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return "Record({})".format(
+            ", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__)
+        )
+
+    def as_dict(self):
+        return dict(zip(self.__slots__, self))
+
+
+@lru_cache(maxsize=64)
+def get_record_class(names):
+    """
+    Create ``Record`` class for given tuple of column names.
+
+    The constructor takes the values positionally and assigns them
+    using a generated function, which is considerably faster than
+    looping over the slots for each row.
+    """
+    for name in names:
+        if not name.isidentifier():
+            raise ValueError('Invalid column name "{}"'.format(name))
+    code = "def __init__(self, {args}):\n    {assignments}\n".format(
+        args=", ".join(names),
+        assignments="\n    ".join("self.{0} = {0}".format(name) for name in names) or "pass",
+    )
+    namespace = {}
+    exec(code, namespace)
+    return type("Record", (Record,), {"__slots__": names, "__init__": namespace["__init__"]})
+
+
+class Rows:
+    """
+    Result of a bulk read, iterating over rows in the given row mode.
+
+    ``columns`` is a list of ``(name, type)`` tuples, with types from the
+    knowledge base. The query is run each time the result is iterated.
+    """
+
+    def __init__(self, db, sql, params, columns, mode="dict", batch_size=5000):
+        self.db = db
+        self.sql = sql
+        self.params = params
+        self.columns = columns
+        self.mode = check_row_mode(mode)
+        self.batch_size = batch_size
+
+    @property
+    def names(self):
+        return tuple(name for name, fieldtype in self.columns)
+
+    @property
+    def dtype(self):
+        """
+        Data type of structured arrays. Keys are ``int64``, numeric and
+        datetime fields are ``float64`` with NULL values as NaN, all other
+        fields are objects with NULL values as ``None``.
+        """
+        np = import_numpy()
+        dtype = []
+        for name, fieldtype in self.columns:
+            if name in ["station_id", "datetime"]:
+                dtype.append((name, np.int64))
+            elif fieldtype in CONVERTERS:
+                dtype.append((name, np.float64))
+            else:
+                dtype.append((name, object))
+        return np.dtype(dtype)
+
+    def to_array(self):
+        """
+        Read all rows into a single structured array.
+        """
+        np = import_numpy()
+        rows = Rows(self.db, self.sql, self.params, self.columns, "numpy", self.batch_size)
+        arrays = list(rows)
+        if not arrays:
+            return np.empty(0, dtype=self.dtype)
+        return np.concatenate(arrays)
+
+    def __iter__(self):
+        if self.sql is None:
+            return
+        c = self.db.cursor()
+        c.row_factory = None
+        try:
+            c.execute(self.sql, self.params)
+            if self.mode == "tuple":
+                yield from c
+            elif self.mode == "dict":
+                names = self.names
+                for row in c:
+                    yield dict(zip(names, row))
+            elif self.mode == "record":
+                record_class = get_record_class(self.names)
+                for row in c:
+                    yield record_class(*row)
+            elif self.mode == "numpy":
+                np = import_numpy()
+                dtype = self.dtype
+                while True:
+                    batch = c.fetchmany(self.batch_size)
+                    if not batch:
+                        break
+                    yield np.array(batch, dtype=dtype)
+        finally:
+            c.close()
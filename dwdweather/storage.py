@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# (c) 2014 Marian Steinbach, MIT licensed
+# (c) 2018-2019 Andreas Motl, MIT licensed
+import sqlite3
+import logging
+import threading
+
+"""
+Storage profiles for the SQLite cache database.
+
+A profile selects journal mode, synchronous level, page cache size,
+memory-mapped I/O and temporary storage of each connection:
+
+- "safe": Rollback journal with full fsync, e.g. for network filesystems.
+- "serve": Write-ahead log, so imports do not block readers in other
+  processes, with fsync on checkpoints only.
+- "bulk-load": Write-ahead log without fsync and with large caches, for
+  long imports. Commits do not checkpoint, this is done periodically from
+  a background thread instead.
+"""
+
+log = logging.getLogger(__name__)
+
+STORAGE_PROFILES = {
+    "safe": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+    },
+    "serve": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+    "bulk-load": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -262144,
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+        "wal_autocheckpoint": 0,
+        "checkpoint_interval": 5,
+    },
+}
+
+# Settings applied using PRAGMA statements, in this order.
+PRAGMAS = ["journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "wal_autocheckpoint"]
+
+
+def get_storage_profile(name):
+    try:
+        return STORAGE_PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            'Unknown storage profile "{}", choose one of {}'.format(
+                name, ", ".join(sorted(STORAGE_PROFILES))
+            )
+        )
+
+
+def apply_storage_profile(db, name):
+    """
+    Configure database connection according to the named storage profile.
+    """
+    profile = get_storage_profile(name)
+    for pragma in PRAGMAS:
+        if pragma not in profile:
+            continue
+        cursor = db.execute("PRAGMA {}={}".format(pragma, profile[pragma]))
+        if pragma == "journal_mode":
+            # Switching the journal mode fails while other connections are open.
+            journal_mode = cursor.fetchone()[0]
+            if journal_mode.upper() != profile[pragma]:
+                log.warning(
+                    'Could not switch journal mode to "{}", using "{}"'.format(
+                        profile[pragma], journal_mode
+                    )
+                )
+        cursor.close()
+
+
+class Checkpointer:
+    """
+    Run passive WAL checkpoints periodically from a background thread,
+    using its own connection, so commits of long imports do not stall
+    on them. Use as context manager around the import.
+    """
+
+    def __init__(self, path, interval=5):
+
+        # Path to the database file.
+        self.path = path
+
+        # Seconds between checkpoints.
+        self.interval = interval
+
+        # Number of completed checkpoints.
+        self.count = 0
+
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="checkpointer", daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        db = sqlite3.connect(self.path)
+        try:
+            while not self.stopping.wait(self.interval):
+                self.checkpoint(db)
+            self.checkpoint(db)
+        finally:
+            db.close()
+
+    def checkpoint(self, db):
+        try:
+            busy, log_frames, checkpointed = db.execute(
+                "PRAGMA wal_checkpoint(PASSIVE)"
+            ).fetchone()
+            self.count += 1
+            log.debug(
+                "Checkpointed {} of {} WAL frames".format(checkpointed, log_frames)
+            )
+        except sqlite3.Error as ex:
+            log.warning("Checkpoint failed: {}".format(ex))
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 import sys
 import logging
+import calendar
 import argparse
+import itertools
+from collections import namedtuple
+
+import bs4
 import htmllistparse
 
 
@@ -20,12 +25,43 @@ def float_range(min, max):
     return check_range
 
 
-def fetch_html_file_list(baseurl, extension):
+# Resource listed within a directory index of the CDC server. "modified"
+# is a Unix timestamp, both "modified" and "size" are None if not listed.
+# "date_from" and "date_to" are the integer dates of the time span
+# covered by a measurement archive, if encoded into its file name.
+DwdCdcResource = namedtuple(
+    "DwdCdcResource",
+    ["uri", "modified", "size", "date_from", "date_to"],
+    defaults=(None, None),
+)
+
 
-    cwd, listing = htmllistparse.fetch_listing(baseurl, timeout=10)
+def parse_html_file_list(baseurl, html, extension):
+    """
+    Parse HTML directory index and return list of ``(uri, modified, size)``
+    tuples. ``modified`` is a Unix timestamp, both ``modified``
+    and ``size`` are ``None`` if not listed.
+    """
+    cwd, listing = htmllistparse.parse(bs4.BeautifulSoup(html, "html5lib"))
     result = [
-        baseurl + "/" + item.name
+        (
+            baseurl + "/" + item.name,
+            calendar.timegm(item.modified) if item.modified else None,
+            item.size,
+        )
         for item in listing
         if item.name.endswith(extension)
     ]
     return result
+
+
+def chunked(iterable, size):
+    """
+    Split iterable into lists of at most ``size`` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
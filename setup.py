@@ -60,8 +60,12 @@ setup(
         "tqdm>=4.32",
         "python-dateutil>=2.8,<2.9",
         "requests>=2.22,<2.23",
-        "requests-cache>=0.5,<0.6",
         'htmllistparse>=0.5.2,<0.6.0',
     ],
+    extras_require={
+        "numpy": ["numpy>=1.23"],
+        "async": ["aiohttp>=3.6"],
+        "pandas": ["numpy>=1.23", "pandas>=1.0"],
+    },
     entry_points={"console_scripts": ["dwdweather = dwdweather.commands:run"]},
 )
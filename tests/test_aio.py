@@ -0,0 +1,160 @@
+import io
+import os
+import asyncio
+from datetime import datetime
+from zipfile import ZipFile
+
+import pytest
+import requests
+
+from dwdweather.core import DwdWeather
+from tests.test_import import AIR_TEMPERATURE, SUN
+
+aiohttp = pytest.importorskip("aiohttp")
+
+
+STATIONS = b"""Stations_id von_datum bis_datum Stationshoehe geoBreite geoLaenge Stationsname Bundesland
+----------- --------- --------- ------------- --------- --------- ----------------------------------------- ----------
+00044 20070401 20200601             44     52.9336    8.2370 Gro\xdfenkneten                            Niedersachsen
+00073 20070401 20200601            374     48.6183   13.0620 Aldersbach-Kramersepp                    Bayern
+"""
+
+
+def make_listing(resources):
+    links = "".join(
+        '<a href="{name}">{name}</a>   26-Feb-2020 10:44    {size}\n'.format(
+            name=name, size=len(body)
+        )
+        for name, body in resources.items()
+    )
+    return "<html><body><pre>{}</pre></body></html>".format(links).encode()
+
+
+@pytest.fixture
+def dwd(tmp_path, server):
+    archive = io.BytesIO()
+    with ZipFile(archive, "w") as myzip:
+        myzip.writestr("produkt_tu_stunde_20070401_20200601_00044.txt", AIR_TEMPERATURE)
+
+    name = "stundenwerte_TU_00044_20070401_20200601_hist.zip"
+    server.resources["/air_temperature/historical"] = make_listing({name: archive.getvalue()})
+    server.resources["/air_temperature/historical/" + name] = archive.getvalue()
+
+    name = "TU_Stundenwerte_Beschreibung_Stationen.txt"
+    server.resources["/air_temperature/recent"] = make_listing({name: STATIONS})
+    server.resources["/air_temperature/recent/" + name] = STATIONS
+
+    dwd = DwdWeather(
+        resolution="hourly", category_names=["air_temperature"], cache_path=str(tmp_path)
+    )
+    dwd.cdc.uri = server.url
+    return dwd
+
+
+def test_aquery(dwd, server):
+    """
+    Test concurrent lookups share a single import.
+    """
+
+    async def main():
+        try:
+            return await asyncio.gather(
+                *[dwd.aquery(44, datetime(2020, 6, 1, hour)) for hour in [7, 8, 9] * 20]
+            )
+        finally:
+            await dwd.aclose()
+
+    results = asyncio.run(main())
+    assert results[1]["air_temperature_200"] == 15.3
+    assert results[2]["air_temperature_200"] is None
+    assert len(server.requests) == 2
+
+    # Synchronous interface sees imported data.
+    assert dwd.query(44, datetime(2020, 6, 1, 7))["air_temperature_200"] == 13.1
+
+
+def test_aquery_resume(dwd, server):
+    """
+    Test downloads interrupted before are resumed by the asynchronous client.
+    """
+    name = "stundenwerte_TU_00044_20070401_20200601_hist.zip"
+    path = "/air_temperature/historical/" + name
+
+    # Make archive large enough to be received in multiple chunks.
+    archive = io.BytesIO()
+    with ZipFile(archive, "w") as myzip:
+        myzip.writestr("produkt_tu_stunde_20070401_20200601_00044.txt", AIR_TEMPERATURE)
+        myzip.writestr("Metadaten.txt", os.urandom(1000000))
+    server.resources["/air_temperature/historical"] = make_listing({name: archive.getvalue()})
+    server.resources[path] = archive.getvalue()
+
+    # Interrupted download leaves a partial file.
+    server.faults[path] = 1
+    dwd.cdc.cache.retries = 0
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        dwd.cdc.cache.fetch(server.url + path)
+
+    async def main():
+        try:
+            return await dwd.aquery(44, datetime(2020, 6, 1, 8))
+        finally:
+            await dwd.aclose()
+
+    assert asyncio.run(main())["air_temperature_200"] == 15.3
+    assert dwd.cdc.cache.stats["resumed"] == 1
+    assert server.ranges[-1].startswith("bytes=")
+
+
+def test_aquery_coverage(tmp_path, server):
+    """
+    Test lookups skip archives not covering the timestamp, and lookups
+    of different fields do not share an import.
+    """
+    for category_name, key, payload in [("air_temperature", "TU", AIR_TEMPERATURE), ("sun", "SD", SUN)]:
+        resources = {}
+        for span in ["19950101_19991231", "20070401_20200601"]:
+            archive = io.BytesIO()
+            with ZipFile(archive, "w") as myzip:
+                myzip.writestr("produkt_{}_00044.txt".format(key.lower()), payload)
+            resources["stundenwerte_{}_00044_{}_hist.zip".format(key, span)] = archive.getvalue()
+        folder = "/{}/historical".format(category_name)
+        server.resources[folder] = make_listing(resources)
+        for name, body in resources.items():
+            server.resources[folder + "/" + name] = body
+
+    dwd = DwdWeather(
+        resolution="hourly", category_names=["air_temperature", "sun"], cache_path=str(tmp_path)
+    )
+    dwd.cdc.uri = server.url
+
+    async def main():
+        try:
+            return await asyncio.gather(
+                dwd.aquery(44, datetime(2020, 6, 1, 8), fields=["air_temperature_200"]),
+                dwd.aquery(44, datetime(2020, 6, 1, 8), fields=["sun_duration"]),
+            )
+        finally:
+            await dwd.aclose()
+
+    results = asyncio.run(main())
+    assert results[0]["air_temperature_200"] == 15.3
+    assert results[1]["sun_duration"] == 60.0
+    assert not [path for path in server.requests if "19950101" in path]
+
+
+def test_anearest_station(dwd, server):
+    """
+    Test stations are imported and looked up asynchronously.
+    """
+
+    async def main():
+        try:
+            stations = await dwd.astations()
+            nearest = await dwd.anearest_station(lon=13.0, lat=48.6)
+            return stations, nearest
+        finally:
+            await dwd.aclose()
+
+    stations, nearest = asyncio.run(main())
+    assert [station["station_id"] for station in stations] == [44, 73]
+    assert nearest["name"] == "Aldersbach-Kramersepp"
@@ -0,0 +1,295 @@
+import io
+import argparse
+import os
+import hashlib
+import time
+from zipfile import ZIP_DEFLATED, ZIP_LZMA, ZipFile
+
+import pytest
+import requests
+
+from dwdweather.cache import HttpCache, TtlPolicy
+from dwdweather.client import DwdCdcClient
+from dwdweather.commands import parse_ttl_rule
+
+
+def fetch(cache, uri, size=None):
+    buffer = io.BytesIO()
+    record = cache.fetch(uri, buffer, size=size)
+    return buffer.getvalue(), record
+
+
+def test_http_cache_revalidate(tmp_path, server):
+    """
+    Test expired responses are revalidated using conditional requests.
+    """
+    server.resources["/archive.zip"] = b"foo" * 1000
+    uri = server.url + "/archive.zip"
+
+    cache = HttpCache(str(tmp_path), requests.Session(), ttl=0)
+    body, record = fetch(cache, uri)
+    assert body == b"foo" * 1000
+    assert record["size"] == 3000
+    assert record["content_hash"] == hashlib.sha256(body).hexdigest()
+    assert cache.stats["bytes_downloaded"] == 3000
+
+    # Resource has not changed, body is served from the cache.
+    body, record = fetch(cache, uri)
+    assert body == b"foo" * 1000
+    assert cache.stats["revalidated"] == 1
+    assert cache.stats["bytes_saved"] == 3000
+
+    # Resource has changed, body is downloaded again.
+    server.resources["/archive.zip"] = b"bar"
+    body, record = fetch(cache, uri)
+    assert body == b"bar"
+    assert record["content_hash"] == hashlib.sha256(b"bar").hexdigest()
+    assert cache.stats["downloaded"] == 2
+    assert len(server.requests) == 3
+
+
+def test_http_cache_fresh(tmp_path, server):
+    """
+    Test fresh responses are served without asking the server.
+    """
+    server.resources["/listing/"] = b"<html></html>"
+    uri = server.url + "/listing/"
+
+    cache = HttpCache(str(tmp_path), requests.Session(), ttl=300)
+    assert fetch(cache, uri)[0] == b"<html></html>"
+    assert fetch(cache, uri)[0] == b"<html></html>"
+    assert cache.stats["fresh"] == 1
+    assert len(server.requests) == 1
+
+    with pytest.raises(requests.HTTPError):
+        fetch(cache, server.url + "/missing.zip")
+
+
+
+def test_http_cache_eviction(tmp_path, server):
+    """
+    Test blobs are shared by content and evicted least recently used first.
+    """
+    for name, body in [("a", b"a" * 1000), ("b", b"b" * 1000), ("c", b"c" * 1000)]:
+        server.resources["/{}.zip".format(name)] = body
+    server.resources["/a-copy.zip"] = b"a" * 1000
+
+    cache = HttpCache(str(tmp_path), requests.Session(), ttl=300, max_size=2500)
+    fetch(cache, server.url + "/a.zip")
+    record, fileobj = cache.open(server.url + "/a-copy.zip")
+    with fileobj:
+        assert fileobj.read() == b"a" * 1000
+        assert fileobj.name == cache.get_blob_path(record["content_hash"])
+    assert cache.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 1
+
+    fetch(cache, server.url + "/b.zip")
+    fetch(cache, server.url + "/a.zip")
+    fetch(cache, server.url + "/c.zip")
+    assert cache.stats["evicted"] == 1
+    assert cache.lookup(server.url + "/b.zip") is None
+    assert cache.lookup(server.url + "/a-copy.zip") is not None
+    assert not os.path.exists(cache.get_blob_path(hashlib.sha256(b"b" * 1000).hexdigest()))
+
+
+def test_http_cache_recompress(tmp_path, server):
+    """
+    Test ZIP archives are recompressed transparently.
+    """
+    payload = b"".join(b"%d;2020060108;    3;  13.1;eor\n" % index for index in range(10000))
+    archive = io.BytesIO()
+    with ZipFile(archive, "w", compression=ZIP_DEFLATED) as myzip:
+        myzip.writestr("produkt_tu_stunde.txt", payload)
+    server.resources["/archive.zip"] = archive.getvalue()
+
+    cache = HttpCache(str(tmp_path), requests.Session(), ttl=300, recompress=True)
+    record, fileobj = cache.open(server.url + "/archive.zip")
+    assert record["content_hash"] == hashlib.sha256(archive.getvalue()).hexdigest()
+    with ZipFile(fileobj) as myzip:
+        assert myzip.infolist()[0].compress_type == ZIP_LZMA
+        assert myzip.read("produkt_tu_stunde.txt") == payload
+    stored_size, recompressed = cache.db.execute(
+        "SELECT stored_size, recompressed FROM blobs"
+    ).fetchone()
+    assert recompressed == 1
+    assert stored_size < len(archive.getvalue())
+
+
+
+def test_http_cache_resume(tmp_path, server):
+    """
+    Test interrupted downloads are resumed using range requests.
+    """
+    body = os.urandom(1000000)
+    server.resources["/archive.zip"] = body
+    server.faults["/archive.zip"] = 2
+    uri = server.url + "/archive.zip"
+
+    cache = HttpCache(str(tmp_path), requests.Session(), ttl=0)
+    assert fetch(cache, uri, size=len(body))[0] == body
+    offsets = [int(value[6:-1]) for value in server.ranges[1:]]
+    assert server.ranges[0] is None
+    assert 0 < offsets[0] < offsets[1] < len(body)
+    assert cache.stats["resumed"] == 2
+    assert cache.stats["bytes_downloaded"] == len(body)
+    assert not os.listdir(os.path.join(str(tmp_path), "partial"))
+
+    # Give up after the configured number of retries.
+    server.resources["/archive.zip"] = body[::-1]
+    server.faults["/archive.zip"] = 3
+    cache.retries = 2
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        fetch(cache, uri)
+
+    # Partial file of an outdated version is replaced.
+    server.resources["/archive.zip"] = body
+    assert fetch(cache, uri)[0] == body
+    assert server.ranges[-1].startswith("bytes=")
+
+
+def test_http_cache_size_mismatch(tmp_path, server):
+    """
+    Test downloads must match the size from the directory listing.
+    """
+    server.resources["/archive.zip"] = b"foo"
+    cache = HttpCache(str(tmp_path), requests.Session())
+    with pytest.raises(IOError):
+        fetch(cache, server.url + "/archive.zip", size=4)
+    assert cache.lookup(server.url + "/archive.zip") is None
+    assert fetch(cache, server.url + "/archive.zip", size=3)[0] == b"foo"
+
+    # Cached and revalidated responses are checked as well.
+    with pytest.raises(IOError):
+        fetch(cache, server.url + "/archive.zip", size=4)
+    assert cache.lookup(server.url + "/archive.zip") is None
+
+
+def test_http_cache_listing_changed(tmp_path, server):
+    """
+    Test cached responses not matching the directory listing are
+    revalidated, even if they never expire.
+    """
+    server.resources["/archive.zip"] = b"foo"
+    uri = server.url + "/archive.zip"
+    cache = HttpCache(str(tmp_path), requests.Session(), ttl=float("inf"))
+    assert fetch(cache, uri, size=3)[0] == b"foo"
+    assert fetch(cache, uri, size=3)[0] == b"foo"
+    assert cache.stats["fresh"] == 1
+
+    # Size has changed.
+    server.resources["/archive.zip"] = b"foobar"
+    assert fetch(cache, uri, size=6)[0] == b"foobar"
+
+    # Resource has been modified after storing it.
+    server.resources["/archive.zip"] = b"barfoo"
+    modified = time.time()
+    buffer = io.BytesIO()
+    cache.fetch(uri, buffer, size=6, modified=modified)
+    assert buffer.getvalue() == b"barfoo"
+    assert cache.stats["downloaded"] == 3
+
+    buffer = io.BytesIO()
+    cache.fetch(uri, buffer, size=6, modified=modified)
+    assert buffer.getvalue() == b"barfoo"
+    assert cache.stats["fresh"] == 2
+
+
+LISTING = b"""<html><head><title>Index of /historical/</title></head><body>
+<h1>Index of /historical/</h1><hr><pre><a href="../">../</a>
+<a href="BESCHREIBUNG_obsgermany_climate_hourly_tu_historical_de.pdf">BESCHREIBUNG_obsgermany_climate_hourly_tu_historical_de.pdf</a>   26-Feb-2020 10:43    115237
+<a href="stundenwerte_TU_00044_20070401_20191231_hist.zip">stundenwerte_TU_00044_20070401_20191231_hist.zip</a>   26-Feb-2020 10:44    548102
+<a href="stundenwerte_TU_00073_19950101_19991231_hist.zip">stundenwerte_TU_00073_19950101_19991231_hist.zip</a>   26-Feb-2020 10:44    123456
+<a href="stundenwerte_TU_00073_20000101_20191231_hist.zip">stundenwerte_TU_00073_20000101_20191231_hist.zip</a>   26-Feb-2020 10:44    234567
+</pre><hr></body></html>
+"""
+
+
+def test_listing_index(tmp_path, server):
+    """
+    Test directory listings are indexed by station id and persisted.
+    """
+    server.resources["/air_temperature/historical"] = LISTING
+    category = {"name": "air_temperature"}
+
+    cdc = DwdCdcClient("hourly", str(tmp_path))
+    cdc.uri = server.url
+    resources = list(cdc.get_measurement_resources(73, category, ["historical"]))
+    assert [resource.date_from for resource in resources] == [19950101, 20000101]
+    assert resources[1].uri.endswith("/stundenwerte_TU_00073_20000101_20191231_hist.zip")
+    assert resources[1].size == 234567
+    assert list(cdc.get_measurement_resources(3, category, ["historical"])) == []
+    assert len(server.requests) == 1
+
+    # Listing is loaded from the index database.
+    cdc = DwdCdcClient("hourly", str(tmp_path))
+    cdc.uri = server.url
+    archives = cdc.get_archive_index(category, "historical")
+    assert [station_id for station_id, resource in archives] == [44, 73, 73]
+    assert archives[2][1] == resources[1]
+    assert len(server.requests) == 1
+
+    # Expired listing is revalidated.
+    cdc = DwdCdcClient("hourly", str(tmp_path), ttl={"listing:historical": 0})
+    cdc.uri = server.url
+    assert len(cdc.get_archive_index(category, "historical")) == 3
+    assert len(server.requests) == 2
+    assert cdc.cache.stats["revalidated"] == 1
+
+
+def test_connection_pool(tmp_path, server):
+    """
+    Test requests reuse keep-alive connections from the pool.
+    """
+    server.resources["/air_temperature/recent"] = LISTING
+    server.resources["/air_temperature/historical"] = LISTING
+    category = {"name": "air_temperature"}
+
+    cdc = DwdCdcClient(
+        "hourly", str(tmp_path), max_connections=2, pool_size=3, ttl={"listing": 0}
+    )
+    assert cdc.http.get_adapter(server.url)._pool_maxsize == 3
+    cdc.uri = server.url
+    for timerange in ["recent", "historical", "recent"]:
+        assert len(cdc.get_archive_index(category, timerange)) == 3
+    assert len(server.requests) == 3
+    assert len(server.clients) == 1
+
+
+def test_ttl_policy():
+    """
+    Test expiration times are selected by the most specific rule.
+    """
+    policy = TtlPolicy({"archive:now": 60, "archive:*:10_minutes": 30, "*:recent": "never"})
+    assert policy.get("archive", "now", "hourly") == 60
+    assert policy.get("archive", "now", "10_minutes") == 60
+    assert policy.get("archive", "historical", "10_minutes") == 30
+    assert policy.get("archive", "recent", "10_minutes") == 30
+    assert policy.get("listing", "recent", "daily") == float("inf")
+
+    # Defaults apply when no given rule matches.
+    assert policy.get("archive", "historical", "hourly") == float("inf")
+    assert policy.get("listing", "historical", "daily") == 86400
+    assert policy.get("stations", None, "daily") == 86400
+    assert policy.get("listing", None, "daily") == 300
+
+    with pytest.raises(ValueError):
+        TtlPolicy({"archive:now:hourly:foo": 60})
+    with pytest.raises(ValueError):
+        TtlPolicy({"archives": 60})
+    with pytest.raises(ValueError):
+        TtlPolicy({"archive:later": 60})
+    with pytest.raises(ValueError):
+        TtlPolicy({"archive": "abc"})
+
+
+@pytest.mark.parametrize("value", ["archive", "archive=abc", "archive=-1", "foo=10", "archive:later=5"])
+def test_parse_ttl_rule_invalid(value):
+    """
+    Test invalid TTL rules are rejected as command line arguments.
+    """
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_ttl_rule(value)
+
+
+def test_parse_ttl_rule():
+    assert parse_ttl_rule("archive:now=60") == ("archive:now", 60.0)
+    assert parse_ttl_rule("*:recent=never") == ("*:recent", float("inf"))
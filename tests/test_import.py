@@ -0,0 +1,772 @@
+import io
+import os
+import pytest
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from zipfile import ZipFile
+
+from dwdweather.client import DwdCdcResource, DwdCdcResult
+from dwdweather.core import DwdWeather
+
+
+AIR_TEMPERATURE = b"""STATIONS_ID;MESS_DATUM;QN_9;TT_TU;RF_TU;eor
+         44;2020060107;    3;  13.1;  63.0;eor
+         44;2020060108;    3;  15.3;  54.0;eor
+         44;2020060109;    3;-999;  49.0;eor
+"""
+
+SUN = b"""STATIONS_ID;MESS_DATUM;QN_7;SD_SO;eor
+         44;2020060108;    3;  60.0;eor
+"""
+
+
+def make_result(category_name, payload):
+    return DwdCdcResult(
+        "hourly", {"name": category_name}, uri="file:///produkt.txt", payload=payload
+    )
+
+
+def test_import_measures_textfile(tmp_path):
+    """
+    Test measurement rows are imported in bulk.
+    """
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path))
+    rowcount = dwd.import_measures_textfile(make_result("air_temperature", AIR_TEMPERATURE))
+    assert rowcount == 3
+
+    result = dwd.query(44, datetime(2020, 6, 1, 8))
+    assert result["datetime"] == 2020060108
+    assert result["air_temperature_200"] == 15.3
+    assert result["relative_humidity_200"] == 54.0
+
+    result = dwd.query(44, datetime(2020, 6, 1, 9))
+    assert result["air_temperature_200"] is None
+
+
+def test_import_measures_textfile_upsert(tmp_path):
+    """
+    Test importing another category only touches its own columns.
+    """
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path))
+    dwd.import_measures_textfile(make_result("air_temperature", AIR_TEMPERATURE))
+    dwd.import_measures_textfile(make_result("sun", SUN))
+    dwd.import_measures_textfile(make_result("sun", SUN))
+
+    result = dwd.query(44, datetime(2020, 6, 1, 8))
+    assert result["air_temperature_200"] == 15.3
+    assert result["sun_duration"] == 60.0
+
+    count = dwd.db.execute("SELECT COUNT(*) AS count FROM measures_hourly").fetchone()
+    assert count["count"] == 3
+
+
+def test_category_tables(tmp_path):
+    """
+    Test categories are stored in separate tables and queries only read selected ones.
+    """
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path))
+    dwd.import_measures_textfile(make_result("air_temperature", AIR_TEMPERATURE))
+    dwd.import_measures_textfile(make_result("sun", SUN))
+    count = dwd.db.execute("SELECT COUNT(*) AS count FROM measures_hourly_sun").fetchone()
+    assert count["count"] == 1
+
+    dwd = DwdWeather(resolution="hourly", category_names=["sun"], cache_path=str(tmp_path))
+    assert dwd.query(44, datetime(2020, 6, 1, 8)) == {
+        "station_id": 44,
+        "datetime": 2020060108,
+        "sun_quality_level": 3,
+        "sun_duration": 60.0,
+    }
+    assert dwd.get_measurement(44, 2020060107) is None
+
+
+def test_category_tables_migration(tmp_path):
+    """
+    Test the wide measurement table of previous versions is migrated.
+    """
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path))
+    dwd.db.close()
+    db = sqlite3.connect(dwd.get_cache_database())
+    db.execute("DROP VIEW measures_hourly")
+    db.execute(
+        "CREATE TABLE measures_hourly (station_id int, datetime int, air_temperature_200 real, sun_duration real)"
+    )
+    db.executemany(
+        "INSERT INTO measures_hourly VALUES (?, ?, ?, ?)",
+        [(44, 2020060107, 13.1, None), (44, 2020060108, 15.3, 60.0)],
+    )
+    db.commit()
+    db.close()
+
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path))
+    result = dwd.query(44, datetime(2020, 6, 1, 8))
+    assert result["air_temperature_200"] == 15.3
+    assert result["sun_duration"] == 60.0
+    count = dwd.db.execute("SELECT COUNT(*) AS count FROM measures_hourly_sun").fetchone()
+    assert count["count"] == 1
+    item = dwd.db.execute("SELECT type FROM sqlite_master WHERE name='measures_hourly'").fetchone()
+    assert item["type"] == "view"
+
+
+def test_query_range(tmp_path):
+    """
+    Test records of a time range are imported first and streamed in order.
+    """
+    dwd = DwdWeather(resolution="hourly", category_names=["air_temperature", "sun"], cache_path=str(tmp_path))
+    dwd.import_measures_textfile(make_result("air_temperature", AIR_TEMPERATURE))
+    dwd.import_measures_textfile(make_result("sun", SUN))
+
+    requests = []
+
+    def get_measurement_resources(station_id, category, timeranges):
+        requests.append((station_id, category["name"], timeranges))
+        return []
+
+    dwd.cdc.get_measurement_resources = get_measurement_resources
+    records = dwd.query_range(44, datetime(2020, 6, 1, 8), datetime(2020, 6, 1, 12))
+    assert sorted(requests) == [
+        (44, "air_temperature", ["historical"]),
+        (44, "sun", ["historical"]),
+    ]
+    records = list(records)
+    assert [record["datetime"] for record in records] == [2020060108, 2020060109]
+    assert records[0]["air_temperature_200"] == 15.3
+    assert records[0]["sun_duration"] == 60.0
+    assert records[1]["sun_duration"] is None
+
+    records = list(
+        dwd.query_range(44, datetime(2020, 6, 1), datetime(2020, 6, 2), fields=["sun_duration"])
+    )
+    assert records == [{"station_id": 44, "datetime": 2020060108, "sun_duration": 60.0}]
+    assert requests[-1] == (44, "sun", ["historical"])
+
+    with pytest.raises(ValueError):
+        dwd.query_range(44, datetime(2020, 6, 1), datetime(2020, 6, 2), fields=["foo"])
+
+
+def test_row_modes(tmp_path):
+    """
+    Test bulk readers emit rows in the selected row mode.
+    """
+    dwd = DwdWeather(
+        resolution="hourly", category_names=["air_temperature", "sun"], cache_path=str(tmp_path), row_mode="tuple"
+    )
+    dwd.import_measures_textfile(make_result("air_temperature", AIR_TEMPERATURE))
+    dwd.import_measures_textfile(make_result("sun", SUN))
+    dwd.cdc.get_measurement_resources = lambda station_id, category, timeranges: []
+
+    start, end = datetime(2020, 6, 1, 7), datetime(2020, 6, 1, 9)
+    fields = ["air_temperature_200", "sun_duration"]
+    rows = dwd.query_range(44, start, end, fields=fields)
+    assert rows.names == ("station_id", "datetime", "air_temperature_200", "sun_duration")
+    assert list(rows) == [
+        (44, 2020060107, 13.1, None),
+        (44, 2020060108, 15.3, 60.0),
+        (44, 2020060109, None, None),
+    ]
+
+    dwd.row_mode = "record"
+    records = list(dwd.query_range(44, start, end, fields=fields))
+    assert records[1].air_temperature_200 == 15.3
+    assert records[1].as_dict() == {
+        "station_id": 44,
+        "datetime": 2020060108,
+        "air_temperature_200": 15.3,
+        "sun_duration": 60.0,
+    }
+    assert not hasattr(records[1], "__dict__")
+
+    np = pytest.importorskip("numpy")
+    dwd.row_mode = "numpy"
+    dwd.batch_size = 2
+    arrays = list(dwd.query_many([44], start=start, end=end))
+    assert [len(array) for array in arrays] == [2, 1]
+    array = np.concatenate(arrays)
+    assert array.dtype["datetime"] == np.int64
+    assert array.dtype["air_temperature_quality_level"] == np.float64
+    assert list(array["datetime"]) == [2020060107, 2020060108, 2020060109]
+    assert np.isnan(array["air_temperature_200"][2])
+    assert array["sun_duration"][1] == 60.0
+
+    with pytest.raises(ValueError):
+        DwdWeather(resolution="hourly", cache_path=str(tmp_path), row_mode="list")
+
+
+def test_to_frame(tmp_path):
+    """
+    Test time series are exported as DataFrame and NumPy arrays.
+    """
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("pandas")
+    dwd = DwdWeather(resolution="hourly", category_names=["air_temperature", "sun"], cache_path=str(tmp_path))
+    dwd.import_measures_textfile(make_result("air_temperature", AIR_TEMPERATURE))
+    dwd.import_measures_textfile(make_result("sun", SUN))
+    dwd.cdc.get_measurement_resources = lambda station_id, category, timeranges: []
+
+    start, end = datetime(2020, 6, 1, 7), datetime(2020, 6, 1, 9)
+    frame = dwd.to_frame(44, start, end, quality=False)
+    assert list(frame.columns) == ["air_temperature_200", "relative_humidity_200", "sun_duration"]
+    assert [value.to_pydatetime() for value in frame.index] == [
+        datetime(2020, 6, 1, 7),
+        datetime(2020, 6, 1, 8),
+        datetime(2020, 6, 1, 9),
+    ]
+    assert frame["sun_duration"].dtype == np.float64
+    assert frame["sun_duration"].isna().tolist() == [True, False, True]
+    assert frame.loc[datetime(2020, 6, 1, 8), "air_temperature_200"] == 15.3
+
+    array = dwd.to_numpy(44, start, end, fields=["air_temperature_200"])
+    assert array.dtype.names == ("station_id", "datetime", "air_temperature_200")
+    assert array["datetime"][2] == np.datetime64("2020-06-01T09:00")
+    assert np.isnan(array["air_temperature_200"][2])
+
+    assert len(dwd.to_frame(44, datetime(2021, 6, 1), datetime(2021, 6, 2))) == 0
+
+
+def test_query_projection(tmp_path):
+    """
+    Test records are restricted to given fields, optionally without quality levels.
+    """
+    dwd = DwdWeather(resolution="hourly", category_names=["air_temperature", "sun"], cache_path=str(tmp_path))
+    dwd.import_measures_textfile(make_result("air_temperature", AIR_TEMPERATURE))
+    dwd.import_measures_textfile(make_result("sun", SUN))
+
+    timestamp = datetime(2020, 6, 1, 8)
+    result = dwd.query(44, timestamp, fields=["sun_duration", "air_temperature_200", "datetime"])
+    assert result == {
+        "station_id": 44,
+        "datetime": 2020060108,
+        "air_temperature_200": 15.3,
+        "sun_duration": 60.0,
+    }
+
+    result = dwd.query(44, timestamp, quality=False)
+    assert sorted(result) == [
+        "air_temperature_200",
+        "datetime",
+        "relative_humidity_200",
+        "station_id",
+        "sun_duration",
+    ]
+
+    category_names, fieldnames = dwd.get_projection(["sun_quality_level"], quality=False)
+    assert category_names == []
+    assert fieldnames == []
+
+    with pytest.raises(ValueError) as excinfo:
+        dwd.query(44, timestamp, fields=["precipitation_height"])
+    assert 'category "precipitation"' in str(excinfo.value)
+    with pytest.raises(ValueError):
+        dwd.query(44, timestamp, fields=["temperature"])
+
+
+def test_query_many(tmp_path):
+    """
+    Test stations missing records are imported at once and read using one query.
+    """
+    dwd = DwdWeather(resolution="hourly", category_names=["air_temperature", "sun"], cache_path=str(tmp_path))
+    payloads = {"air_temperature": AIR_TEMPERATURE, "sun": SUN}
+    for category_name, payload in payloads.items():
+        dwd.import_measures_textfile(make_result(category_name, payload.replace(b" 44;", b" 96;")))
+
+    requests = []
+
+    def get_measurement_resources(station_id, category, timeranges):
+        requests.append((station_id, category["name"]))
+        uri = "https://example.org/{}_{:05d}_akt.zip".format(category["name"], station_id)
+        yield DwdCdcResource(uri, 1591000000, 42)
+
+    def download(uri, fileobj):
+        category_name = uri.split("/")[-1].split("_0")[0]
+        with ZipFile(fileobj, "w") as myzip:
+            myzip.writestr("produkt_{}.txt".format(category_name), payloads[category_name])
+        return {"size": 42, "etag": None, "last_modified": None, "content_hash": category_name}
+
+    dwd.cdc.get_measurement_resources = get_measurement_resources
+    dwd.cdc.open_download = make_open_download(download)
+
+    timestamps = [datetime(2020, 6, 1, 8), datetime(2020, 6, 1, 7)]
+    records = list(dwd.query_many([96, 44], timestamps))
+    assert sorted(requests) == [(44, "air_temperature"), (44, "sun")]
+    assert [(record["station_id"], record["datetime"]) for record in records] == [
+        (44, 2020060107),
+        (44, 2020060108),
+        (96, 2020060107),
+        (96, 2020060108),
+    ]
+    assert records[1]["sun_duration"] == 60.0
+
+    records = list(
+        dwd.query_many(
+            [44, 96],
+            start=datetime(2020, 6, 1, 7),
+            end=datetime(2020, 6, 1, 9),
+            fields=["air_temperature_200"],
+        )
+    )
+    assert len(requests) == 2
+    assert len(records) == 6
+    assert records[4] == {"station_id": 96, "datetime": 2020060108, "air_temperature_200": 15.3}
+
+    with pytest.raises(ValueError):
+        dwd.query_many([44])
+
+
+def test_get_timeranges(tmp_path):
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path))
+    now = datetime.utcnow()
+    assert dwd.get_timeranges(now) == ["now"]
+    assert dwd.get_timeranges(now - timedelta(days=30)) == ["recent"]
+    assert dwd.get_timeranges(now - timedelta(days=500), now) == ["now", "recent", "historical"]
+
+
+def test_import_measures_textfile_invalid_line(tmp_path):
+    """
+    Test lines which can not be decoded are skipped.
+    """
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path))
+    payload = AIR_TEMPERATURE + b"         44;2020060110;    3;  foo;  49.0;eor\n"
+    rowcount = dwd.import_measures_textfile(make_result("air_temperature", payload))
+    assert rowcount == 3
+
+
+def test_import_measures_textfile_zip_member(tmp_path):
+    """
+    Test measurements are streamed from a ZIP archive member.
+    """
+    archive = str(tmp_path / "stundenwerte_TU_00044_akt.zip")
+    with ZipFile(archive, "w") as myzip:
+        myzip.writestr("produkt_tu_stunde_20190101_20200601_00044.txt", AIR_TEMPERATURE)
+
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path))
+    with ZipFile(archive) as myzip:
+        member = myzip.infolist()[0]
+        result = DwdCdcResult(
+            "hourly", {"name": "air_temperature"}, uri=archive, opener=partial(myzip.open, member)
+        )
+        assert dwd.import_measures_textfile(result) == 3
+        assert result.payload == AIR_TEMPERATURE
+
+
+def test_import_measures_textfile_numpy(tmp_path):
+    """
+    Test measurement rows are imported using the vectorized parser.
+    """
+    pytest.importorskip("numpy")
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path), parser="numpy")
+    assert dwd.import_measures_textfile(make_result("air_temperature", AIR_TEMPERATURE)) == 3
+
+    result = dwd.query(44, datetime(2020, 6, 1, 9))
+    assert result["air_temperature_quality_level"] == 3
+    assert result["air_temperature_200"] is None
+    assert result["relative_humidity_200"] == 49.0
+
+
+def test_import_measures_textfile_parsers_invalid_date(tmp_path):
+    """
+    Test both parsers skip lines with invalid dates alike.
+    """
+    pytest.importorskip("numpy")
+    payload = AIR_TEMPERATURE + b"         44;2019022908;    3;  12.0;  50.0;eor\n"
+    records = []
+    for parser in ["python", "numpy"]:
+        dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path / parser), parser=parser)
+        assert dwd.import_measures_textfile(make_result("air_temperature", payload)) == 3
+        records.append(dwd.db.execute("SELECT * FROM measures_hourly_air_temperature").fetchall())
+    assert records[0] == records[1]
+
+
+STATIONS = b"""Stations_id von_datum bis_datum Stationshoehe geoBreite geoLaenge Stationsname Bundesland
+----------- --------- --------- ------------- --------- --------- ----------------------------------------- ----------
+00044 20070401 20200601             44     52.9336    8.2370 Gro\xdfenkneten                            Niedersachsen
+00073 20070401 20200601            374     48.6183   13.0620 Aldersbach-Kramersepp                    Bayern
+"""
+
+
+def test_import_stations(tmp_path):
+    """
+    Test station lists of all categories are merged and upserted in bulk.
+    """
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path))
+    sun = STATIONS.replace(b"00073 20070401 20200601", b"00073 20070401 20200602")
+    sun += b"00091 19810101 20200601            304     50.7446    9.3450 Alsfeld-Eifa                             Hessen\n"
+    results = [
+        DwdCdcResult("hourly", {"name": "air_temperature"}, payload=STATIONS),
+        DwdCdcResult("hourly", {"name": "cloud_type"}, payload=STATIONS),
+        DwdCdcResult("hourly", {"name": "sun"}, payload=sun),
+    ]
+    assert dwd.store_stations(results) == 3
+    assert dwd.store_stations(results) == 3
+
+    stations = dwd.load_stations()
+    assert [station["station_id"] for station in stations] == [44, 73, 91]
+    assert stations[0]["name"] == "Gro\xdfenkneten"
+    assert stations[1]["date_end"] == 20200602
+    assert stations[2]["state"] == "Hessen"
+    assert dwd.get_station_categories(44) == ["air_temperature", "cloud_type", "sun"]
+    assert dwd.get_station_categories(91) == ["sun"]
+
+
+def test_station_coverage(tmp_path):
+    """
+    Test stations without coverage are skipped by queries and station lookups.
+    """
+    dwd = DwdWeather(
+        resolution="hourly", category_names=["air_temperature", "sun"], cache_path=str(tmp_path)
+    )
+    sun = STATIONS.replace(b"00073 20070401 20200601", b"00073 20070401 20100101")
+    dwd.store_stations(
+        [
+            DwdCdcResult("hourly", {"name": "air_temperature"}, payload=STATIONS),
+            DwdCdcResult("hourly", {"name": "sun"}, payload=sun),
+        ]
+    )
+    assert dwd.get_covered_categories(73, datetime(2015, 1, 1)) == ["air_temperature"]
+    assert dwd.get_covered_categories(44, datetime(2030, 1, 1)) == ["air_temperature", "sun"]
+    assert dwd.get_covered_categories(44, datetime(2000, 1, 1)) == []
+    assert dwd.get_covered_categories(5, datetime(2000, 1, 1)) is None
+
+    # Nothing will be downloaded for stations without coverage.
+    downloads = fake_archives(dwd, {})
+    assert dwd.query(44, datetime(2000, 1, 1, 8)) is None
+    assert downloads == []
+
+    station = dwd.nearest_station(lon=13.0, lat=48.6, timestamp=datetime(2015, 1, 1))
+    assert station["station_id"] == 73
+    dwd = DwdWeather(resolution="hourly", category_names=["sun"], cache_path=str(tmp_path))
+    station = dwd.nearest_station(lon=13.0, lat=48.6, timestamp=datetime(2015, 1, 1))
+    assert station["station_id"] == 44
+
+
+def test_station_coverage_unknown(tmp_path):
+    """
+    Test categories are imported when their coverage is unknown.
+    """
+    dwd = DwdWeather(
+        resolution="hourly", category_names=["air_temperature", "sun"], cache_path=str(tmp_path)
+    )
+    requests = []
+
+    def get_measurement_resources(station_id, category, timeranges):
+        requests.append((station_id, category["name"], timeranges))
+        return []
+
+    dwd.cdc.get_measurement_resources = get_measurement_resources
+    last_month = datetime.utcnow() - timedelta(days=30)
+
+    # Spans of historical archives do not exclude recent data.
+    dwd.update_coverage([("air_temperature", 44, "historical", 19500101, 20191231)])
+    assert dwd.get_covered_categories(44, last_month) is None
+    dwd.query(44, last_month)
+    assert {category_name for station_id, category_name, timeranges in requests} == {
+        "air_temperature",
+        "sun",
+    }
+
+    # Station list of "air_temperature" has not been imported.
+    dwd.store_stations([DwdCdcResult("hourly", {"name": "sun"}, payload=STATIONS)])
+    assert dwd.get_covered_categories(44, last_month) == ["air_temperature", "sun"]
+    assert dwd.get_covered_categories(44, datetime(2000, 1, 1)) == ["air_temperature"]
+    station = dwd.nearest_station(lon=13.0, lat=48.6, timestamp=datetime(2000, 1, 1))
+    assert station["station_id"] == 73
+
+    # Cache without coverage information, e.g. from a previous version.
+    dwd.db.execute("DELETE FROM {}".format(dwd.get_coverage_table()))
+    dwd.db.commit()
+    station = dwd.nearest_station(lon=13.0, lat=48.6, timestamp=datetime(2015, 1, 1))
+    assert station["station_id"] == 73
+
+
+def test_import_measures_coverage(tmp_path):
+    """
+    Test historical archives not covering the requested day are skipped.
+    """
+    dwd = DwdWeather(resolution="hourly", category_names=["air_temperature"], cache_path=str(tmp_path))
+    downloads = fake_archives(dwd, {"air_temperature": AIR_TEMPERATURE})
+
+    def get_measurement_resources(station_id, category, timeranges):
+        for date_from, date_to in [(19950101, 19991231), (20000101, 20191231)]:
+            uri = "https://example.org/air_temperature_{:05d}_{}_{}_hist.zip".format(
+                station_id, date_from, date_to
+            )
+            yield DwdCdcResource(uri, 1591000000, 42, date_from, date_to)
+
+    dwd.cdc.get_measurement_resources = get_measurement_resources
+    assert dwd.import_measures(44, historic=True, timestamp=datetime(2005, 1, 1)) == 3
+    assert downloads == ["https://example.org/air_temperature_00044_20000101_20191231_hist.zip"]
+
+    coverage = dwd.db.execute("SELECT * FROM coverage_hourly").fetchall()
+    assert coverage == [
+        {
+            "category": "air_temperature",
+            "station_id": 44,
+            "timerange": "historical",
+            "date_start": 19950101,
+            "date_end": 20191231,
+        }
+    ]
+
+
+def make_open_download(download):
+    """
+    Make replacement for ``DwdCdcClient.open_download`` from a download function.
+    """
+
+    @contextmanager
+    def open_download(uri, size=None, modified=None):
+        buffer = io.BytesIO()
+        record = download(uri, buffer)
+        buffer.seek(0)
+        yield record, buffer
+
+    return open_download
+
+
+def fake_archives(dwd, payloads, modified=1591000000):
+    """
+    Serve archives from given payloads, keyed by category name.
+    """
+    downloads = []
+
+    def get_measurement_resources(station_id, category, timeranges):
+        assert timeranges == ["recent"]
+        uri = "https://example.org/{}_{:05d}_akt.zip".format(category["name"], station_id)
+        yield DwdCdcResource(uri, modified, 42)
+
+    def download(uri, fileobj):
+        downloads.append(uri)
+        category_name = uri.split("/")[-1].split("_0")[0]
+        with ZipFile(fileobj, "w") as myzip:
+            myzip.writestr("produkt_{}.txt".format(category_name), payloads[category_name])
+        fileobj.seek(0)
+        return {
+            "size": 42,
+            "etag": None,
+            "last_modified": None,
+            "content_hash": hashlib.sha256(payloads[category_name]).hexdigest(),
+        }
+
+    dwd.cdc.get_measurement_resources = get_measurement_resources
+    dwd.cdc.open_download = make_open_download(download)
+    return downloads
+
+
+def test_import_measures_concurrent(tmp_path):
+    """
+    Test measurements of multiple categories are imported concurrently.
+    """
+    dwd = DwdWeather(
+        resolution="hourly",
+        category_names=["air_temperature", "sun", "cloud_type"],
+        cache_path=str(tmp_path),
+        workers=2,
+    )
+    fake_archives(dwd, {"air_temperature": AIR_TEMPERATURE, "sun": SUN, "cloud_type": SUN})
+    assert dwd.import_measures(44, latest=True) == 4
+
+    result = dwd.query(44, datetime(2020, 6, 1, 8))
+    assert result["air_temperature_200"] == 15.3
+    assert result["sun_duration"] == 60.0
+
+
+def test_import_measures_writer_error(tmp_path):
+    """
+    Test errors of the writer are raised instead of blocking workers forever.
+    """
+    payload = AIR_TEMPERATURE.splitlines()[0] + b"\n" + b"".join(
+        b"44;20200601%02d;    3;  13.1;  63.0;eor\n" % hour for hour in range(24)
+    )
+
+    def upsert_measurements(category_name, rows):
+        raise sqlite3.OperationalError("database is locked")
+
+    errors = []
+
+    def run():
+        # The database connection must be created within this thread.
+        dwd = DwdWeather(
+            resolution="hourly", category_names=["air_temperature"], cache_path=str(tmp_path), workers=1, batch_size=1
+        )
+        fake_archives(dwd, {"air_temperature": payload})
+        dwd.upsert_measurements = upsert_measurements
+        try:
+            dwd.import_measures(44, latest=True)
+        except sqlite3.OperationalError as ex:
+            errors.append(ex)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert str(errors[0]) == "database is locked"
+
+
+def test_import_measures_manifest(tmp_path):
+    """
+    Test archives are skipped when they have been imported already.
+    """
+    dwd = DwdWeather(
+        resolution="hourly", category_names=["air_temperature", "sun"], cache_path=str(tmp_path)
+    )
+    payloads = {"air_temperature": AIR_TEMPERATURE, "sun": SUN}
+    downloads = fake_archives(dwd, payloads)
+    assert dwd.import_measures(44, latest=True) == 4
+    assert len(downloads) == 2
+
+    # Unchanged listing information, archives will not be downloaded.
+    assert dwd.import_measures(44, latest=True) == 0
+    assert len(downloads) == 2
+
+    # Changed listing information, but same content.
+    downloads = fake_archives(dwd, payloads, modified=1592000000)
+    assert dwd.import_measures(44, latest=True) == 0
+    assert len(downloads) == 2
+
+    # Unfinished import, archive will be imported again.
+    manifest_table = dwd.get_manifest_table()
+    dwd.db.execute("UPDATE {} SET status='started' WHERE category='sun'".format(manifest_table))
+    dwd.db.commit()
+    downloads = fake_archives(dwd, payloads, modified=1592000000)
+    assert dwd.import_measures(44, latest=True) == 1
+    assert len(downloads) == 1
+
+    entry = dwd.get_manifest()[downloads[0]]
+    assert entry["status"] == "complete"
+    assert entry["rowcount"] == 1
+    assert entry["content_hash"] == hashlib.sha256(SUN).hexdigest()
+
+
+def test_backfill(tmp_path):
+    """
+    Test measurements of multiple stations are backfilled using worker processes.
+    """
+    dwd = DwdWeather(
+        resolution="hourly",
+        category_names=["air_temperature", "sun"],
+        cache_path=str(tmp_path),
+    )
+    payloads = {"air_temperature": AIR_TEMPERATURE, "sun": SUN}
+
+    def get_measurement_uris(station_id, category, timeranges):
+        yield "https://example.org/{}_{:05d}_akt.zip".format(category["name"], station_id)
+
+    def download(uri, fileobj):
+        category_name = uri.split("/")[-1].split("_0")[0]
+        payload = payloads[category_name].replace(b" 44;", b" %d;" % int(uri[-13:-8]))
+        with ZipFile(fileobj, "w") as myzip:
+            myzip.writestr("produkt_{}.txt".format(category_name), payload)
+
+    dwd.cdc.get_measurement_uris = get_measurement_uris
+    dwd.cdc.download = download
+    assert dwd.backfill([44, 96], timeranges=["recent"], processes=2) == 8
+
+    result = dwd.query(96, datetime(2020, 6, 1, 8))
+    assert result["air_temperature_200"] == 15.3
+    assert result["sun_duration"] == 60.0
+
+
+def test_backfill_writer_died(tmp_path, monkeypatch):
+    """
+    Test backfilling fails instead of blocking when the writer process is gone.
+    """
+    dwd = DwdWeather(
+        resolution="hourly", category_names=["air_temperature"], cache_path=str(tmp_path), batch_size=1
+    )
+    payload = AIR_TEMPERATURE.splitlines()[0] + b"\n" + b"".join(
+        b"44;20200601%02d;    3;  13.1;  63.0;eor\n" % hour for hour in range(24)
+    )
+
+    def get_measurement_uris(station_id, category, timeranges):
+        yield "https://example.org/{}_{:05d}_akt.zip".format(category["name"], station_id)
+
+    def download(uri, fileobj):
+        with ZipFile(fileobj, "w") as myzip:
+            myzip.writestr("produkt_tu_stunde.txt", payload)
+
+    # Writer process exits hard on its first write, workers inherit the patch.
+    monkeypatch.setattr(DwdWeather, "upsert_measurements", lambda self, category_name, rows: os._exit(3))
+    dwd.cdc.get_measurement_uris = get_measurement_uris
+    dwd.cdc.download = download
+    with pytest.raises(RuntimeError):
+        dwd.backfill([44], timeranges=["recent"], processes=1)
+
+
+def test_mirror_resume(tmp_path):
+    """
+    Test mirroring a category resumes after an interruption.
+    """
+    dwd = DwdWeather(resolution="hourly", category_names=["air_temperature"], cache_path=str(tmp_path))
+    archives = {
+        "https://example.org/stundenwerte_TU_{:05d}_akt.zip".format(station_id): station_id
+        for station_id in [44, 96, 5792]
+    }
+    downloads = []
+
+    def get_archive_index(category, timerange):
+        return [(station_id, DwdCdcResource(uri, 1591000000, 42)) for uri, station_id in archives.items()]
+
+    def download(uri, fileobj):
+        downloads.append(uri)
+        if archives[uri] == 5792 and downloads.count(uri) == 1:
+            raise IOError("Connection reset")
+        payload = AIR_TEMPERATURE.replace(b" 44;", b" %d;" % archives[uri])
+        with ZipFile(fileobj, "w") as myzip:
+            myzip.writestr("produkt_tu_stunde.txt", payload)
+        return {"size": 42, "etag": None, "last_modified": None, "content_hash": uri}
+
+    dwd.cdc.get_archive_index = get_archive_index
+    dwd.cdc.open_download = make_open_download(download)
+
+    with pytest.raises(RuntimeError):
+        dwd.mirror(timeranges=["recent"], station_ids=[44, 5792])
+    assert sorted(downloads) == sorted(uri for uri in archives if archives[uri] != 96)
+
+    assert dwd.mirror(timeranges=["recent"], station_ids=[44, 5792]) == 3
+    assert len(downloads) == 3
+
+    result = dwd.query(5792, datetime(2020, 6, 1, 8))
+    assert result["air_temperature_200"] == 15.3
+    count = dwd.db.execute("SELECT COUNT(*) AS count FROM measures_hourly").fetchone()
+    assert count["count"] == 6
+
+
+def test_mirror_priority(tmp_path):
+    """
+    Test mirrored historical records win over recent ones, and mirrored
+    archives are recorded in the manifest.
+    """
+    dwd = DwdWeather(
+        resolution="hourly", category_names=["air_temperature"], cache_path=str(tmp_path), workers=1
+    )
+    payloads = {
+        "https://example.org/stundenwerte_TU_00044_20070401_20200601_hist.zip": AIR_TEMPERATURE,
+        "https://example.org/stundenwerte_TU_00044_akt.zip": AIR_TEMPERATURE.replace(b"15.3", b"99.9"),
+    }
+
+    def get_archive_index(category, timerange):
+        uri = [uri for uri in payloads if (timerange == "historical") == uri.endswith("_hist.zip")][0]
+        return [(44, DwdCdcResource(uri, 1591000000, 42))]
+
+    def download(uri, fileobj):
+        with ZipFile(fileobj, "w") as myzip:
+            myzip.writestr("produkt_tu_stunde.txt", payloads[uri])
+        return {"size": 42, "etag": None, "last_modified": None, "content_hash": uri}
+
+    dwd.cdc.get_archive_index = get_archive_index
+    dwd.cdc.open_download = make_open_download(download)
+
+    # Historical archive is loaded first.
+    dwd.mirror(timeranges=["historical", "recent"])
+
+    result = dwd.query(44, datetime(2020, 6, 1, 8))
+    assert result["air_temperature_200"] == 15.3
+
+    manifest = dwd.get_manifest()
+    assert sorted(manifest) == sorted(payloads)
+    for uri in payloads:
+        assert dwd.is_archive_unchanged(manifest[uri], DwdCdcResource(uri, 1591000000, 42))
+        assert manifest[uri]["rowcount"] == 3
@@ -0,0 +1,132 @@
+import pytest
+
+from dwdweather.parser import (
+    decode_stations,
+    get_row_decoder,
+    get_timestamp_decoder,
+    parse_columns,
+    parse_timestamp,
+)
+
+
+@pytest.mark.parametrize(
+    "timestamp_format, timestamp_raw, expected",
+    [
+        ("%Y%m%d", "20200601", 20200601),
+        ("%Y%m%d%H", "2020060108", 2020060108),
+        ("%Y%m%d%H", "2020051908:00", 2020051908),
+        ("%Y%m%d%H", "20200601", 2020060100),
+        ("%Y%m%d%H%M", "202006010800", 202006010800),
+        ("%Y%m%d%H%M", "2018112922", 201811292200),
+        ("%Y%m%d", "20200229", 20200229),
+    ],
+)
+def test_timestamp_decoder(timestamp_format, timestamp_raw, expected):
+    """
+    Test fast timestamp decoder matches the dateutil-based path.
+    """
+    decoder = get_timestamp_decoder(timestamp_format)
+    assert decoder(timestamp_raw) == expected
+    assert parse_timestamp(timestamp_raw, timestamp_format) == expected
+
+
+@pytest.mark.parametrize("timestamp_raw", ["20190229", "2020060125", "foobar"])
+def test_timestamp_decoder_invalid(timestamp_raw):
+    """
+    Test invalid timestamps are rejected by the fallback path.
+    """
+    decoder = get_timestamp_decoder("%Y%m%d%H")
+    with pytest.raises(ValueError):
+        decoder(timestamp_raw)
+
+
+def test_row_decoder():
+    """
+    Test compiled row decoder maps a line to SQL parameters.
+    """
+    decoder = get_row_decoder("hourly", "air_temperature")
+    assert decoder("         44;2020060108;    3;  15.3;  54.0;eor") == (3, 15.3, 54.0, 44, 2020060108)
+    assert decoder("         44;2020060109;    3;-999;  -999;eor") == (3, None, None, 44, 2020060109)
+    assert get_row_decoder("hourly", "air_temperature") is decoder
+
+
+def test_row_decoder_types():
+    """
+    Test compiled row decoder honors field types of the knowledge base.
+    """
+    decoder = get_row_decoder("hourly", "visibility")
+    assert decoder("96;2020060108;3;P  ;39870;eor") == (3, "P", 39870, 96, 2020060108)
+
+    decoder = get_row_decoder("hourly", "solar")
+    row = decoder("5792;2020051908:00;4;83;-999;256;60;50.37;2020051909:23;eor")
+    assert row == (4, 83.0, None, 256.0, 60, 50.37, 202005190923, 5792, 2020051908)
+
+
+def test_parse_columns():
+    """
+    Test vectorized parser matches the compiled row decoders.
+    """
+    pytest.importorskip("numpy")
+    text = (
+        "STATIONS_ID;MESS_DATUM;QN_592;ATMO_LBERG;FD_LBERG;FG_LBERG;SD_LBERG;ZENIT;MESS_DATUM_WOZ;eor\r\n"
+        "5792;2020051908:00;4;83;-999;256;60;50.37;2020051909:23;eor\r\n"
+        "5792;2020051909:00;4;85;12.5;-999;-999;45.10;2020051910:23;eor\r\n"
+    )
+    columns = parse_columns(text, "hourly", "solar")
+    assert len(columns) == 2
+    assert columns.datetime.tolist() == [2020051908, 2020051909]
+    assert columns.station_id.tolist() == [5792, 5792]
+
+    decoder = get_row_decoder("hourly", "solar")
+    expected = [decoder(line) for line in text.splitlines()[1:]]
+    assert list(columns.iter_rows()) == expected
+
+
+def test_parse_columns_irregular():
+    """
+    Test vectorized parser rejects files with an irregular layout.
+    """
+    pytest.importorskip("numpy")
+    text = "STATIONS_ID;MESS_DATUM;QN_7;SD_SO;eor\n44;2020060108;3;eor\n"
+    with pytest.raises(ValueError):
+        parse_columns(text, "hourly", "sun")
+
+
+@pytest.mark.parametrize("timestamp", ["2019022908", "2019043108", "2019130108"])
+def test_parse_columns_invalid_date(timestamp):
+    """
+    Test vectorized parser rejects invalid dates, so lines get skipped by
+    the row decoders like with the Python parser.
+    """
+    pytest.importorskip("numpy")
+    text = "STATIONS_ID;MESS_DATUM;QN_7;SD_SO;eor\n44;2020022908;3;60.0;eor\n44;{};3;60.0;eor\n".format(
+        timestamp
+    )
+    with pytest.raises(ValueError):
+        parse_columns(text, "hourly", "sun")
+
+    # Leap days are valid.
+    columns = parse_columns(text.splitlines()[0] + "\n44;2020022908;3;60.0;eor\n", "hourly", "sun")
+    assert columns.datetime.tolist() == [2020022908]
+
+
+def test_decode_stations():
+    """
+    Test station lists are decoded, with or without trailing columns.
+    """
+    payload = (
+        "Stations_id von_datum bis_datum Stationshoehe geoBreite geoLaenge Stationsname Bundesland Abgabe\n"
+        "----------- --------- --------- ------------- --------- --------- ----------------------------------------- ---------- ------\n"
+        "00001 19370101 19860630            478     47.8413    8.8493 Aach                                     Baden-W\xfcrttemberg Frei\n"
+        "00096 20190410 20200601             50     52.9437   12.8518 Neuruppin-Alt Ruppin                     Brandenburg  Frei\n"
+        "00097 foo\n"
+        "\x1a\n"
+    ).encode("latin-1")
+    stations = list(decode_stations(payload))
+    assert stations == [
+        (1, 19370101, 19860630, 8.8493, 47.8413, 478, "Aach", "Baden-W\xfcrttemberg"),
+        (96, 20190410, 20200601, 12.8518, 52.9437, 50, "Neuruppin-Alt Ruppin", "Brandenburg"),
+    ]
+
+    payload = payload.replace(b" Abgabe", b"").replace(b" Frei", b"")
+    assert list(decode_stations(payload))[1][6:] == ("Neuruppin-Alt Ruppin", "Brandenburg")
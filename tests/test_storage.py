@@ -0,0 +1,62 @@
+import os
+import sqlite3
+
+import pytest
+
+from dwdweather.core import DwdWeather
+from dwdweather.storage import Checkpointer
+from tests.test_import import AIR_TEMPERATURE, make_result
+
+
+def get_pragma(dwd, name):
+    return list(dwd.db.execute("PRAGMA {}".format(name)).fetchone().values())[0]
+
+
+@pytest.mark.parametrize(
+    "profile, journal_mode, synchronous, mmap_size",
+    [("safe", "delete", 2, 0), ("serve", "wal", 1, 268435456), ("bulk-load", "wal", 0, 1073741824)],
+)
+def test_storage_profile(tmp_path, profile, journal_mode, synchronous, mmap_size):
+    """
+    Test storage profiles configure the database connection.
+    """
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path), storage_profile=profile)
+    assert get_pragma(dwd, "journal_mode") == journal_mode
+    assert get_pragma(dwd, "synchronous") == synchronous
+    assert get_pragma(dwd, "mmap_size") == mmap_size
+
+
+def test_storage_profile_unknown(tmp_path):
+    with pytest.raises(ValueError):
+        DwdWeather(resolution="hourly", cache_path=str(tmp_path), storage_profile="fast")
+
+
+def test_storage_concurrent_reader(tmp_path):
+    """
+    Test readers are not blocked by an import in progress.
+    """
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path), storage_profile="bulk-load")
+    dwd.import_measures_textfile(make_result("air_temperature", AIR_TEMPERATURE))
+
+    # Keep write transaction open.
+    dwd.db.execute("DELETE FROM measures_hourly_air_temperature")
+
+    reader = sqlite3.connect(dwd.get_cache_database(), timeout=0)
+    count = reader.execute("SELECT COUNT(*) FROM measures_hourly_air_temperature").fetchone()[0]
+    assert count == 3
+    dwd.db.rollback()
+
+
+def test_storage_checkpointer(tmp_path):
+    """
+    Test WAL checkpoints are run from a background thread.
+    """
+    dwd = DwdWeather(resolution="hourly", cache_path=str(tmp_path), storage_profile="bulk-load")
+    size = os.path.getsize(dwd.get_cache_database())
+    with dwd.checkpointing() as checkpointer:
+        assert isinstance(checkpointer, Checkpointer)
+        dwd.import_measures_textfile(make_result("air_temperature", AIR_TEMPERATURE))
+    assert checkpointer.count >= 1
+
+    # Commits do not checkpoint, the database file grows by the checkpointer only.
+    assert os.path.getsize(dwd.get_cache_database()) > size